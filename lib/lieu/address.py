@@ -68,3 +68,27 @@ class Address(object):
             fields[Coordinates.LONGITUDE] = lon
 
         return fields
+
+    '''Fixed field order for the compact tuple encoding used in shuffles'''
+    tuple_fields = (
+        AddressComponents.NAME,
+        AddressComponents.HOUSE_NUMBER,
+        AddressComponents.STREET,
+        AddressComponents.FLOOR,
+        AddressComponents.UNIT,
+        AddressComponents.CITY,
+        AddressComponents.POSTAL_CODE,
+        Coordinates.LATITUDE,
+        Coordinates.LONGITUDE,
+        VenueDetails.PHONE,
+        VenueDetails.WEBSITE,
+    )
+
+    @classmethod
+    def to_tuple(cls, address):
+        '''Positional tuple of the address fields (None where missing), much smaller pickled than the dict'''
+        return tuple((address.get(f) for f in cls.tuple_fields))
+
+    @classmethod
+    def from_tuple(cls, values):
+        return {f: v for f, v in six.moves.zip(cls.tuple_fields, values) if v is not None}
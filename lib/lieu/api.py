@@ -1,6 +1,9 @@
+import ujson as json
 import uuid
 from operator import itemgetter
 
+from lieu.encoding import safe_encode
+
 
 class DedupeResponse(object):
     class classifications:
@@ -8,6 +11,9 @@ class DedupeResponse(object):
         LIKELY_DUPE = 'likely_dupe'
         EXACT_DUPE = 'exact_dupe'
 
+    '''Classifications that make a record a dupe of the other'''
+    dupe_classifications = (classifications.EXACT_DUPE, classifications.LIKELY_DUPE)
+
     class deduping_types:
         VENUE = 'venue'
         ADDRESS = 'address'
@@ -22,7 +28,7 @@ class DedupeResponse(object):
 
     @classmethod
     def random_guid(cls):
-        return uuid.uuid4().get_hex()
+        return uuid.uuid4().hex
 
     @classmethod
     def add_guid(cls, value, guid):
@@ -87,21 +93,58 @@ class DedupeResponse(object):
             return response
 
         response.setdefault(key, [])
+        # same key order as raw_possible_dupe, so both serialize the same
         dupe = {
             'is_canonical': is_canonical,
             'classification': classification,
-            'object': value,
         }
 
         if similarity is not None:
-            dupe.update(similarity=min(similarity, 1.0))
+            dupe['similarity'] = min(similarity, 1.0)
 
         if explain:
             dupe['explain'] = explain
+        dupe['object'] = value
         response[key].append(dupe)
 
         return response
 
+    @classmethod
+    def raw_possible_dupe(cls, raw_value, classification, is_canonical, similarity, raw_explain=None):
+        parts = [b'{"is_canonical":', b'true' if is_canonical else b'false',
+                 b',"classification":', safe_encode(json.dumps(classification))]
+        if similarity is not None:
+            parts.extend((b',"similarity":', safe_encode(json.dumps(min(similarity, 1.0)))))
+        if raw_explain:
+            parts.extend((b',"explain":', raw_explain))
+        parts.extend((b',"object":', safe_encode(raw_value), b'}'))
+        return b''.join(parts)
+
+    @classmethod
+    def raw_response(cls, raw_value, is_dupe=False, same_as=(), raw_explain=None):
+        '''
+        Same response as create, as UTF-8 JSON bytes spliced together from the
+        features' already-serialized JSON (which should have their guids) so
+        they're never parsed or re-encoded. raw_explain is the explain dict
+        serialized once by the caller.
+        '''
+        dupes = []
+        possible_dupes = []
+        for raw_other, classification, is_canonical, similarity in same_as:
+            if classification in cls.dupe_classifications:
+                dupes.append(cls.raw_possible_dupe(raw_other, classification, is_canonical, similarity, raw_explain=raw_explain))
+            elif classification == cls.classifications.NEEDS_REVIEW:
+                possible_dupes.append((similarity, cls.raw_possible_dupe(raw_other, classification, is_canonical, similarity, raw_explain=raw_explain)))
+
+        parts = [b'{"object":', safe_encode(raw_value), b',"is_dupe":', b'true' if is_dupe else b'false']
+        if dupes:
+            parts.extend((b',"same_as":[', b','.join(dupes), b']'))
+        if possible_dupes:
+            possible_dupes.sort(key=itemgetter(0), reverse=True)
+            parts.extend((b',"possibly_same_as":[', b','.join(d for sim, d in possible_dupes), b']'))
+        parts.append(b'}')
+        return b''.join(parts)
+
     @classmethod
     def create(cls, value, is_dupe=False, add_random_guid=False, same_as=[], explain=None):
         response = cls.base_response(value, is_dupe=is_dupe)
@@ -0,0 +1,70 @@
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''
+    Bounded least-recently-used cache with hit/miss counters.
+
+    A maxsize of 0 disables caching entirely (every lookup is a miss
+    and nothing is stored).
+    '''
+    DEFAULT_MAXSIZE = 100000
+
+    missing = object()
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE):
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __contains__(self, key):
+        return key in self.cache
+
+    def get(self, key, default=None):
+        value = self.cache.pop(key, self.missing)
+        if value is self.missing:
+            self.misses += 1
+            return default
+
+        # re-insert to mark as most recently used
+        self.cache[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+
+        self.cache.pop(key, None)
+        self.cache[key] = value
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+
+    def get_or_compute(self, key, func, *args, **kw):
+        value = self.get(key, self.missing)
+        if value is self.missing:
+            value = func(*args, **kw)
+            self.put(key, value)
+        return value
+
+    def resize(self, maxsize):
+        self.maxsize = maxsize
+        while len(self.cache) > max(maxsize, 0):
+            self.cache.popitem(last=False)
+
+    def clear(self):
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.cache),
+            'maxsize': self.maxsize,
+        }
@@ -0,0 +1,171 @@
+import geohash
+import re
+import six
+
+from lieu.address import Coordinates, VenueDetails
+from lieu.encoding import safe_decode
+
+non_digit_regex = re.compile(r'[^\d]+', re.UNICODE)
+# phone fields often hold several numbers, "+1 212 555 0100; +1 212 555 0101",
+# but not split on "/", which is also used inside numbers ("212/555-0100")
+phone_split_regex = re.compile(r'[;,|]|\s+(?:or|ext\.?|x)\s+', re.IGNORECASE | re.UNICODE)
+website_split_regex = re.compile(r'[\s;,|]+', re.UNICODE)
+website_scheme_regex = re.compile(r'^[a-z][a-z0-9+.\-]*://', re.IGNORECASE)
+
+
+class Contact(object):
+    '''
+    Phone numbers and website domains of venues, normalized so they can be
+    compared exactly, which is far cheaper than libpostal or Soft-TFIDF.
+
+    Phone numbers keep all their digits except leading zeros, and two
+    numbers match when the longer one ends with the shorter one (of at
+    least MIN_PHONE_DIGITS digits), so the same number with and without a
+    country code or trunk prefix matches ("+44 20 7946 0000" and
+    "020 7946 0000"). Numbers of different lengths that don't match might
+    still be the same line written differently, so only numbers of the same
+    length that differ count as a conflict.
+
+    Websites are reduced to their registrable domain ("www.joes.com/menu"
+    and "order.joes.com" are both "joes.com", "joes.co.uk" stays as is),
+    and domains that many unrelated venues share (social networks, site
+    builders) are ignored.
+    '''
+    MIN_PHONE_DIGITS = 7
+
+    DEFAULT_GEOHASH_PRECISION = 5
+
+    phone_key_prefix = u'phone'
+    website_key_prefix = u'website'
+
+    '''Domains of pages for many unrelated venues, useless as a signal'''
+    shared_domains = frozenset([
+        'facebook.com', 'fb.com', 'instagram.com', 'twitter.com', 'x.com',
+        'linkedin.com', 'youtube.com', 'yelp.com', 'tripadvisor.com', 'foursquare.com',
+        'google.com', 'goo.gl', 'bit.ly',
+        'blogspot.com', 'wordpress.com', 'wixsite.com', 'squarespace.com', 'tumblr.com',
+        'linktr.ee',
+    ])
+
+    '''Second-level labels under which country code domains are registered, as in co.uk or com.au'''
+    generic_second_level_labels = frozenset([
+        'co', 'com', 'net', 'org', 'gov', 'edu', 'ac', 'ne', 'or', 'go',
+    ])
+
+    @classmethod
+    def field_values(cls, address, field, split_regex):
+        '''Text values of a field that may hold a list, a number or a delimited string'''
+        value = address.get(field)
+        if not value:
+            return []
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+
+        values = []
+        for v in value:
+            v = safe_decode(v) if isinstance(v, (six.string_types, six.binary_type)) else six.text_type(v)
+            values.extend(split_regex.split(v))
+        return [v for v in values if v and v.strip()]
+
+    @classmethod
+    def phone_number(cls, value):
+        digits = non_digit_regex.sub(u'', value).lstrip(u'0')
+        if len(digits) < cls.MIN_PHONE_DIGITS:
+            return None
+        return digits
+
+    @classmethod
+    def phone_numbers(cls, address):
+        '''Set of normalized phone numbers of an address'''
+        numbers = (cls.phone_number(v) for v in cls.field_values(address, VenueDetails.PHONE, phone_split_regex))
+        return frozenset((n for n in numbers if n))
+
+    @classmethod
+    def phone_numbers_match(cls, n1, n2):
+        if len(n1) > len(n2):
+            n1, n2 = n2, n1
+        return len(n1) >= cls.MIN_PHONE_DIGITS and n2.endswith(n1)
+
+    @classmethod
+    def website_domain(cls, value):
+        value = website_scheme_regex.sub(u'', value.strip().lower())
+        host = re.split(u'[/?#:]', value, 1)[0].strip(u'.')
+        labels = host.split(u'.')
+        if len(labels) < 2 or not all(labels) or labels[-1].isdigit():
+            return None
+
+        num_labels = 2
+        if len(labels) > 2 and len(labels[-1]) == 2 and labels[-2] in cls.generic_second_level_labels:
+            num_labels = 3
+
+        domain = u'.'.join(labels[-num_labels:])
+        if domain in cls.shared_domains:
+            return None
+        return domain
+
+    @classmethod
+    def website_domains(cls, address):
+        '''Set of normalized website domains of an address'''
+        domains = (cls.website_domain(v) for v in cls.field_values(address, VenueDetails.WEBSITE, website_split_regex))
+        return frozenset((d for d in domains if d))
+
+    @classmethod
+    def values_match(cls, values1, values2):
+        '''True if the sets share a value, False if they don't, None if either is empty'''
+        if not values1 or not values2:
+            return None
+        return not values1.isdisjoint(values2)
+
+    @classmethod
+    def phone_match(cls, a1, a2):
+        '''
+        True if any of the phone numbers match, False if none do but two of
+        them have the same length, None otherwise (including no numbers)
+        '''
+        numbers1 = cls.phone_numbers(a1)
+        numbers2 = cls.phone_numbers(a2)
+        if not numbers1 or not numbers2:
+            return None
+
+        comparable = False
+        for n1 in numbers1:
+            for n2 in numbers2:
+                if cls.phone_numbers_match(n1, n2):
+                    return True
+                comparable = comparable or len(n1) == len(n2)
+        return False if comparable else None
+
+    @classmethod
+    def website_match(cls, a1, a2):
+        return cls.values_match(cls.website_domains(a1), cls.website_domains(a2))
+
+    @classmethod
+    def geohash(cls, address, geohash_precision=DEFAULT_GEOHASH_PRECISION):
+        lat = address.get(Coordinates.LATITUDE)
+        lon = address.get(Coordinates.LONGITUDE)
+        if lat is None or lon is None:
+            return None
+        return geohash.encode(lat, lon, precision=geohash_precision)
+
+    @classmethod
+    def hashes(cls, address, geohash_precision=DEFAULT_GEOHASH_PRECISION, with_phone=True, with_website=True):
+        '''
+        Block keys of each phone number (its last MIN_PHONE_DIGITS digits, so
+        any two numbers that can match share one) and/or website domain with
+        the geohash of the address, none without coordinates. Only the
+        address's own cell is used, as in MinHashLSH, so a pair shares a
+        key once rather than once per neighboring cell.
+        '''
+        values = []
+        if with_phone:
+            values.extend(set(((cls.phone_key_prefix, n[-cls.MIN_PHONE_DIGITS:]) for n in cls.phone_numbers(address))))
+        if with_website:
+            values.extend(((cls.website_key_prefix, d) for d in cls.website_domains(address)))
+        if not values:
+            return []
+
+        gh = cls.geohash(address, geohash_precision=geohash_precision)
+        if gh is None:
+            return []
+
+        return [u'|'.join((prefix, gh, value)) for prefix, value in values]
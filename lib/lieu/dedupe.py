@@ -3,31 +3,145 @@ import geohash
 import re
 import six
 
-from postal.near_dupe import near_dupe_hashes
-from postal.dedupe import place_languages, duplicate_status, is_name_duplicate, is_street_duplicate, is_house_number_duplicate, is_po_box_duplicate, is_unit_duplicate, is_floor_duplicate, is_postal_code_duplicate, is_toponym_duplicate, is_name_duplicate_fuzzy, is_street_duplicate
-from postal.normalize import normalized_tokens
-from postal.tokenize import tokenize
-from postal.token_types import token_types
 
 from lieu.address import AddressComponents, VenueDetails, Coordinates
 from lieu.api import DedupeResponse
+from lieu.cache import LRUCache
+from lieu.contact import Contact
 from lieu.similarity import ordered_word_count, soft_tfidf_similarity, jaccard_similarity
 from lieu.encoding import safe_encode, safe_decode
 from lieu.floats import isclose
+from lieu.libpostal import near_dupe_hashes, place_languages, duplicate_status, is_name_duplicate, is_street_duplicate, is_house_number_duplicate, is_po_box_duplicate, is_unit_duplicate, is_floor_duplicate, is_postal_code_duplicate, is_toponym_duplicate, is_name_duplicate_fuzzy, normalized_tokens, tokenize, token_types
 
 whitespace_regex = re.compile('[\s]+')
+word_regex = re.compile('\w', re.UNICODE)
+digits_regex = re.compile('^[0-9]+$')
+number_regex = re.compile('[0-9]+')
+
+
+class LazyValue(object):
+    '''Calls func(*args) on first access and remembers the result'''
+    missing = object()
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+        self.value = self.missing
+
+    def get(self):
+        if self.value is self.missing:
+            self.value = self.func(*self.args)
+        return self.value
+
+    @classmethod
+    def resolve(cls, value):
+        return value.get() if isinstance(value, cls) else value
+
+
+class LibpostalCache(object):
+    '''
+    LRU memoization of the libpostal pair predicates and place_languages.
+
+    Street names repeat across every record on a block face and languages
+    across a whole region, so most calls can skip libpostal's expansions.
+    Pair predicates are keyed on (value1, value2, languages), place_languages
+    on the (label, value) pairs of the address. Each function gets its own
+    cache of the given size.
+    '''
+    DEFAULT_SIZE = LRUCache.DEFAULT_MAXSIZE
+
+    pair_functions = {
+        'name': is_name_duplicate,
+        'street': is_street_duplicate,
+        'house_number': is_house_number_duplicate,
+        'unit': is_unit_duplicate,
+        'floor': is_floor_duplicate,
+    }
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self.caches = {name: LRUCache(maxsize=size) for name in self.pair_functions}
+        self.caches['place_languages'] = LRUCache(maxsize=size)
+
+    def resize(self, size):
+        for cache in self.caches.values():
+            cache.resize(size)
+
+    def clear(self):
+        for cache in self.caches.values():
+            cache.clear()
+
+    def info(self):
+        return {name: cache.info() for name, cache in six.iteritems(self.caches)}
+
+    def pair_status(self, name, value1, value2, languages=None):
+        key = (value1, value2, tuple(languages) if languages is not None else None)
+        return self.caches[name].get_or_compute(key, self.pair_functions[name], value1, value2, languages=languages)
+
+    def place_languages(self, labels, values):
+        '''
+        Same result as place_languages(labels, values). The name can decide
+        the language, so every component is part of the key, sorted so the
+        same components in a different property order share a key.
+        '''
+        key = tuple(sorted(six.moves.zip(labels, values)))
+        return self.caches['place_languages'].get_or_compute(key, place_languages, labels, values)
+
+    def is_name_duplicate(self, value1, value2, languages=None):
+        return self.pair_status('name', value1, value2, languages=languages)
+
+    def is_street_duplicate(self, value1, value2, languages=None):
+        return self.pair_status('street', value1, value2, languages=languages)
+
+    def is_house_number_duplicate(self, value1, value2, languages=None):
+        return self.pair_status('house_number', value1, value2, languages=languages)
+
+    def is_unit_duplicate(self, value1, value2, languages=None):
+        return self.pair_status('unit', value1, value2, languages=languages)
+
+    def is_floor_duplicate(self, value1, value2, languages=None):
+        return self.pair_status('floor', value1, value2, languages=languages)
+
+
+libpostal_cache = LibpostalCache()
 
 
 class AddressDeduper(object):
     DEFAULT_GEOHASH_PRECISION = 7
+    # decimal places, 4 is about 11m
+    DEFAULT_SIGNATURE_COORDINATE_PRECISION = 4
 
     address_only_keys = True
     name_only_keys = False
     name_and_address_keys = False
     with_name = False
 
+    @classmethod
+    def is_trivially_same(cls, value1, value2):
+        # identical strings with some word content always share a libpostal expansion
+        return value1 == value2 and word_regex.search(value1) is not None
+
+    @classmethod
+    def is_trivially_different_house_number(cls, house_number1, house_number2):
+        # plain digit strings only expand to themselves, so different integers can never match
+        return (digits_regex.match(house_number1) is not None and digits_regex.match(house_number2) is not None and
+                int(house_number1) != int(house_number2))
+
+    @classmethod
+    def is_trivially_different_street(cls, street1, street2):
+        # numbered streets ("W 34th St") keep their digits in every expansion, so if both
+        # have numbers and share none they can never match ("Fifth Ave" has no digits to compare)
+        numbers1 = set((int(n) for n in number_regex.findall(street1)))
+        numbers2 = set((int(n) for n in number_regex.findall(street2)))
+        return bool(numbers1) and bool(numbers2) and numbers1.isdisjoint(numbers2)
+
     @classmethod
     def is_address_dupe(cls, a1, a2, languages=None):
+        '''
+        Cascade from cheapest to most expensive check: missing components,
+        plain string comparisons of the house number and street and only
+        then the libpostal predicates. languages may be a LazyValue so it's
+        only computed when libpostal is actually called.
+        '''
         a1_street = a1.get(AddressComponents.STREET)
         a2_street = a2.get(AddressComponents.STREET)
 
@@ -37,28 +151,38 @@ class AddressDeduper(object):
         if not a1_street or not a2_street or not a1_house_number or not a2_house_number:
             return None
 
-        street_status = is_street_duplicate(a1_street, a2_street, languages=languages)
-        house_number_status = is_house_number_duplicate(a1_house_number, a2_house_number, languages=languages)
+        if cls.is_trivially_different_house_number(a1_house_number, a2_house_number):
+            return False
+
+        if not cls.is_trivially_same(a1_house_number, a2_house_number):
+            house_number_status = libpostal_cache.is_house_number_duplicate(a1_house_number, a2_house_number, languages=LazyValue.resolve(languages))
+            if house_number_status != duplicate_status.EXACT_DUPLICATE:
+                return False
 
-        same_street = street_status in (duplicate_status.EXACT_DUPLICATE, duplicate_status.LIKELY_DUPLICATE)
-        same_house_number = house_number_status == duplicate_status.EXACT_DUPLICATE
+        if cls.is_trivially_different_street(a1_street, a2_street):
+            return False
 
-        return same_street and same_house_number
+        if not cls.is_trivially_same(a1_street, a2_street):
+            street_status = libpostal_cache.is_street_duplicate(a1_street, a2_street, languages=LazyValue.resolve(languages))
+            if street_status not in (duplicate_status.EXACT_DUPLICATE, duplicate_status.LIKELY_DUPLICATE):
+                return False
+
+        return True
 
     @classmethod
     def is_sub_building_dupe(cls, a1, a2, languages=None):
         a1_unit = a1.get(AddressComponents.UNIT)
         a2_unit = a2.get(AddressComponents.UNIT)
 
-        if a1_unit and a2_unit and is_unit_duplicate(a1_unit, a2_unit, languages=languages) != duplicate_status.EXACT_DUPLICATE:
+        if a1_unit and a2_unit and libpostal_cache.is_unit_duplicate(a1_unit, a2_unit, languages=LazyValue.resolve(languages)) != duplicate_status.EXACT_DUPLICATE:
             return False
         elif a1_unit or a2_unit:
             return False
 
-        a2_floor = a1.get(AddressComponents.FLOOR)
+        a1_floor = a1.get(AddressComponents.FLOOR)
         a2_floor = a2.get(AddressComponents.FLOOR)
 
-        if a1_floor and a2_floor and is_floor_duplicate(a1_floor, a2_floor, languages=languages) != duplicate_status.EXACT_DUPLICATE:
+        if a1_floor and a2_floor and libpostal_cache.is_floor_duplicate(a1_floor, a2_floor, languages=LazyValue.resolve(languages)) != duplicate_status.EXACT_DUPLICATE:
             return False
         elif a1_floor or a2_floor:
             return False
@@ -79,7 +203,7 @@ class AddressDeduper(object):
             keys, values = cls.address_labels_and_values(address)
             if not (keys and values):
                 continue
-            langs = place_languages(keys, values) or []
+            langs = libpostal_cache.place_languages(keys, values) or []
             new_languages = [lang for lang in langs if lang not in languages_set]
             languages.extend(new_languages)
             languages_set.update(new_languages)
@@ -88,10 +212,66 @@ class AddressDeduper(object):
 
     @classmethod
     def is_dupe(cls, a1, a2, with_unit=True):
-        languages = cls.combined_place_languages(a1, a2)
+        languages = LazyValue(cls.combined_place_languages, a1, a2)
 
         return cls.is_address_dupe(a1, a2, languages=languages) and (not with_unit or cls.is_sub_building_dupe(a1, a2, languages=languages))
 
+    @classmethod
+    def exact_signature(cls, address, coordinate_precision=DEFAULT_SIGNATURE_COORDINATE_PRECISION):
+        '''
+        Key shared by records with the same normalized name (for venues),
+        house number, street, unit and floor, and the same coordinates once
+        rounded to coordinate_precision decimal places. Records with the same
+        key are exact dupes without comparing them. Returns None without a
+        house number, street or coordinates (or a name for venues), since
+        pairwise comparison would never call those exact dupes either.
+        '''
+        lat = address.get(Coordinates.LATITUDE)
+        lon = address.get(Coordinates.LONGITUDE)
+        if lat is None or lon is None:
+            return None
+
+        values = []
+        components = (AddressComponents.HOUSE_NUMBER, AddressComponents.STREET)
+        if cls.with_name:
+            components = (AddressComponents.NAME,) + components
+
+        for component in components:
+            value = address.get(component)
+            tokens = Name.content_tokens(value) if value else None
+            if not tokens:
+                return None
+            values.append(u' '.join(tokens))
+
+        for component in (AddressComponents.UNIT, AddressComponents.FLOOR):
+            value = address.get(component)
+            values.append(u' '.join(Name.content_tokens(value)) if value else u'')
+
+        values.append(u'{:.{p}f},{:.{p}f}'.format(lat, lon, p=coordinate_precision))
+        return u'|'.join(values)
+
+    @classmethod
+    def score_pair(cls, a1, a2, tfidf=None, with_unit=True, contact_signals=False):
+        '''Same (name_status, name_fuzzy_status, name_sim) as VenueDeduper.score_pair, for address dupes (contact_signals only applies to venues)'''
+        if not cls.is_dupe(a1, a2, with_unit=with_unit):
+            return None
+        return cls.exact_name_status(), None, None
+
+    @classmethod
+    def exact_name_status(cls):
+        return duplicate_status.EXACT_DUPLICATE
+
+    '''Code of a missing (None) name status in a scored pairs file'''
+    missing_status_code = -1
+
+    @classmethod
+    def name_status_code(cls, name_status):
+        return name_status.value if name_status is not None else cls.missing_status_code
+
+    @classmethod
+    def name_status_from_code(cls, code):
+        return duplicate_status.from_id(code) if code != cls.missing_status_code else None
+
     @classmethod
     def address_labels_and_values(cls, address):
         string_address = {k: v for k, v in six.iteritems(address) if isinstance(v, six.string_types) and v.strip()}
@@ -157,6 +337,19 @@ class Name(object):
     def content_tokens(cls, name):
         return [t for t, c in normalized_tokens(name) if c in token_types.WORD_TOKEN_TYPES or c in token_types.NUMERIC_TOKEN_TYPES]
 
+    @classmethod
+    def ngrams(cls, name, n=3):
+        '''Set of character n-grams of each content token, padded so short tokens still count'''
+        ngrams = set()
+        for token in cls.content_tokens(name):
+            token = u'_{}_'.format(token)
+            if len(token) <= n:
+                ngrams.add(token)
+                continue
+            for i in six.moves.xrange(len(token) - n + 1):
+                ngrams.add(token[i:i + n])
+        return ngrams
+
 
 class VenueDeduper(AddressDeduper):
     DEFAULT_GEOHASH_PRECISION = 6
@@ -176,14 +369,17 @@ class VenueDeduper(AddressDeduper):
         tfidf = cls.tfidf_vector(tokens, tfidf_index)
         return tfidf_index.normalized_tfidf_vector(tfidf)
 
-    dupe_class_map = {
-        duplicate_status.LIKELY_DUPLICATE: DedupeResponse.classifications.LIKELY_DUPE,
-        duplicate_status.EXACT_DUPLICATE: DedupeResponse.classifications.EXACT_DUPE,
-        duplicate_status.NEEDS_REVIEW: DedupeResponse.classifications.NEEDS_REVIEW,
-    }
+    # built on first use, so importing this module doesn't load libpostal
+    dupe_class_map = None
 
     @classmethod
     def string_dupe_class(cls, dupe_class):
+        if cls.dupe_class_map is None:
+            cls.dupe_class_map = {
+                duplicate_status.LIKELY_DUPLICATE: DedupeResponse.classifications.LIKELY_DUPE,
+                duplicate_status.EXACT_DUPLICATE: DedupeResponse.classifications.EXACT_DUPE,
+                duplicate_status.NEEDS_REVIEW: DedupeResponse.classifications.NEEDS_REVIEW,
+            }
         return cls.dupe_class_map.get(dupe_class)
 
     @classmethod
@@ -201,42 +397,114 @@ class VenueDeduper(AddressDeduper):
                                        likely_dupe_threshold=likely_dupe_threshold, needs_review_threshold=needs_review_threshold)
 
     @classmethod
-    def dupe_class_and_sim(cls, a1, a2, tfidf=None, likely_dupe_threshold=DedupeResponse.default_name_dupe_threshold,
-                           needs_review_threshold=DedupeResponse.default_name_review_threshold, with_unit=False):
+    def pair_languages(cls, a1, a2):
+        a1_minus_name = cls.address_minus_name(a1)
+        a2_minus_name = cls.address_minus_name(a2)
+        return cls.combined_place_languages(a1, a1_minus_name, a2, a2_minus_name)
+
+    @classmethod
+    def score_pair(cls, a1, a2, tfidf=None, with_unit=False, contact_signals=False):
+        '''
+        Threshold-independent half of dupe_class_and_sim, returning
+        (name_status, name_fuzzy_status, name_sim), or None if the pair can't
+        be a dupe whatever the thresholds. name_status is libpostal's
+        duplicate_status for the names (EXACT_DUPLICATE for identical names).
+        name_fuzzy_status and name_sim are what libpostal's Soft-TFIDF
+        predicate returned (see name_dupe_similarity), both None when it
+        wasn't needed or there's no tfidf.
+
+        Checks are ordered from cheapest to most expensive so most pairs are
+        rejected before touching libpostal: missing names, missing/different
+        address components, then the libpostal address and name predicates
+        and finally Soft-TFIDF. Languages are only computed when a libpostal
+        predicate actually needs them.
+
+        With contact_signals, phone numbers and website domains (see Contact)
+        adjust pairs at the same address, unless the names are identical.
+        Conflicting phone numbers (see Contact.phone_match) rule the pair out
+        before the names are compared. A matching phone number makes the pair
+        a likely dupe if the names are at least a needs-review match, since
+        a shared number can also be a different business at the same place
+        (e.g. a restaurant inside a hotel). Otherwise, conflicting website
+        domains lower the pair to needs review at most, since a branch can
+        have its own site. A shared domain alone decides nothing, since
+        chains share them.
+        '''
         a1_name = a1.get(AddressComponents.NAME)
         a2_name = a2.get(AddressComponents.NAME)
         if not a1_name or not a2_name:
-            return None, 0.0
+            return None
 
-        a1_minus_name = cls.address_minus_name(a1)
-        a2_minus_name = cls.address_minus_name(a2)
-        languages = cls.combined_place_languages(a1, a1_minus_name, a2, a2_minus_name)
+        languages = LazyValue(cls.pair_languages, a1, a2)
 
         same_address = cls.is_address_dupe(a1, a2, languages=languages)
         if not same_address:
-            return None, 0.0
+            return None
 
         if with_unit:
             same_unit = cls.is_sub_building_dupe(a1, a2, languages=languages)
             if not same_unit:
-                return None, 0.0
+                return None
+
+        if cls.is_trivially_same(a1_name, a2_name):
+            return duplicate_status.EXACT_DUPLICATE, None, None
+
+        phone_match = website_conflict = False
+        if contact_signals:
+            phone_match = Contact.phone_match(a1, a2)
+            if phone_match is False:
+                return None
+            website_conflict = not phone_match and Contact.website_match(a1, a2) is False
+
+        languages = languages.get()
+
+        name_status = cls.name_dupe_status(a1_name, a2_name, languages=languages)
+        name_fuzzy_status = name_sim = None
+        if name_status != duplicate_status.EXACT_DUPLICATE and tfidf:
+            name_fuzzy_status, name_sim = cls.name_dupe_similarity(a1_name, a2_name, tfidf)
+            if name_fuzzy_status is None:
+                name_sim = None
+
+        if phone_match and (name_status >= duplicate_status.NEEDS_REVIEW or
+                            (name_fuzzy_status is not None and name_fuzzy_status >= duplicate_status.NEEDS_REVIEW)):
+            name_status = max(name_status, duplicate_status.LIKELY_DUPLICATE)
+        elif website_conflict:
+            name_status = min(name_status, duplicate_status.NEEDS_REVIEW)
+            if name_fuzzy_status is not None:
+                name_fuzzy_status = min(name_fuzzy_status, duplicate_status.NEEDS_REVIEW)
+
+        return name_status, name_fuzzy_status, name_sim
 
-        name_dupe_class = cls.name_dupe_status(a1_name, a2_name, languages=languages)
-        if name_dupe_class == duplicate_status.EXACT_DUPLICATE:
+    @classmethod
+    def classify(cls, name_status, name_fuzzy_status, name_sim, likely_dupe_threshold=DedupeResponse.default_name_dupe_threshold,
+                 needs_review_threshold=DedupeResponse.default_name_review_threshold):
+        '''
+        (classification, similarity) of a score_pair result. The thresholds
+        give the similarity of pairs decided by name_status alone.
+        '''
+        if name_status == duplicate_status.EXACT_DUPLICATE:
             return DedupeResponse.classifications.EXACT_DUPE, 1.0
-        elif tfidf:
-            name_fuzzy_dupe_class, name_sim = cls.name_dupe_similarity(a1_name, a2_name, tfidf)
-            if name_fuzzy_dupe_class >= name_dupe_class:
-                return cls.string_dupe_class(name_fuzzy_dupe_class), name_sim
-
-        if name_dupe_class == duplicate_status.LIKELY_DUPLICATE:
-            name_sim = likely_dupe_threshold
-        elif name_dupe_class == duplicate_status.NEEDS_REVIEW:
-            name_sim = needs_review_threshold
-        else:
+
+        if name_fuzzy_status is not None and name_fuzzy_status >= name_status:
+            return cls.string_dupe_class(name_fuzzy_status), name_sim
+
+        if name_status == duplicate_status.LIKELY_DUPLICATE:
+            return cls.string_dupe_class(name_status), likely_dupe_threshold
+        elif name_status == duplicate_status.NEEDS_REVIEW:
+            return cls.string_dupe_class(name_status), needs_review_threshold
+
+        return None, 0.0
+
+    @classmethod
+    def dupe_class_and_sim(cls, a1, a2, tfidf=None, likely_dupe_threshold=DedupeResponse.default_name_dupe_threshold,
+                           needs_review_threshold=DedupeResponse.default_name_review_threshold, with_unit=False, contact_signals=False):
+        score = cls.score_pair(a1, a2, tfidf=tfidf, with_unit=with_unit, contact_signals=contact_signals)
+        if score is None:
             return None, 0.0
 
-        return cls.string_dupe_class(name_dupe_class), name_sim
+        name_status, name_fuzzy_status, name_sim = score
+        return cls.classify(name_status, name_fuzzy_status, name_sim, likely_dupe_threshold=likely_dupe_threshold,
+                            needs_review_threshold=needs_review_threshold)
 
     @classmethod
     def is_dupe(cls, a1, a2, tfidf=None, name_dupe_threshold=DedupeResponse.default_name_dupe_threshold, with_unit=False):
@@ -245,4 +513,10 @@ class VenueDeduper(AddressDeduper):
 
     @classmethod
     def name_dupe_status(cls, name1, name2, languages=None):
-        return is_name_duplicate(name1, name2, languages=languages)
+        return libpostal_cache.is_name_duplicate(name1, name2, languages=languages)
+
+    @classmethod
+    def is_exact_name_dupe(cls, name1, name2, languages=None):
+        if not name1 or not name2:
+            return False
+        return cls.is_trivially_same(name1, name2) or cls.name_dupe_status(name1, name2, languages=languages) == duplicate_status.EXACT_DUPLICATE
@@ -0,0 +1,170 @@
+import copy
+import random
+import six
+import time
+
+from collections import defaultdict
+from six import itertools
+
+from lieu.address import Address
+from lieu.dedupe import libpostal_cache
+
+
+def format_value(value):
+    if isinstance(value, six.string_types):
+        return value
+    if isinstance(value, six.integer_types):
+        return str(value)
+    if value >= 100:
+        return '{:.3g}'.format(value) if value >= 1e6 else '{:.0f}'.format(value)
+    return '{:.2f}'.format(value)
+
+
+def format_table(columns, results):
+    '''Plain-text table of result dicts, one row per result'''
+    rows = [columns] + [tuple((format_value(result[c]) for c in columns)) for result in results]
+    widths = [max((len(row[i]) for row in rows)) for i in six.moves.xrange(len(columns))]
+    return u'\n'.join((u'  '.join((v.rjust(w) if i else v.ljust(w) for i, (v, w) in enumerate(six.moves.zip(row, widths))))
+                       for row in rows))
+
+
+class BlockingEstimate(object):
+    '''
+    Dry run of the blocking stage on a Bernoulli sample of the input, to
+    compare hash options before a full run. Each record is kept with
+    probability sample_rate, so a pair of records is kept with probability
+    sample_rate ** 2. Comparisons counted in the sample blocks are scaled up
+    by 1 / sample_rate ** 2 and block sizes by 1 / sample_rate. The number
+    of blocks doesn't scale that way, so it's reported as seen in the sample.
+
+    The plain mean of the sample block sizes is biased: most large blocks
+    show up as a few records, and blocks with no sampled records don't show
+    up at all. 'block/record' is instead the size of the block an average
+    record is in (weighted by block size), 1 + sum(m * (m - 1)) / sum(m)
+    over the full blocks, estimated from the sample block sizes n as
+    1 + sum(n * (n - 1)) / (sample_rate * sum(n)) since a pair within a
+    block is sampled with probability sample_rate ** 2 and a record with
+    probability sample_rate.
+
+    Projected runtime is the measured hashing time per record times the
+    number of input records, plus the measured time per comparison (over at
+    most max_timed_comparisons pairs from the sample blocks) times the
+    estimated comparisons. The libpostal cache is cleared before each
+    configuration, so the timings of later ones don't benefit from pairs
+    already compared by earlier ones. Small samples undercount the largest blocks, so
+    the estimates are for telling configurations apart by orders of
+    magnitude, not for predicting exact numbers.
+    '''
+    DEFAULT_SAMPLE_RATE = 0.01
+    DEFAULT_MAX_TIMED_COMPARISONS = 1000
+
+    '''(label, pipeline options) tried by default'''
+    default_configurations = [
+        ('latlon gh6', dict(use_latlon=True, geohash_precision=6)),
+        ('latlon gh7', dict(use_latlon=True, geohash_precision=7)),
+        ('latlon gh8', dict(use_latlon=True, geohash_precision=8)),
+        ('latlon+city', dict(use_latlon=True, use_city=True)),
+        ('latlon+postcode', dict(use_latlon=True, use_postal_code=True)),
+        ('latlon+containing', dict(use_latlon=True, use_small_containing=True)),
+        ('city', dict(use_latlon=False, use_city=True)),
+        ('postcode', dict(use_latlon=False, use_postal_code=True)),
+    ]
+
+    columns = ('configuration', 'keys/record', 'sample blocks', 'block/record', 'max block', 'comparisons', 'hours')
+
+    def __init__(self, pipeline, sample_rate=DEFAULT_SAMPLE_RATE, configurations=None,
+                 max_timed_comparisons=DEFAULT_MAX_TIMED_COMPARISONS, seed=0):
+        self.pipeline = pipeline
+        self.sample_rate = sample_rate
+        self.configurations = configurations or self.default_configurations
+        self.max_timed_comparisons = max_timed_comparisons
+        self.random = random.Random(seed)
+
+    def sample(self, features):
+        '''Returns (number of input records, sampled addresses)'''
+        num_records = 0
+        addresses = []
+        for feature in features:
+            num_records += 1
+            if self.random.random() < self.sample_rate:
+                addresses.append(Address.from_geojson(feature))
+        return num_records, addresses
+
+    def configured_pipeline(self, options):
+        pipeline = copy.copy(self.pipeline)
+        pipeline.lsh_only = False
+        pipeline.top_k = None
+        for k, v in six.iteritems(options):
+            setattr(pipeline, k, v)
+        return pipeline
+
+    def time_comparisons(self, pipeline, blocks, addresses, tfidf_index):
+        '''Seconds per comparison over the first max_timed_comparisons pairs, None without any'''
+        pairs = itertools.islice(((canonical, other) for candidates in six.itervalues(blocks) if len(candidates) > 1
+                                  for canonical, other in itertools.combinations(candidates, 2)), self.max_timed_comparisons)
+
+        num_pairs = 0
+        start = time.time()
+        for canonical, other in pairs:
+            for result in pipeline.compare_block([canonical, other], addresses, tfidf_index):
+                pass
+            num_pairs += 1
+
+        if not num_pairs:
+            return None
+        return (time.time() - start) / num_pairs
+
+    def estimate_configuration(self, label, options, num_records, addresses, tfidf_index):
+        pipeline = self.configured_pipeline(options)
+        blocks = defaultdict(list)
+        num_keys = 0
+        num_hashed = 0
+
+        libpostal_cache.clear()
+
+        start = time.time()
+        for i, address in enumerate(addresses):
+            hashes = pipeline.index_address(address)
+            if hashes is None:
+                continue
+            num_hashed += 1
+            num_keys += len(hashes)
+            for h in hashes:
+                blocks[h].append(i)
+        hash_seconds = (time.time() - start) / len(addresses)
+
+        sizes = [len(candidates) for candidates in six.itervalues(blocks)]
+        rate = self.sample_rate
+        sample_comparisons = sum((n * (n - 1) // 2 for n in sizes))
+        comparisons = sample_comparisons / rate ** 2
+        num_blocked = sum(sizes)
+
+        comparison_seconds = self.time_comparisons(pipeline, blocks, dict(enumerate(addresses)), tfidf_index) or 0.0
+
+        return {
+            'configuration': label,
+            'keys/record': float(num_keys) / num_hashed if num_hashed else 0.0,
+            'sample blocks': len(blocks),
+            'block/record': 1.0 + 2.0 * sample_comparisons / (rate * num_blocked) if num_blocked else 0.0,
+            'max block': max(sizes) / rate if sizes else 0.0,
+            'comparisons': comparisons,
+            'hours': (hash_seconds * num_records + comparison_seconds * comparisons) / 3600.0,
+        }
+
+    def estimate(self, features):
+        '''One result dict (keyed by columns) per configuration'''
+        num_records, addresses = self.sample(features)
+        if not addresses:
+            return []
+
+        tfidf_index = self.pipeline.new_tfidf_index()
+        if tfidf_index is not None:
+            for address in addresses:
+                self.pipeline.index_name(address, tfidf_index)
+
+        return [self.estimate_configuration(label, options, num_records, addresses, tfidf_index)
+                for label, options in self.configurations]
+
+    @classmethod
+    def table(cls, results):
+        return format_table(cls.columns, results)
@@ -0,0 +1,150 @@
+import csv
+import six
+import time
+import ujson as json
+
+from lieu.api import DedupeResponse
+from lieu.dedupe import libpostal_cache
+from lieu.encoding import safe_decode
+from lieu.estimate import format_table
+from lieu.lsh import MinHashLSH
+from lieu.pipeline import DedupePipeline
+
+
+class DedupeEvaluation(object):
+    '''
+    Runs DedupePipeline configurations over the same features and scores
+    each against labeled pairs of feature ids, so options that prune
+    candidates can be judged on what they cost in precision and recall as
+    well as what they save in comparisons and time.
+
+    A pair counts as predicted when either feature lists the other in
+    same_as (or possibly_same_as with count_review). Only the labeled pairs
+    are scored: a predicted pair that isn't labeled counts for nothing.
+
+    The libpostal cache is cleared before each run, so a configuration
+    isn't timed against comparisons cached by the one before it.
+    '''
+    DEFAULT_ID_PROPERTY = 'id'
+
+    true_labels = frozenset(['1', 'true', 'yes', 'dupe', DedupeResponse.classifications.EXACT_DUPE, DedupeResponse.classifications.LIKELY_DUPE])
+
+    columns = ('configuration', 'precision', 'recall', 'f1', 'true positives', 'false positives', 'false negatives', 'comparisons', 'seconds')
+
+    '''(label, pipeline options) run by default'''
+    default_configurations = [
+        ('baseline', {}),
+        ('exact signatures', {'exact_signatures': True}),
+        ('lsh', {'lsh': {}}),
+        ('lsh only', {'lsh': {}, 'lsh_only': True}),
+        ('top-10 names', {'top_k': 10}),
+        ('phone/website', {'contact_keys': True, 'contact_signals': True}),
+    ]
+
+    def __init__(self, labels, id_property=DEFAULT_ID_PROPERTY, count_review=False):
+        self.labels = labels
+        self.id_property = id_property
+        self.count_review = count_review
+
+    @classmethod
+    def read_labels(cls, f):
+        '''
+        Tab-separated id1, id2, label lines where label is 1/0, true/false,
+        or a classification. Returns {frozenset((id1, id2)): is_dupe}.
+        '''
+        labels = {}
+        for row in csv.reader(f, delimiter='\t'):
+            if not row or row[0].startswith('#'):
+                continue
+            id1, id2, label = [safe_decode(v).strip() for v in row[:3]]
+            labels[frozenset((id1, id2))] = label.lower() in cls.true_labels
+        return labels
+
+    @classmethod
+    def pipeline(cls, options):
+        '''DedupePipeline from JSON-style options, with lsh given as MinHashLSH options'''
+        options = dict(options)
+        lsh = options.pop('lsh', None)
+        if lsh is not None:
+            options['lsh'] = MinHashLSH(**lsh)
+        return DedupePipeline(**options)
+
+    def feature_id(self, feature):
+        properties = feature.get('properties', {})
+        value = properties.get(self.id_property)
+        if value is None:
+            value = properties.get(DedupeResponse.guid_key)
+        return six.text_type(value) if value is not None else None
+
+    def predicted_pairs(self, responses):
+        keys = ['same_as']
+        if self.count_review:
+            keys.append('possibly_same_as')
+
+        pairs = set()
+        for response in responses:
+            feature_id = self.feature_id(response['object'])
+            for key in keys:
+                for other in response.get(key, ()):
+                    other_id = self.feature_id(other['object'])
+                    if feature_id is not None and other_id is not None:
+                        pairs.add(frozenset((feature_id, other_id)))
+        return pairs
+
+    def score(self, predicted):
+        true_positives = false_positives = false_negatives = 0
+        for pair, is_dupe in six.iteritems(self.labels):
+            if pair in predicted:
+                if is_dupe:
+                    true_positives += 1
+                else:
+                    false_positives += 1
+            elif is_dupe:
+                false_negatives += 1
+
+        precision = float(true_positives) / (true_positives + false_positives) if true_positives + false_positives else 0.0
+        recall = float(true_positives) / (true_positives + false_negatives) if true_positives + false_negatives else 0.0
+        f1 = 2.0 * precision * recall / (precision + recall) if precision + recall else 0.0
+
+        return {
+            'precision': precision,
+            'recall': recall,
+            'f1': f1,
+            'true positives': true_positives,
+            'false positives': false_positives,
+            'false negatives': false_negatives,
+        }
+
+    def evaluate(self, label, pipeline, features):
+        '''features is a list of GeoJSON features, which is left as it was'''
+        # dedupe adds guids to the features, so each run gets its own copies
+        features = [json.loads(json.dumps(feature)) for feature in features]
+
+        libpostal_cache.clear()
+
+        start = time.time()
+        responses = list(pipeline.dedupe(features))
+        seconds = time.time() - start
+
+        result = self.score(self.predicted_pairs(responses))
+        result.update({
+            'configuration': label,
+            'comparisons': pipeline.num_comparisons,
+            'seconds': seconds,
+        })
+        return result
+
+    def evaluate_all(self, features, configurations=None, **kw):
+        '''One result per (label, options), options are added to kw for each pipeline'''
+        if configurations is None:
+            configurations = self.default_configurations
+        results = []
+        for label, options in configurations:
+            pipeline_options = dict(kw)
+            pipeline_options.update(options)
+            results.append(self.evaluate(label, self.pipeline(pipeline_options), features))
+        return results
+
+    @classmethod
+    def table(cls, results):
+        return format_table(cls.columns, results)
@@ -0,0 +1,169 @@
+import geohash
+import heapq
+import six
+
+from collections import Counter
+
+from lieu.address import AddressComponents, Coordinates
+from lieu.dedupe import VenueDeduper, Name
+from lieu.similarity import soft_tfidf_similarities
+
+
+class NameIndex(object):
+    '''
+    Inverted index from the character n-grams of venue names to record ids,
+    kept separately for each geohash cell. A query counts the n-grams each
+    record shares with the name in the query's cell and its neighbors, so
+    only records with some overlap are ever touched. The best candidates by
+    n-gram overlap (Dice coefficient) are then verified with Soft-TFIDF.
+
+    This is meant for dense cells, where comparing every name in a block
+    to every other is quadratic, and for looking up a single record
+    against an existing index.
+
+    A record turns up as a candidate for many queries, so the normalized
+    TF-IDF vector of each indexed name is cached. Cached vectors are
+    dropped when the record is added again or when tfidf_index has seen
+    more documents, since its idf values have changed.
+    '''
+    DEFAULT_GEOHASH_PRECISION = 6
+    DEFAULT_NGRAM_SIZE = 3
+    DEFAULT_K = 10
+    # n-gram candidates verified with Soft-TFIDF per result
+    DEFAULT_CANDIDATE_MULTIPLIER = 4
+
+    def __init__(self, tfidf_index=None, geohash_precision=DEFAULT_GEOHASH_PRECISION, ngram_size=DEFAULT_NGRAM_SIZE):
+        self.tfidf_index = tfidf_index
+        self.geohash_precision = geohash_precision
+        self.ngram_size = ngram_size
+
+        # cell => {ngram: [record_id]}
+        self.cells = {}
+        # record_id => (name, number of distinct n-grams, lat, lon)
+        self.records = {}
+        # record_id => normalized name vector, for tfidf_index at vectors_num_docs documents
+        self.vectors = {}
+        self.vectors_num_docs = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, record_id):
+        return record_id in self.records
+
+    def cell(self, lat, lon):
+        return geohash.encode(lat, lon, precision=self.geohash_precision)
+
+    @classmethod
+    def name_and_coordinates(cls, address):
+        return address.get(AddressComponents.NAME), address.get(Coordinates.LATITUDE), address.get(Coordinates.LONGITUDE)
+
+    def add(self, record_id, name, lat, lon):
+        '''Index a name, returns False if it has no content tokens or coordinates'''
+        if not name or lat is None or lon is None:
+            return False
+
+        ngrams = Name.ngrams(name, n=self.ngram_size)
+        if not ngrams:
+            return False
+
+        postings = self.cells.setdefault(self.cell(lat, lon), {})
+        for ngram in ngrams:
+            postings.setdefault(ngram, []).append(record_id)
+
+        self.records[record_id] = (name, len(ngrams), lat, lon)
+        self.vectors.pop(record_id, None)
+        return True
+
+    def add_address(self, record_id, address):
+        return self.add(record_id, *self.name_and_coordinates(address))
+
+    def candidates(self, name, lat, lon, max_candidates=None, exclude=None):
+        '''
+        Records sharing n-grams with name in the same cell or its neighbors,
+        as [(dice, record_id)] with the highest overlap first.
+        '''
+        if not name or lat is None or lon is None:
+            return []
+
+        ngrams = Name.ngrams(name, n=self.ngram_size)
+        if not ngrams:
+            return []
+
+        cell = self.cell(lat, lon)
+        counts = Counter()
+        for c in [cell] + geohash.neighbors(cell):
+            postings = self.cells.get(c)
+            if not postings:
+                continue
+            for ngram in ngrams:
+                counts.update(postings.get(ngram, ()))
+
+        if exclude is not None:
+            for record_id in exclude:
+                counts.pop(record_id, None)
+
+        num_ngrams = len(ngrams)
+        scored = ((2.0 * shared / (num_ngrams + self.records[record_id][1]), record_id)
+                  for record_id, shared in six.iteritems(counts))
+
+        if max_candidates is None:
+            return sorted(scored, reverse=True)
+        return heapq.nlargest(max_candidates, scored)
+
+    def name_vector(self, name):
+        tokens = Name.content_tokens(name)
+        if not tokens:
+            return None
+        return VenueDeduper.tfidf_vector_normalized(tokens, self.tfidf_index)
+
+    def record_vector(self, record_id):
+        '''Normalized name vector of an indexed record, cached'''
+        num_docs = getattr(self.tfidf_index, 'N', None)
+        if num_docs != self.vectors_num_docs:
+            self.vectors.clear()
+            self.vectors_num_docs = num_docs
+
+        try:
+            return self.vectors[record_id]
+        except KeyError:
+            vector = self.vectors[record_id] = self.name_vector(self.records[record_id][0])
+            return vector
+
+    def top_k(self, name, lat, lon, k=DEFAULT_K, min_similarity=0.0, max_candidates=None, exclude=None, vector=None):
+        '''
+        Up to k (record_id, similarity) for the names most similar to name
+        (by Soft-TFIDF against tfidf_index) in its cell and the neighboring
+        ones, best first. Only the max_candidates records with the most
+        n-gram overlap (default k * DEFAULT_CANDIDATE_MULTIPLIER) are scored.
+        vector is the normalized vector of name, if the caller has it.
+        '''
+        if max_candidates is None:
+            max_candidates = k * self.DEFAULT_CANDIDATE_MULTIPLIER
+
+        candidates = self.candidates(name, lat, lon, max_candidates=max_candidates, exclude=exclude)
+        if not candidates:
+            return []
+
+        if vector is None:
+            vector = self.name_vector(name)
+        if vector is None:
+            return []
+
+        candidate_vectors = [(record_id, self.record_vector(record_id)) for overlap, record_id in candidates]
+        candidate_vectors = [(record_id, candidate_vector) for record_id, candidate_vector in candidate_vectors if candidate_vector is not None]
+
+        sims = soft_tfidf_similarities([(vector, candidate_vector) for record_id, candidate_vector in candidate_vectors])
+
+        results = [(sim, record_id) for (record_id, candidate_vector), sim in six.moves.zip(candidate_vectors, sims) if sim >= min_similarity]
+        return [(record_id, sim) for sim, record_id in heapq.nlargest(k, results)]
+
+    def top_k_record(self, record_id, k=DEFAULT_K, min_similarity=0.0, max_candidates=None):
+        '''Most similar names to an indexed record, excluding itself'''
+        name, num_ngrams, lat, lon = self.records[record_id]
+        return self.top_k(name, lat, lon, k=k, min_similarity=min_similarity, max_candidates=max_candidates, exclude=(record_id,),
+                          vector=self.record_vector(record_id))
+
+    def top_k_address(self, address, k=DEFAULT_K, min_similarity=0.0, max_candidates=None, exclude=None):
+        name, lat, lon = self.name_and_coordinates(address)
+        return self.top_k(name, lat, lon, k=k, min_similarity=min_similarity, max_candidates=max_candidates, exclude=exclude)
@@ -32,4 +32,19 @@ class GeoJSONLineParser(GeoJSONParser):
             self.f = open(filename)
 
     def next_feature(self):
-        return json.loads(self.f.next().rstrip())
+        return json.loads(next(self.f).rstrip())
+
+
+def open_geojson_file(filename):
+    '''Feature iterator for a file of line-delimited GeoJSON features, or else a GeoJSON FeatureCollection'''
+    try:
+        f = GeoJSONLineParser(filename)
+        feature = f.next_feature()
+        f.f.close()
+    except ValueError:
+        return GeoJSONParser(filename)
+
+    # a FeatureCollection written on one line parses as a single line too
+    if feature.get('type') == 'FeatureCollection':
+        return GeoJSONParser(filename)
+    return GeoJSONLineParser(filename)
@@ -0,0 +1,87 @@
+'''
+Lazy access to the libpostal bindings. Importing a postal module sets up
+libpostal's models, which takes seconds and a lot of memory, so nothing is
+imported until a function is first called or an attribute first read. This
+way, importing lieu (e.g. in a Spark driver, or in a parent process before
+forking workers) doesn't pay for libpostal unless it's used, and load() can
+be called explicitly to pay for it up front.
+'''
+import importlib
+import time
+
+
+class LazyModule(object):
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+        self.load_seconds = None
+
+    def load(self):
+        if self.module is None:
+            start = time.time()
+            self.module = importlib.import_module(self.name)
+            self.load_seconds = time.time() - start
+        return self.module
+
+    @property
+    def loaded(self):
+        return self.module is not None
+
+
+class LazyAttribute(object):
+    '''Stands in for a function or object from a LazyModule until it's used'''
+
+    def __init__(self, module, name):
+        self.module = module
+        self.name = name
+
+    def get(self):
+        return getattr(self.module.load(), self.name)
+
+    def __getattr__(self, attr):
+        # pickle and copy probe for special methods, which shouldn't load libpostal
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return getattr(self.get(), attr)
+
+    def __call__(self, *args, **kw):
+        return self.get()(*args, **kw)
+
+
+near_dupe_module = LazyModule('postal.near_dupe')
+dedupe_module = LazyModule('postal.dedupe')
+normalize_module = LazyModule('postal.normalize')
+tokenize_module = LazyModule('postal.tokenize')
+token_types_module = LazyModule('postal.token_types')
+
+modules = (near_dupe_module, dedupe_module, normalize_module, tokenize_module, token_types_module)
+
+near_dupe_hashes = LazyAttribute(near_dupe_module, 'near_dupe_hashes')
+
+place_languages = LazyAttribute(dedupe_module, 'place_languages')
+duplicate_status = LazyAttribute(dedupe_module, 'duplicate_status')
+is_name_duplicate = LazyAttribute(dedupe_module, 'is_name_duplicate')
+is_street_duplicate = LazyAttribute(dedupe_module, 'is_street_duplicate')
+is_house_number_duplicate = LazyAttribute(dedupe_module, 'is_house_number_duplicate')
+is_po_box_duplicate = LazyAttribute(dedupe_module, 'is_po_box_duplicate')
+is_unit_duplicate = LazyAttribute(dedupe_module, 'is_unit_duplicate')
+is_floor_duplicate = LazyAttribute(dedupe_module, 'is_floor_duplicate')
+is_postal_code_duplicate = LazyAttribute(dedupe_module, 'is_postal_code_duplicate')
+is_toponym_duplicate = LazyAttribute(dedupe_module, 'is_toponym_duplicate')
+is_name_duplicate_fuzzy = LazyAttribute(dedupe_module, 'is_name_duplicate_fuzzy')
+
+normalized_tokens = LazyAttribute(normalize_module, 'normalized_tokens')
+tokenize = LazyAttribute(tokenize_module, 'tokenize')
+token_types = LazyAttribute(token_types_module, 'token_types')
+
+
+def load():
+    '''Import (and so set up) all of the libpostal modules, returns the seconds it took'''
+    start = time.time()
+    for module in modules:
+        module.load()
+    return time.time() - start
+
+
+def is_loaded():
+    return all((module.loaded for module in modules))
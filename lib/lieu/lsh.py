@@ -0,0 +1,98 @@
+import geohash
+import hashlib
+import random
+import six
+import zlib
+
+from lieu.address import AddressComponents, Coordinates
+from lieu.dedupe import Name
+from lieu.encoding import safe_encode
+
+
+class MinHashLSH(object):
+    '''
+    Locality-sensitive hashing of venue names for blocking. A MinHash
+    signature over the character n-grams of the name's content tokens is cut
+    into num_bands bands of rows_per_band rows, and each band is hashed
+    together with a coarse geohash into a block key. Two names with n-gram
+    Jaccard similarity s share at least one key with probability
+    1 - (1 - s ** rows_per_band) ** num_bands, so more rows per band means
+    smaller, stricter blocks and more bands means higher recall.
+
+    Unlike libpostal's near-dupe hashes, typos, reordered tokens and
+    unexpanded abbreviations still share most of their n-grams.
+
+    Keys use the address's own geohash cell only. with_neighbors also
+    emits a key for each of the 8 neighboring cells, which catches pairs
+    on either side of a cell border, but two names in the same cell then
+    share 9 keys per matching band and are compared up to 9 times as often.
+    '''
+    DEFAULT_NUM_BANDS = 20
+    DEFAULT_ROWS_PER_BAND = 5
+    DEFAULT_NGRAM_SIZE = 3
+    DEFAULT_GEOHASH_PRECISION = 5
+
+    MERSENNE_PRIME = (1 << 61) - 1
+    MAX_HASH = (1 << 32) - 1
+
+    key_prefix = u'lsh'
+
+    def __init__(self, num_bands=DEFAULT_NUM_BANDS, rows_per_band=DEFAULT_ROWS_PER_BAND,
+                 ngram_size=DEFAULT_NGRAM_SIZE, geohash_precision=DEFAULT_GEOHASH_PRECISION,
+                 with_neighbors=False, seed=0):
+        self.num_bands = num_bands
+        self.rows_per_band = rows_per_band
+        self.ngram_size = ngram_size
+        self.geohash_precision = geohash_precision
+        self.with_neighbors = with_neighbors
+
+        # hash functions (a * x + b) mod p, seeded so keys agree across processes and runs
+        rand = random.Random(seed)
+        self.coefficients = [(rand.randint(1, self.MERSENNE_PRIME - 1), rand.randint(0, self.MERSENNE_PRIME - 1))
+                             for i in six.moves.xrange(num_bands * rows_per_band)]
+
+    def ngrams(self, name):
+        return Name.ngrams(name, n=self.ngram_size)
+
+    def signature(self, ngrams):
+        if not ngrams:
+            return None
+        # zlib.crc32 rather than hash(), which is randomized per process on Python 3
+        values = [zlib.crc32(safe_encode(ngram)) & self.MAX_HASH for ngram in ngrams]
+        p = self.MERSENNE_PRIME
+        return [min(((a * x + b) % p for x in values)) for a, b in self.coefficients]
+
+    def geohashes(self, address):
+        lat = address.get(Coordinates.LATITUDE)
+        lon = address.get(Coordinates.LONGITUDE)
+        if lat is None or lon is None:
+            return []
+
+        gh = geohash.encode(lat, lon, precision=self.geohash_precision)
+        if not self.with_neighbors:
+            return [gh]
+        return [gh] + geohash.neighbors(gh)
+
+    def band_digests(self, signature):
+        rows = self.rows_per_band
+        for band in six.moves.xrange(self.num_bands):
+            values = signature[band * rows:(band + 1) * rows]
+            yield band, hashlib.md5(safe_encode(u','.join((six.text_type(v) for v in values)))).hexdigest()[:16]
+
+    def hashes(self, address):
+        '''Block keys for an address, none without a name or coordinates'''
+        name = address.get(AddressComponents.NAME)
+        if not name:
+            return []
+
+        geohashes = self.geohashes(address)
+        if not geohashes:
+            return []
+
+        signature = self.signature(self.ngrams(name))
+        if signature is None:
+            return []
+
+        return [u'|'.join((self.key_prefix, six.text_type(band), gh, digest))
+                for band, digest in self.band_digests(signature)
+                for gh in geohashes]
@@ -0,0 +1,215 @@
+import heapq
+import struct
+import tempfile
+
+from array import array
+from six import itertools, operator
+
+from lieu.api import DedupeResponse
+
+
+class IdSet(object):
+    '''Set of non-negative integer ids as a bitmap, one bit per id'''
+
+    def __init__(self):
+        self.bits = bytearray()
+        self.size = 0
+
+    def add(self, record_id):
+        i, bit = divmod(record_id, 8)
+        if i >= len(self.bits):
+            self.bits.extend(bytearray(max(i + 1 - len(self.bits), len(self.bits))))
+        if not self.bits[i] & (1 << bit):
+            self.bits[i] |= 1 << bit
+            self.size += 1
+
+    def __contains__(self, record_id):
+        i, bit = divmod(record_id, 8)
+        return i < len(self.bits) and bool(self.bits[i] & (1 << bit))
+
+    def __len__(self):
+        return self.size
+
+
+class PairStore(object):
+    '''
+    Dupe pairs for the command-line script, keyed by integer record ids
+    (the order records were read in) instead of guids. Each pair is kept
+    in typed arrays as (record_id, canonical_id, classification code,
+    similarity), 25 bytes per pair rather than a tuple of Python objects in
+    a set. If memory_limit (in bytes) is set, the arrays are sorted and
+    spilled to a temporary binary run file whenever they pass it.
+
+    Pairs are read back grouped by record id, in id order, by merging the
+    runs, so the output stage can walk the records in the same order.
+    '''
+    classifications = (DedupeResponse.classifications.EXACT_DUPE,
+                       DedupeResponse.classifications.LIKELY_DUPE,
+                       DedupeResponse.classifications.NEEDS_REVIEW)
+    classification_codes = {c: i for i, c in enumerate(classifications)}
+
+    record = struct.Struct('<qqBd')
+    RECORDS_PER_READ = 4096
+    # pairs sorted at a time before the sorted chunks are merged
+    SORT_CHUNK_SIZE = 16384
+
+    def __init__(self, memory_limit=None, temp_dir=None):
+        self.memory_limit = memory_limit
+        self.temp_dir = temp_dir
+
+        self.record_ids = array('q')
+        self.canonical_ids = array('q')
+        self.codes = array('B')
+        self.sims = array('d')
+
+        self.runs = []
+        self.num_pairs = 0
+        self.dupes = IdSet()
+
+    def __len__(self):
+        return self.num_pairs
+
+    def add(self, record_id, canonical_id, classification, sim):
+        self.record_ids.append(record_id)
+        self.canonical_ids.append(canonical_id)
+        self.codes.append(self.classification_codes[classification])
+        self.sims.append(sim if sim is not None else float('nan'))
+        self.num_pairs += 1
+
+        if classification in DedupeResponse.dupe_classifications:
+            self.dupes.add(record_id)
+
+        if self.memory_limit is not None and len(self.record_ids) * self.record.size >= self.memory_limit:
+            self.spill()
+
+    def sorted_order(self):
+        '''
+        Buffer indices by (record_id, canonical_id), ties in the order the
+        pairs were added. Sorting the whole buffer at once would build a key
+        tuple per pair, several times the size of the arrays, so chunks of
+        SORT_CHUNK_SIZE pairs are sorted separately into one index array
+        (8 bytes per pair) and merged lazily.
+        '''
+        record_ids = self.record_ids
+        canonical_ids = self.canonical_ids
+        n = len(record_ids)
+        chunk_size = self.SORT_CHUNK_SIZE
+        starts = range(0, n, chunk_size)
+
+        order = array('q')
+        for start in starts:
+            order.extend(sorted(range(start, min(start + chunk_size, n)), key=lambda i: (record_ids[i], canonical_ids[i])))
+
+        def sorted_chunk(start):
+            for j in range(start, min(start + chunk_size, n)):
+                i = order[j]
+                yield record_ids[i], canonical_ids[i], i
+
+        for record_id, canonical_id, i in heapq.merge(*[sorted_chunk(start) for start in starts]):
+            yield i
+
+    def sorted_buffer(self):
+        for i in self.sorted_order():
+            yield self.record_ids[i], self.canonical_ids[i], self.codes[i], self.sims[i]
+
+    def clear_buffer(self):
+        self.record_ids = array('q')
+        self.canonical_ids = array('q')
+        self.codes = array('B')
+        self.sims = array('d')
+
+    def spill(self):
+        f = tempfile.TemporaryFile(mode='w+b', dir=self.temp_dir)
+        pack = self.record.pack
+        for values in self.sorted_buffer():
+            f.write(pack(*values))
+        f.flush()
+        self.runs.append(f)
+        self.clear_buffer()
+
+    @classmethod
+    def read_run(cls, f):
+        f.seek(0)
+        size = cls.record.size
+        unpack_from = cls.record.unpack_from
+        while True:
+            buf = f.read(size * cls.RECORDS_PER_READ)
+            if not buf:
+                break
+            for offset in range(0, len(buf), size):
+                yield unpack_from(buf, offset)
+
+    def groups(self):
+        '''
+        (record_id, [(canonical_id, classification, sim)]) in record id
+        order, with repeats of a pair (found in several blocks) dropped
+        '''
+        entries = heapq.merge(self.sorted_buffer(), *[self.read_run(f) for f in self.runs])
+
+        for record_id, group in itertools.groupby(entries, key=operator.itemgetter(0)):
+            pairs = []
+            last_canonical_id = None
+            for _, canonical_id, code, sim in group:
+                if canonical_id == last_canonical_id:
+                    continue
+                last_canonical_id = canonical_id
+                pairs.append((canonical_id, self.classifications[code], sim if sim == sim else None))
+            yield record_id, pairs
+
+    def join(self, records):
+        '''
+        For (record_id, value) in increasing record_id order, yields
+        (record_id, value, pairs), with an empty list for unpaired records
+        '''
+        groups = self.groups()
+        group = next(groups, None)
+        for record_id, value in records:
+            while group is not None and group[0] < record_id:
+                group = next(groups, None)
+            if group is not None and group[0] == record_id:
+                yield record_id, value, group[1]
+            else:
+                yield record_id, value, []
+
+    def close(self):
+        for f in self.runs:
+            f.close()
+        self.runs = []
+        self.clear_buffer()
+
+
+class ScoredPairs(object):
+    '''
+    Append-only file of scored pairs, one fixed-size binary record of
+    (other_id, canonical_id, name status code, fuzzy name status code, name
+    similarity) each, as written by the compare stage before any thresholds
+    are applied (see VenueDeduper.score_pair). Reading them back and
+    classifying them under new thresholds is much faster than comparing the
+    records again.
+    '''
+    record = struct.Struct('<qqbbd')
+    RECORDS_PER_READ = 4096
+
+    def __init__(self, f):
+        self.f = f
+        self.num_pairs = 0
+
+    def write(self, other_id, canonical_id, status_code, fuzzy_status_code, sim):
+        self.f.write(self.record.pack(other_id, canonical_id, status_code, fuzzy_status_code, sim if sim is not None else float('nan')))
+        self.num_pairs += 1
+
+    def close(self):
+        self.f.close()
+
+    @classmethod
+    def read(cls, f):
+        '''Yields (other_id, canonical_id, status_code, fuzzy_status_code, sim), sim is None if there wasn't one'''
+        size = cls.record.size
+        unpack_from = cls.record.unpack_from
+        while True:
+            buf = f.read(size * cls.RECORDS_PER_READ)
+            if not buf:
+                break
+            for offset in range(0, len(buf), size):
+                other_id, canonical_id, status_code, fuzzy_status_code, sim = unpack_from(buf, offset)
+                yield other_id, canonical_id, status_code, fuzzy_status_code, sim if sim == sim else None
@@ -0,0 +1,433 @@
+import heapq
+import tempfile
+
+from collections import Counter, defaultdict
+from six import itertools, operator
+
+from lieu.address import Address, AddressComponents
+from lieu.api import DedupeResponse
+from lieu.contact import Contact
+from lieu.dedupe import AddressDeduper, VenueDeduper, Name
+from lieu.encoding import safe_encode, safe_decode
+from lieu.index import NameIndex
+from lieu.tfidf import TFIDF, CountMinTFIDF
+from lieu.workers import ForkWorkerPool
+
+
+class HashBlocks(object):
+    '''
+    (hash, guid) entries grouped into blocks by hash, with each block in
+    insertion order. This is the same grouping the command-line script gets
+    from sort. If memory_limit (in bytes, roughly) is set, the buffered
+    entries are sorted and spilled to a temporary run file whenever they
+    pass it. The runs are merged back when the blocks are read.
+    '''
+    ENTRY_OVERHEAD = 64
+
+    def __init__(self, memory_limit=None, temp_dir=None):
+        self.memory_limit = memory_limit
+        self.temp_dir = temp_dir
+        self.entries = []
+        self.entries_bytes = 0
+        self.runs = []
+        self.num_entries = 0
+
+    def add(self, key, guid):
+        self.entries.append((key, self.num_entries, guid))
+        self.num_entries += 1
+
+        if self.memory_limit is not None:
+            self.entries_bytes += len(key) + len(guid) + self.ENTRY_OVERHEAD
+            if self.entries_bytes >= self.memory_limit:
+                self.spill()
+
+    def spill(self):
+        self.entries.sort()
+        f = tempfile.TemporaryFile(mode='w+b', dir=self.temp_dir)
+        for key, i, guid in self.entries:
+            f.write(safe_encode(u'{}\t{}\t{}\n'.format(safe_decode(key), i, safe_decode(guid))))
+        f.flush()
+        self.runs.append(f)
+        self.entries = []
+        self.entries_bytes = 0
+
+    @classmethod
+    def read_run(cls, f):
+        f.seek(0)
+        for line in f:
+            key, i, guid = safe_decode(line).rstrip(u'\n').split(u'\t')
+            yield key, int(i), guid
+
+    def __iter__(self):
+        self.entries.sort()
+        if self.runs:
+            entries = heapq.merge(iter(self.entries), *[self.read_run(f) for f in self.runs])
+        else:
+            entries = iter(self.entries)
+
+        for key, group in itertools.groupby(entries, key=operator.itemgetter(0)):
+            yield key, [guid for k, i, guid in group]
+
+    def close(self):
+        for f in self.runs:
+            f.close()
+        self.runs = []
+        self.entries = []
+
+
+worker_state = None
+
+
+def init_worker(pipeline, addresses, tfidf_index):
+    global worker_state
+    worker_state = (pipeline, addresses, tfidf_index)
+
+
+def compare_block_worker(candidates):
+    pipeline, addresses, tfidf_index = worker_state
+    return list(pipeline.compare_block(candidates, addresses, tfidf_index))
+
+
+class DedupePipeline(object):
+    '''
+    In-memory version of the command-line script: takes an iterable of
+    GeoJSON features and yields a DedupeResponse dict per feature (or per
+    dupe with dupes_only). The command-line script uses the same indexing,
+    block comparison and response code, so the results are the same.
+
+    lsh (a MinHashLSH) adds name-based block keys for venues, or replaces
+    libpostal's near-dupe hashes with lsh_only.
+
+    With top_k, venues with coordinates aren't blocked by hash at all: each
+    one is only compared to its top_k most similar names in a NameIndex
+    (geohash cells at top_k_precision plus neighbors). Venues without
+    coordinates are still blocked by hash, among themselves. Contact keys
+    (below) are kept either way.
+
+    With exact_signatures, records with the same exact_signature as an
+    earlier record (see AddressDeduper.exact_signature) are marked as its
+    exact dupes up front and left out of the blocks, so each group of
+    copies is only compared once, through its first record.
+
+    With contact_keys, venues also get a block key for each normalized phone
+    number and website domain (with the geohash at contact_precision), so
+    venues whose names diverge can still be compared. With
+    contact_signals, phone numbers and websites adjust the name comparison of
+    pairs at the same address (see VenueDeduper.score_pair).
+
+    With idf_memory_limit (in bytes), document frequencies are counted in a
+    fixed-size count-min sketch (see CountMinTFIDF).
+
+    With num_workers > 1 the blocks are compared in a ForkWorkerPool, which
+    loads libpostal once and forks the workers after the addresses and
+    TF-IDF index are built, so they're shared copy-on-write. Each worker's
+    startup time and memory are left in worker_stats.
+    memory_limit bounds the hash entries held in memory (see HashBlocks).
+    The features themselves are always held in memory.
+    '''
+
+    def __init__(self, address_only=False, with_unit=False, dupes_only=False,
+                 name_dupe_threshold=DedupeResponse.default_name_dupe_threshold,
+                 name_review_threshold=DedupeResponse.default_name_review_threshold,
+                 use_latlon=True, use_city=False, use_small_containing=False, use_postal_code=False,
+                 geohash_precision=AddressDeduper.DEFAULT_GEOHASH_PRECISION, lsh=None, lsh_only=False, top_k=None, top_k_precision=NameIndex.DEFAULT_GEOHASH_PRECISION,
+                 exact_signatures=False, signature_precision=AddressDeduper.DEFAULT_SIGNATURE_COORDINATE_PRECISION,
+                 idf_memory_limit=None, idf_min_count=CountMinTFIDF.DEFAULT_MIN_COUNT,
+                 contact_keys=False, contact_signals=False, contact_precision=Contact.DEFAULT_GEOHASH_PRECISION,
+                 num_workers=1, memory_limit=None, temp_dir=None):
+        self.address_only = address_only
+        self.with_unit = with_unit
+        self.dupes_only = dupes_only
+        self.name_dupe_threshold = name_dupe_threshold
+        self.name_review_threshold = name_review_threshold
+        self.use_latlon = use_latlon
+        self.use_city = use_city
+        self.use_small_containing = use_small_containing
+        self.use_postal_code = use_postal_code
+        self.geohash_precision = geohash_precision
+        self.lsh = lsh
+        self.lsh_only = lsh_only
+        self.top_k = top_k
+        self.top_k_precision = top_k_precision
+        self.exact_signatures = exact_signatures
+        self.signature_precision = signature_precision
+        self.idf_memory_limit = idf_memory_limit
+        self.idf_min_count = idf_min_count
+        self.contact_keys = contact_keys
+        self.contact_signals = contact_signals
+        self.contact_precision = contact_precision
+        self.num_workers = num_workers
+        self.memory_limit = memory_limit
+        self.temp_dir = temp_dir
+
+        self.num_features = 0
+        self.num_comparisons = 0
+        self.num_dupes = 0
+        self.num_exact_dupes = 0
+        self.worker_stats = []
+
+    def explain(self):
+        if not self.address_only:
+            return DedupeResponse.explain_venue_dupe(name_likely_dupe_threshold=self.name_dupe_threshold,
+                                                     name_needs_review_threshold=self.name_review_threshold,
+                                                     with_unit=self.with_unit)
+        return DedupeResponse.explain_address_dupe(with_unit=self.with_unit)
+
+    def new_tfidf_index(self):
+        '''Empty TF-IDF index for venue names, None in address-only mode'''
+        if self.address_only:
+            return None
+        if self.idf_memory_limit is not None:
+            return CountMinTFIDF.from_memory(self.idf_memory_limit, min_count=self.idf_min_count)
+        return TFIDF()
+
+    def index_name(self, address, tfidf_index=None):
+        '''Adds a venue's name to the TF-IDF index, False if it has none'''
+        name = address.get(AddressComponents.NAME)
+        if not name:
+            return False
+        if tfidf_index is not None:
+            tfidf_index.update(Counter(Name.content_tokens(name)))
+        return True
+
+    def index_address(self, address, tfidf_index=None):
+        '''
+        Near-dupe hashes for an address, adding its name to the TF-IDF index
+        in venue mode. Returns None for venues without a name, which are
+        output as non-dupes without being compared.
+        '''
+        if not self.address_only:
+            if not self.index_name(address, tfidf_index):
+                return None
+
+            hashes = []
+            if not (self.lsh is not None and self.lsh_only):
+                hashes.extend(VenueDeduper.near_dupe_hashes(address, with_latlon=self.use_latlon, with_city_or_equivalent=self.use_city,
+                                                            with_small_containing_boundaries=self.use_small_containing, with_postal_code=self.use_postal_code,
+                                                            geohash_precision=self.geohash_precision))
+            if self.lsh is not None:
+                hashes.extend(self.lsh.hashes(address))
+            hashes.extend(self.contact_hashes(address))
+            return hashes
+
+        return AddressDeduper.near_dupe_hashes(address, with_latlon=self.use_latlon, with_city_or_equivalent=self.use_city,
+                                               with_small_containing_boundaries=self.use_small_containing, with_postal_code=self.use_postal_code,
+                                               geohash_precision=self.geohash_precision)
+
+    def contact_hashes(self, address):
+        '''Phone/website block keys of a venue with contact_keys, also used for venues blocked by top_k'''
+        if not self.contact_keys or self.address_only:
+            return []
+        return Contact.hashes(address, geohash_precision=self.contact_precision)
+
+    def exact_signature(self, address):
+        if not self.exact_signatures:
+            return None
+        deduper = AddressDeduper if self.address_only else VenueDeduper
+        return deduper.exact_signature(address, coordinate_precision=self.signature_precision)
+
+    def signature_dupe(self, address, signatures, tfidf_index=None):
+        '''
+        Checks a record against signatures (signature => first record), returning
+        (signature, representative) where representative is the earlier record
+        it's an exact dupe of, if any. Names of exact dupes still go into the
+        TF-IDF index so document frequencies are the same either way.
+        '''
+        signature = self.exact_signature(address)
+        if signature is None:
+            return None, None
+
+        representative = signatures.get(signature)
+        if representative is not None:
+            if not self.address_only:
+                self.index_name(address, tfidf_index)
+            self.num_exact_dupes += 1
+        return signature, representative
+
+    def add_exact_dupes(self, exact_dupes, dupe_pairs, dupes):
+        for guid, representative in exact_dupes:
+            dupe_pairs[guid].add((representative, DedupeResponse.classifications.EXACT_DUPE, 1.0))
+            dupes.add(guid)
+        self.num_dupes = len(dupes)
+
+    def name_index(self, tfidf_index=None):
+        '''Empty NameIndex for top_k candidate generation, None if not used'''
+        if not self.top_k or self.address_only:
+            return None
+        return NameIndex(tfidf_index, geohash_precision=self.top_k_precision)
+
+    def name_index_blocks(self, name_index, guids):
+        '''
+        (None, [canonical_guid, other_guid]) blocks pairing each indexed guid
+        with its top_k most similar names, the guid earlier in guids being the
+        canonical as with hash blocks. Each pair is only generated once.
+        '''
+        positions = {guid: i for i, guid in enumerate(guids)}
+        pairs = set()
+        for guid in guids:
+            if guid not in name_index:
+                continue
+            for other_guid, sim in name_index.top_k_record(guid, k=self.top_k):
+                pair = (guid, other_guid) if positions[guid] < positions[other_guid] else (other_guid, guid)
+                if pair not in pairs:
+                    pairs.add(pair)
+                    yield None, list(pair)
+
+    def score_block(self, candidates, addresses, tfidf_index=None):
+        '''
+        Score every pair of guids in a block (the earlier one is the
+        canonical), yielding (other_guid, canonical_guid, name_status,
+        name_fuzzy_status, name_sim)
+        for the pairs that pass the threshold-independent checks (see
+        VenueDeduper.score_pair). addresses is any mapping of guid to address.
+        '''
+        deduper = AddressDeduper if self.address_only else VenueDeduper
+        candidate_addresses = [(guid, addresses[guid]) for guid in candidates]
+
+        for ((canonical_guid, canonical), (other_guid, other)) in itertools.combinations(candidate_addresses, 2):
+            score = deduper.score_pair(canonical, other, tfidf=tfidf_index, with_unit=self.with_unit, contact_signals=self.contact_signals)
+            if score is not None:
+                name_status, name_fuzzy_status, name_sim = score
+                yield other_guid, canonical_guid, name_status, name_fuzzy_status, name_sim
+
+    def classify_pair(self, name_status, name_fuzzy_status, name_sim):
+        return VenueDeduper.classify(name_status, name_fuzzy_status, name_sim, likely_dupe_threshold=self.name_dupe_threshold,
+                                     needs_review_threshold=self.name_review_threshold)
+
+    def compare_block(self, candidates, addresses, tfidf_index=None):
+        '''
+        Compare every pair of guids in a block (the earlier one is the
+        canonical), yielding (other_guid, canonical_guid, dupe_class, sim).
+        addresses is any mapping of guid to address.
+        '''
+        for other_guid, canonical_guid, name_status, name_fuzzy_status, name_sim in self.score_block(candidates, addresses, tfidf_index):
+            dupe_class, sim = self.classify_pair(name_status, name_fuzzy_status, name_sim)
+            if dupe_class is not None:
+                yield other_guid, canonical_guid, dupe_class, sim
+
+    def compare_blocks(self, blocks, addresses, tfidf_index=None):
+        '''Compare all blocks with 2+ candidates, returning (dupe_pairs, dupes)'''
+        dupe_pairs = defaultdict(set)
+        dupes = set()
+
+        blocks = (candidates for key, candidates in blocks if len(candidates) > 1)
+
+        if self.num_workers > 1:
+            pool = ForkWorkerPool(self.num_workers, initializer=init_worker, initargs=(self, addresses, tfidf_index))
+            results = pool.imap_unordered(compare_block_worker, self.counted_blocks(blocks), chunksize=16)
+        else:
+            pool = None
+            results = (self.compare_block(candidates, addresses, tfidf_index) for candidates in self.counted_blocks(blocks))
+
+        try:
+            for pairs in results:
+                for other_guid, canonical_guid, dupe_class, sim in pairs:
+                    dupe_pairs[other_guid].add((canonical_guid, dupe_class, sim))
+                    if dupe_class in DedupeResponse.dupe_classifications:
+                        dupes.add(other_guid)
+        finally:
+            if pool is not None:
+                self.worker_stats = pool.worker_stats(timeout=1)
+                pool.close()
+
+        self.num_dupes = len(dupes)
+        return dupe_pairs, dupes
+
+    def counted_blocks(self, blocks):
+        for candidates in blocks:
+            num_candidates = len(candidates)
+            self.num_comparisons += num_candidates * (num_candidates - 1) // 2
+            yield candidates
+
+    def response(self, guid, value, dupe_pairs, dupes, get_value, explain=None):
+        '''
+        Response for one feature, get_value(guid) returns the (parsed)
+        feature for each of the other guids it's paired with
+        '''
+        is_dupe = any((classification in DedupeResponse.dupe_classifications for other_guid, classification, sim in dupe_pairs.get(guid, ())))
+        if not is_dupe:
+            DedupeResponse.add_guid(value, guid)
+        response = DedupeResponse.base_response(value, is_dupe)
+
+        for other_guid, classification, sim in dupe_pairs.get(guid, ()):
+            other_value = get_value(other_guid)
+
+            is_canonical = other_guid not in dupes
+
+            if is_canonical:
+                DedupeResponse.add_guid(other_value, other_guid)
+            DedupeResponse.add_possible_dupe(response, value=other_value, classification=classification, is_canonical=is_canonical, similarity=sim, explain=explain)
+
+        if 'possibly_same_as' in response:
+            response['possibly_same_as'].sort(key=operator.itemgetter('similarity'), reverse=True)
+        return response
+
+    def raw_response(self, guid, raw_value, dupe_pairs, dupes, get_raw_value, raw_explain=None):
+        '''
+        Like response, but from the features' stored JSON (with guids already
+        added), returning the response as JSON bytes without parsing them
+        '''
+        pairs = dupe_pairs.get(guid, ())
+        is_dupe = any((classification in DedupeResponse.dupe_classifications for other_guid, classification, sim in pairs))
+        same_as = [(get_raw_value(other_guid), classification, other_guid not in dupes, sim) for other_guid, classification, sim in pairs]
+        return DedupeResponse.raw_response(raw_value, is_dupe=is_dupe, same_as=same_as, raw_explain=raw_explain)
+
+    def dedupe(self, features):
+        '''Generator of DedupeResponse dicts, in input order'''
+        tfidf_index = self.new_tfidf_index()
+        blocks = HashBlocks(memory_limit=self.memory_limit, temp_dir=self.temp_dir)
+        name_index = self.name_index(tfidf_index)
+        indexed_guids = []
+        signatures = {}
+        exact_dupes = []
+
+        guids = []
+        values = {}
+        addresses = {}
+
+        for feature in features:
+            DedupeResponse.add_random_guid(feature)
+            guid = feature['properties'][DedupeResponse.guid_key]
+            guids.append(guid)
+            values[guid] = feature
+
+            address = Address.from_geojson(feature)
+            signature, representative = self.signature_dupe(address, signatures, tfidf_index)
+            if representative is not None:
+                exact_dupes.append((guid, representative))
+                continue
+
+            hashes = self.index_address(address, tfidf_index)
+            if hashes is None:
+                continue
+
+            if signature is not None:
+                signatures[signature] = guid
+
+            addresses[guid] = address
+            self.num_features += 1
+
+            if name_index is not None and name_index.add_address(guid, address):
+                indexed_guids.append(guid)
+                hashes = self.contact_hashes(address)
+
+            for h in hashes:
+                blocks.add(h, guid)
+
+        all_blocks = blocks
+        if name_index is not None:
+            all_blocks = itertools.chain(blocks, self.name_index_blocks(name_index, indexed_guids))
+
+        try:
+            dupe_pairs, dupes = self.compare_blocks(all_blocks, addresses, tfidf_index)
+        finally:
+            blocks.close()
+
+        self.add_exact_dupes(exact_dupes, dupe_pairs, dupes)
+
+        explain = self.explain()
+
+        for guid in guids:
+            if self.dupes_only and guid not in dupe_pairs:
+                continue
+            yield self.response(guid, values[guid], dupe_pairs, dupes, values.get, explain=explain)
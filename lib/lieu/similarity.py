@@ -59,6 +59,27 @@ def soft_tfidf_similarity(token_scores1, token_scores2,
     return total_sim
 
 
+def soft_tfidf_similarities(token_scores_pairs, sim_func=Levenshtein.jaro_winkler,
+                            theta=0.95):
+    '''
+    Soft TFIDF similarity for each (token_scores1, token_scores2) in a batch.
+
+    The same token pairs recur across the pairs in a batch (e.g. all the
+    candidates in a block), so the token-level sim_func is memoized for
+    the duration of the batch.
+    '''
+    token_sims = {}
+
+    def batch_sim_func(t1, t2):
+        sim = token_sims.get((t1, t2))
+        if sim is None:
+            sim = token_sims[(t1, t2)] = sim_func(t1, t2)
+        return sim
+
+    return [soft_tfidf_similarity(token_scores1, token_scores2, sim_func=batch_sim_func, theta=theta)
+            for token_scores1, token_scores2 in token_scores_pairs]
+
+
 def jaccard_similarity(tokens1, tokens2):
     '''
     Traditionally Jaccard similarity is defined for two sets:
@@ -0,0 +1,82 @@
+import math
+import random
+import six
+import zlib
+
+from array import array
+
+from lieu.encoding import safe_encode
+
+
+class CountMinSketch(object):
+    '''
+    Count-min sketch: depth rows of width counters, each key incremented in
+    one counter per row and estimated as the minimum over its counters.
+    Estimates never undercount. With width = ceil(e / epsilon) and
+    depth = ceil(ln(1 / delta)), an estimate overcounts by more than
+    epsilon * total (the sum of all increments) with probability at most
+    delta. Updates are conservative (only the counters at the current
+    minimum are raised), which tightens the estimates in practice without
+    changing the bound.
+
+    Memory is fixed at width * depth 32-bit counters, whatever the number of
+    distinct keys.
+    '''
+    DEFAULT_DEPTH = 4
+
+    MERSENNE_PRIME = (1 << 61) - 1
+    MAX_COUNT = (1 << 32) - 1
+
+    def __init__(self, width, depth=DEFAULT_DEPTH, seed=0):
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self.counts = array('I', [0]) * (width * depth)
+
+        # row hashes (a * x + b) mod p over crc32, stable across processes like the LSH keys
+        rand = random.Random(seed)
+        self.coefficients = [(rand.randint(1, self.MERSENNE_PRIME - 1), rand.randint(0, self.MERSENNE_PRIME - 1))
+                             for i in six.moves.xrange(depth)]
+
+    @classmethod
+    def from_error(cls, epsilon, delta, seed=0):
+        return cls(int(math.ceil(math.e / epsilon)), depth=int(math.ceil(math.log(1.0 / delta))), seed=seed)
+
+    @classmethod
+    def from_memory(cls, memory_limit, depth=DEFAULT_DEPTH, seed=0):
+        '''Sketch using about memory_limit bytes'''
+        width = max(1, memory_limit // (depth * array('I').itemsize))
+        return cls(width, depth=depth, seed=seed)
+
+    @property
+    def epsilon(self):
+        return math.e / self.width
+
+    @property
+    def delta(self):
+        return math.exp(-self.depth)
+
+    def error_bound(self):
+        '''Overcount exceeded with probability at most delta, given the updates so far'''
+        return self.epsilon * self.total
+
+    def indices(self, key):
+        x = zlib.crc32(safe_encode(key)) & 0xffffffff
+        p = self.MERSENNE_PRIME
+        width = self.width
+        return [row * width + ((a * x + b) % p) % width for row, (a, b) in enumerate(self.coefficients)]
+
+    def add(self, key, count=1):
+        '''Increment key, returns its new estimate'''
+        indices = self.indices(key)
+        counts = self.counts
+        estimate = min(self.MAX_COUNT, min((counts[i] for i in indices)) + count)
+        for i in indices:
+            if counts[i] < estimate:
+                counts[i] = estimate
+        self.total += count
+        return estimate
+
+    def estimate(self, key):
+        counts = self.counts
+        return min((counts[i] for i in self.indices(key)))
@@ -0,0 +1,153 @@
+import six
+
+from pyspark.sql import functions as F
+from pyspark.sql.types import StructType, StructField, LongType, StringType, DoubleType, BooleanType, ArrayType
+
+from lieu.api import DedupeResponse
+from lieu.dedupe import VenueDeduper
+
+from lieu.spark.dedupe import AddressDeduperSpark, VenueDeduperSpark
+from lieu.spark.tfidf import spark_session
+from lieu.spark.utils import IDPairRDD, RDDPersistence
+
+
+class VenueDeduperSparkDF(object):
+    '''
+    DataFrame variant of VenueDeduperSpark.dupe_sims. Blocking and the TF-IDF
+    model are shared with the RDD version, but the candidate pairs are scored
+    in Arrow batches by pandas UDFs instead of one Python call per pair.
+    '''
+    vector_schema = StructType([
+        StructField('uid', LongType(), False),
+        StructField('name', StringType(), True),
+        StructField('words', ArrayType(StringType()), True),
+        StructField('scores', ArrayType(DoubleType()), True),
+        StructField('geo_words', ArrayType(StringType()), True),
+        StructField('geo_scores', ArrayType(DoubleType()), True),
+    ])
+
+    pair_schema = StructType([
+        StructField('uid1', LongType(), False),
+        StructField('uid2', LongType(), False),
+    ])
+
+    vector_columns = ('name', 'words', 'scores', 'geo_words', 'geo_scores')
+
+    @classmethod
+    def vector_row(cls, uid, name, tfidfs):
+        if tfidfs is None:
+            return (uid, name, None, None, None, None)
+
+        tfidf, geo_tfidf = tfidfs
+        words, scores = list(tfidf.keys()), list(tfidf.values())
+        if geo_tfidf is None:
+            return (uid, name, words, scores, None, None)
+        return (uid, name, words, scores, list(geo_tfidf.keys()), list(geo_tfidf.values()))
+
+    @classmethod
+    def vectors_frame(cls, spark, id_names, name_tfidfs):
+        vectors = id_names.leftOuterJoin(name_tfidfs) \
+                          .map(lambda uid_name_tfidfs: cls.vector_row(uid_name_tfidfs[0], uid_name_tfidfs[1][0], uid_name_tfidfs[1][1]))
+        return spark.createDataFrame(vectors, cls.vector_schema)
+
+    @classmethod
+    def frame_tfidfs(cls, words, scores, geo_words, geo_scores):
+        if words is None:
+            return None
+        geo_tfidf = dict(six.moves.zip(geo_words, geo_scores)) if geo_words is not None else None
+        return (dict(six.moves.zip(words, scores)), geo_tfidf)
+
+    @classmethod
+    def exact_name_dupes(cls, names1, names2):
+        import pandas as pd
+        return pd.Series([VenueDeduper.is_exact_name_dupe(name1 or '', name2 or '') for name1, name2 in six.moves.zip(names1, names2)])
+
+    @classmethod
+    def similarities(cls, words1, scores1, geo_words1, geo_scores1, words2, scores2, geo_words2, geo_scores2,
+                     geo_model_proportion=VenueDeduperSpark.DEFAULT_GEO_MODEL_PROPORTION):
+        '''Name similarity for a batch of pairs, null where either side has no vector'''
+        import pandas as pd
+
+        tfidfs = [(cls.frame_tfidfs(*side1), cls.frame_tfidfs(*side2))
+                  for side1, side2 in six.moves.zip(six.moves.zip(words1, scores1, geo_words1, geo_scores1),
+                                                    six.moves.zip(words2, scores2, geo_words2, geo_scores2))]
+
+        indices = [i for i, (tfidfs1, tfidfs2) in enumerate(tfidfs) if tfidfs1 is not None and tfidfs2 is not None]
+        sims = [None] * len(tfidfs)
+        for i, sim in six.moves.zip(indices, VenueDeduperSpark.pair_similarities([tfidfs[i] for i in indices], geo_model_proportion=geo_model_proportion)):
+            sims[i] = sim
+
+        return pd.Series(sims, dtype=float)
+
+    @classmethod
+    def score_pairs(cls, pairs, vectors, name_dupe_threshold=DedupeResponse.default_name_dupe_threshold,
+                    name_review_threshold=DedupeResponse.default_name_review_threshold,
+                    geo_model_proportion=VenueDeduperSpark.DEFAULT_GEO_MODEL_PROPORTION, broadcast_vectors=False):
+        '''
+        Join both sides' vectors onto (uid1, uid2) and classify each pair,
+        returning a DataFrame of (uid1, uid2, classification, similarity).
+        '''
+        from pyspark.sql.functions import pandas_udf
+
+        exact_name_dupe = pandas_udf(cls.exact_name_dupes, BooleanType())
+        similarity = pandas_udf(lambda *cols: cls.similarities(*cols, geo_model_proportion=geo_model_proportion), DoubleType())
+
+        if broadcast_vectors:
+            vectors = F.broadcast(vectors)
+
+        side1 = vectors.select(F.col('uid').alias('uid1'), *[F.col(c).alias(c + '1') for c in cls.vector_columns])
+        side2 = vectors.select(F.col('uid').alias('uid2'), *[F.col(c).alias(c + '2') for c in cls.vector_columns])
+
+        scored = pairs.join(side1, 'uid1') \
+                      .join(side2, 'uid2') \
+                      .select('uid1', 'uid2',
+                              exact_name_dupe('name1', 'name2').alias('exact'),
+                              similarity('words1', 'scores1', 'geo_words1', 'geo_scores1',
+                                         'words2', 'scores2', 'geo_words2', 'geo_scores2').alias('sim'))
+
+        classification = F.when(F.col('exact'), F.lit(DedupeResponse.classifications.EXACT_DUPE)) \
+                          .when(F.col('sim') >= name_dupe_threshold, F.lit(DedupeResponse.classifications.LIKELY_DUPE)) \
+                          .when(F.col('sim') >= name_review_threshold, F.lit(DedupeResponse.classifications.NEEDS_REVIEW))
+
+        return scored.select('uid1', 'uid2',
+                             classification.alias('classification'),
+                             F.when(F.col('exact'), F.lit(1.0)).otherwise(F.col('sim')).alias('similarity')) \
+                     .filter(F.col('classification').isNotNull())
+
+    @classmethod
+    def dupe_sims(cls, address_ids, geo_model=True, name_dupe_threshold=DedupeResponse.default_name_dupe_threshold,
+                  name_review_threshold=DedupeResponse.default_name_review_threshold,
+                  geo_model_proportion=VenueDeduperSpark.DEFAULT_GEO_MODEL_PROPORTION,
+                  use_latlon=True, use_city=False, use_postal_code=False, max_block_size=AddressDeduperSpark.DEFAULT_MAX_BLOCK_SIZE,
+                  join_strategy=None, model=None, update_doc_frequencies=True, adaptive_geo_cells=False, persistence=None):
+        '''
+        Same ((uid1, uid2), (classification, similarity)) output as
+        VenueDeduperSpark.dupe_sims. Only the broadcast/co-partition join
+        strategies apply here, the join itself is left to Spark SQL.
+        '''
+        if persistence is None:
+            persistence = RDDPersistence()
+
+        spark = spark_session(address_ids.context)
+
+        model = VenueDeduperSpark.doc_frequency_model(address_ids, geo_model=geo_model, model=model, update=update_doc_frequencies,
+                                                      adaptive_geo_cells=adaptive_geo_cells)
+
+        name_tfidfs = persistence.persist(VenueDeduperSpark.name_tfidfs(address_ids, model, geo_model=geo_model), 'name_tfidfs')
+        id_names = VenueDeduperSpark.names(address_ids).map(lambda name_uid: (name_uid[1], name_uid[0]))
+
+        address_hashes = AddressDeduperSpark.address_hashes(address_ids, deduper=VenueDeduper, use_latlon=use_latlon, use_city=use_city, use_postal_code=use_postal_code)
+        address_hashes = persistence.persist(address_hashes, 'venue_address_hashes')
+
+        address_dupe_pairs = AddressDeduperSpark.address_dupe_pairs(address_hashes, max_block_size=max_block_size, persistence=persistence)
+
+        if join_strategy is None:
+            join_strategy = IDPairRDD.choose_strategy(name_tfidfs)
+
+        pairs = spark.createDataFrame(address_dupe_pairs, cls.pair_schema)
+        vectors = cls.vectors_frame(spark, id_names, name_tfidfs)
+
+        return cls.score_pairs(pairs, vectors, name_dupe_threshold=name_dupe_threshold, name_review_threshold=name_review_threshold,
+                               geo_model_proportion=geo_model_proportion, broadcast_vectors=join_strategy == IDPairRDD.BROADCAST) \
+                  .rdd \
+                  .map(lambda row: ((row.uid1, row.uid2), (row.classification, row.similarity)))
@@ -1,33 +1,174 @@
+import math
+import six
+
 from six import itertools
 
-from lieu.address import AddressComponents, Coordinates
+from lieu.address import Address, AddressComponents, Coordinates
 from lieu.api import DedupeResponse
-from lieu.dedupe import AddressDeduper, NameDeduper, VenueDeduper
-from lieu.similarity import soft_tfidf_similarity, jaccard_similarity
+from lieu.dedupe import AddressDeduper, VenueDeduper
+from lieu.similarity import soft_tfidf_similarity, soft_tfidf_similarities, jaccard_similarity
 from lieu.tfidf import TFIDF
 
-from lieu.spark.tfidf import TFIDFSpark, GeoTFIDFSpark
-from lieu.spark.utils import IDPairRDD
+from lieu.spark.tfidf import TFIDFSpark, GeoTFIDFSpark, DocFrequencyModel
+from lieu.spark.utils import IDPairRDD, RDDPersistence
 
 
 class AddressDeduperSpark(object):
+    DEFAULT_MAX_BLOCK_SIZE = 2000
+    DEFAULT_SKEW_SAMPLE_FRACTION = 0.01
+    DEFAULT_PAIR_SAMPLE_FRACTION = 0.01
+
+    @classmethod
+    def block_size_estimates(cls, address_hashes, sample_fraction=DEFAULT_SKEW_SAMPLE_FRACTION, seed=None):
+        '''
+        Estimated {key: block size} from a sample of the hash keys. Sampling
+        computes all of address_hashes, so it should be persisted if it's
+        used again for the blocking (see block_candidate_pairs).
+        '''
+        sample_counts = address_hashes.sample(False, sample_fraction, seed=seed).countByKey()
+        return {key: count / sample_fraction for key, count in six.iteritems(sample_counts)}
+
+    @classmethod
+    def heavy_keys(cls, block_sizes, max_block_size=DEFAULT_MAX_BLOCK_SIZE):
+        '''
+        Return {key: num_sub_blocks} for the keys whose estimated block size
+        exceeds max_block_size.
+        '''
+        return {key: int(math.ceil(size / max_block_size)) for key, size in six.iteritems(block_sizes)
+                if size > max_block_size}
+
+    @classmethod
+    def sub_block_keys(cls, key, sub_block, num_sub_blocks):
+        '''
+        Split a heavy block into num_sub_blocks sub-blocks by uid. Each record
+        is sent to every (i, j) sub-block pair it belongs to, so the cross
+        products of all pairs of sub-blocks cover each candidate pair exactly once
+        '''
+        if num_sub_blocks <= 1:
+            return [(key, 0, 0)]
+
+        return [(key, min(sub_block, j), max(sub_block, j)) for j in range(num_sub_blocks)]
+
+    @classmethod
+    def sub_block_pairs(cls, key, vals):
+        _, i, j = key
+        if i == j:
+            return itertools.combinations(((uid, a) for sub_block, uid, a in vals), 2)
+
+        left = [(uid, a) for sub_block, uid, a in vals if sub_block == i]
+        right = [(uid, a) for sub_block, uid, a in vals if sub_block == j]
+        return itertools.product(left, right)
+
+    @classmethod
+    def salted_address_hashes(cls, address_hashes, heavy_keys):
+        from pyspark.rdd import portable_hash
+
+        heavy_keys = address_hashes.context.broadcast(heavy_keys)
+
+        def salted(key_val):
+            key, (uid, address) = key_val
+            num_sub_blocks = heavy_keys.value.get(key, 1)
+            sub_block = portable_hash(uid) % num_sub_blocks
+            return [(sub_key, (sub_block, uid, address)) for sub_key in cls.sub_block_keys(key, sub_block, num_sub_blocks)]
+
+        return address_hashes.flatMap(salted)
+
     @classmethod
-    def address_dupe_pairs(cls, address_hashes, sub_building=False):
-        dupe_pairs = list(address_hashes.groupByKey() \
-                                   .filter(lambda key_vals: len(key_vals[1]) > 1).values()) \
-                                   .flatMap(lambda vals: [(max(uid1, uid2), min(uid1, uid2))
-                                                          for (uid1, a1), (uid2, a2) in itertools.combinations(vals, 2)
-                                                          if AddressDeduper.is_address_dupe(a1, a2) and
-                                                          (not sub_building or AddressDeduper.is_sub_building_dupe(a1, a2))]) \
-                                   .distinct()
+    def block_candidate_pairs(cls, hashes, max_block_size=DEFAULT_MAX_BLOCK_SIZE, skew_sample_fraction=DEFAULT_SKEW_SAMPLE_FRACTION,
+                              block_sizes=None, persistence=None):
+        '''
+        All ((uid1, value1), (uid2, value2)) candidate pairs sharing a block.
+        Blocks estimated (from a sample) to be larger than max_block_size are
+        salted into sub-blocks whose cross-products run as separate tasks,
+        which bounds the work per task without changing the candidate pairs.
+
+        If block_sizes has to be estimated here, hashes is persisted first
+        (unless it already is) so the hashing isn't done twice.
+        '''
+        if block_sizes is None:
+            if not hashes.is_cached:
+                hashes = (persistence or RDDPersistence()).persist(hashes, 'block_hashes')
+            block_sizes = cls.block_size_estimates(hashes, sample_fraction=skew_sample_fraction)
+        heavy_keys = cls.heavy_keys(block_sizes, max_block_size=max_block_size)
+
+        return cls.salted_address_hashes(hashes, heavy_keys) \
+                  .groupByKey() \
+                  .filter(lambda key_vals: len(key_vals[1]) > 1) \
+                  .flatMap(lambda key_vals: cls.sub_block_pairs(key_vals[0], key_vals[1]))
+
+    @classmethod
+    def address_hashes(cls, address_ids, deduper=AddressDeduper, use_latlon=True, use_city=False, use_postal_code=False):
+        '''
+        (hash, (uid, address tuple)) for each near-dupe hash of each address. The
+        addresses are shuffled in their compact tuple encoding (Address.to_tuple).
+        '''
+        return address_ids.flatMap(lambda address_uid: [(h, (address_uid[1], Address.to_tuple(address_uid[0])))
+                                                        for h in deduper.near_dupe_hashes(address_uid[0], with_latlon=use_latlon, with_city_or_equivalent=use_city, with_postal_code=use_postal_code)])
+
+    @classmethod
+    def is_address_dupe_pair(cls, pair, sub_building=False):
+        a1 = Address.from_tuple(pair[0][1])
+        a2 = Address.from_tuple(pair[1][1])
+        return AddressDeduper.is_address_dupe(a1, a2) and (not sub_building or AddressDeduper.is_sub_building_dupe(a1, a2))
+
+    @classmethod
+    def address_dupe_pairs(cls, address_hashes, sub_building=False, max_block_size=DEFAULT_MAX_BLOCK_SIZE,
+                           skew_sample_fraction=DEFAULT_SKEW_SAMPLE_FRACTION, block_sizes=None, persistence=None):
+        dupe_pairs = cls.block_candidate_pairs(address_hashes, max_block_size=max_block_size, skew_sample_fraction=skew_sample_fraction,
+                                               block_sizes=block_sizes, persistence=persistence) \
+                        .filter(lambda pair: cls.is_address_dupe_pair(pair, sub_building=sub_building)) \
+                        .map(lambda pair: (max(pair[0][0], pair[1][0]), min(pair[0][0], pair[1][0]))) \
+                        .distinct()
 
         return dupe_pairs
 
     @classmethod
-    def dupe_sims(cls, address_ids, use_latlon=True, use_city=False, use_postal_code=False):
-        address_hashes = address_ids.flatMap(lambda address_uid: [(h, (address_uid[1], address_uid[0])) for h in AddressDeduper.near_dupe_hashes(address_uid[0], use_latlon=use_latlon, use_city=use_city, use_postal_code=use_postal_code)])
+    def dupe_pair_estimates(cls, address_hashes, sample_fraction=DEFAULT_PAIR_SAMPLE_FRACTION, max_block_size=DEFAULT_MAX_BLOCK_SIZE):
+        '''
+        Estimated (hash entries, address dupe pairs) of address_hashes, from
+        the whole blocks of a sample of the hash keys, so the address checks
+        run on real candidate pairs. A sampled block larger than max_block_size
+        is only checked on its first max_block_size records and scaled up.
+        Pairs sharing several blocks are counted once per block.
+        '''
+        from pyspark.rdd import portable_hash
+
+        num_buckets = 10000
+        sample_buckets = max(int(sample_fraction * num_buckets), 1)
+        sample_fraction = float(sample_buckets) / num_buckets
+
+        def block_counts(key_vals):
+            vals = list(key_vals[1])
+            n = len(vals)
+            checked = vals[:max_block_size]
+            m = len(checked)
+            if m < 2:
+                return n, 0.0
+
+            dupes = sum((1 for pair in itertools.combinations(checked, 2) if cls.is_address_dupe_pair(pair)))
+            return n, dupes * float(n * (n - 1)) / (m * (m - 1))
+
+        num_entries, num_dupe_pairs = address_hashes.filter(lambda key_val: portable_hash(key_val[0]) % num_buckets < sample_buckets) \
+                                                    .groupByKey() \
+                                                    .map(block_counts) \
+                                                    .fold((0, 0.0), lambda a, b: (a[0] + b[0], a[1] + b[1]))
+
+        return num_entries / sample_fraction, num_dupe_pairs / sample_fraction
 
-        return cls.address_dupe_pairs(address_hashes) \
+    @classmethod
+    def dupe_sims(cls, address_ids, use_latlon=True, use_city=False, use_postal_code=False, max_block_size=DEFAULT_MAX_BLOCK_SIZE,
+                  persistence=None):
+        '''
+        Same output as VenueDeduperSpark.dupe_sims. Address pairs have no name
+        vectors to join, so there's no join strategy to choose.
+        '''
+        if persistence is None:
+            persistence = RDDPersistence()
+
+        address_hashes = cls.address_hashes(address_ids, deduper=AddressDeduper, use_latlon=use_latlon, use_city=use_city, use_postal_code=use_postal_code)
+        address_hashes = persistence.persist(address_hashes, 'address_hashes')
+
+        return cls.address_dupe_pairs(address_hashes, max_block_size=max_block_size, persistence=persistence) \
                   .map(lambda uid1_uid2: ((uid1_uid2[0], uid1_uid2[1]), (DedupeResponse.classifications.EXACT_DUPE, 1.0)))
 
 
@@ -61,72 +202,253 @@ class VenueDeduperSpark(object):
         return (geo_model_proportion * geo_tfidf_sim) + ((1.0 - geo_model_proportion) * tfidf_sim)
 
     @classmethod
-    def dupe_sims(cls, address_ids, geo_model=True, doc_frequency=None, geo_doc_frequency=None, total_docs=0, total_docs_by_geo=None,
-                  min_name_word_count=1, min_geo_name_word_count=1, name_dupe_threshold=DedupeResponse.default_name_dupe_threshold,
-                  name_review_threshold=DedupeResponse.default_name_review_threshold, geo_model_proportion=DEFAULT_GEO_MODEL_PROPORTION,
-                  use_latlon=True, use_city=False, use_postal_code=False):
-        name_ids = cls.names(address_ids)
-        name_word_counts = TFIDFSpark.doc_word_counts(name_ids, has_id=True)
-        batch_doc_frequency = TFIDFSpark.doc_frequency(name_word_counts)
+    def pair_similarity(cls, tfidfs1, tfidfs2, geo_model_proportion=DEFAULT_GEO_MODEL_PROPORTION):
+        tfidf1, geo_tfidf1 = tfidfs1
+        tfidf2, geo_tfidf2 = tfidfs2
+        if geo_tfidf1 is None or geo_tfidf2 is None:
+            return cls.name_similarity(list(tfidf1.items()), list(tfidf2.items()))
 
-        if doc_frequency is not None:
-            doc_frequency = TFIDFSpark.update_doc_frequency(doc_frequency, batch_doc_frequency)
-        else:
-            doc_frequency = batch_doc_frequency
+        return cls.name_geo_similarity(list(tfidf1.items()), list(tfidf2.items()),
+                                       list(geo_tfidf1.items()), list(geo_tfidf2.items()),
+                                       geo_model_proportion=geo_model_proportion)
+
+    @classmethod
+    def pair_similarities(cls, pairs, geo_model_proportion=DEFAULT_GEO_MODEL_PROPORTION):
+        '''
+        Batch version of pair_similarity for a sequence of (tfidfs1, tfidfs2),
+        so token similarities can be shared across the batch
+        '''
+        pairs = list(pairs)
+        sims = soft_tfidf_similarities([(TFIDF.normalized_tfidf_vector(list(tfidfs1[0].items())),
+                                         TFIDF.normalized_tfidf_vector(list(tfidfs2[0].items())))
+                                        for tfidfs1, tfidfs2 in pairs])
+
+        geo_indices = [i for i, (tfidfs1, tfidfs2) in enumerate(pairs) if tfidfs1[1] is not None and tfidfs2[1] is not None]
+        geo_sims = soft_tfidf_similarities([(TFIDF.normalized_tfidf_vector(list(pairs[i][0][1].items())),
+                                             TFIDF.normalized_tfidf_vector(list(pairs[i][1][1].items())))
+                                            for i in geo_indices])
+
+        for i, geo_tfidf_sim in six.moves.zip(geo_indices, geo_sims):
+            sims[i] = (geo_model_proportion * geo_tfidf_sim) + ((1.0 - geo_model_proportion) * sims[i])
+
+        return sims
+
+    @classmethod
+    def sim_dupe_class(cls, sim, name_dupe_threshold=DedupeResponse.default_name_dupe_threshold):
+        return (DedupeResponse.classifications.LIKELY_DUPE if sim >= name_dupe_threshold else DedupeResponse.classifications.NEEDS_REVIEW, sim)
 
-        name_geo_word_counts = None
+    @classmethod
+    def choose_join_strategy(cls, vector_bytes, num_hash_entries, num_address_dupe_pairs,
+                             broadcast_max_bytes=IDPairRDD.DEFAULT_BROADCAST_MAX_BYTES):
+        '''
+        Broadcast the TF-IDF vectors when they're small (vector_bytes is their
+        estimated size). Otherwise compare the number of vectors each strategy
+        shuffles, on top of the blocking both of them do:
+
+        - scoring inside the blocks ships a vector with every hash entry
+        - joining onto the pairs partitions the vectors once, then ships one
+          vector per address dupe pair (carried from the first join to the
+          second). Pairs rejected by the address checks never reach the join.
+
+        The estimates come from AddressDeduperSpark.dupe_pair_estimates.
+        '''
+        if vector_bytes <= broadcast_max_bytes:
+            return IDPairRDD.BROADCAST
+
+        if num_hash_entries <= num_address_dupe_pairs:
+            return IDPairRDD.BLOCK
+        return IDPairRDD.COPARTITION
+
+    @classmethod
+    def block_pair_dupe_sim(cls, pair, name_dupe_threshold=DedupeResponse.default_name_dupe_threshold,
+                            name_review_threshold=DedupeResponse.default_name_review_threshold,
+                            geo_model_proportion=DEFAULT_GEO_MODEL_PROPORTION):
+        (uid1, (a1, tfidfs1)), (uid2, (a2, tfidfs2)) = pair
+        if uid1 < uid2:
+            uid1, a1, tfidfs1, uid2, a2, tfidfs2 = uid2, a2, tfidfs2, uid1, a1, tfidfs1
+
+        a1 = Address.from_tuple(a1)
+        a2 = Address.from_tuple(a2)
+
+        if not AddressDeduper.is_address_dupe(a1, a2):
+            return []
+
+        if VenueDeduper.is_exact_name_dupe(a1.get(AddressComponents.NAME, ''), a2.get(AddressComponents.NAME, '')):
+            return [((uid1, uid2), (DedupeResponse.classifications.EXACT_DUPE, 1.0))]
+
+        if tfidfs1 is None or tfidfs2 is None:
+            return []
+
+        sim = cls.pair_similarity(tfidfs1, tfidfs2, geo_model_proportion=geo_model_proportion)
+        if sim < name_review_threshold:
+            return []
+
+        return [((uid1, uid2), cls.sim_dupe_class(sim, name_dupe_threshold=name_dupe_threshold))]
+
+    @classmethod
+    def block_dupe_sims(cls, address_hashes, name_tfidfs,
+                        name_dupe_threshold=DedupeResponse.default_name_dupe_threshold,
+                        name_review_threshold=DedupeResponse.default_name_review_threshold,
+                        geo_model_proportion=DEFAULT_GEO_MODEL_PROPORTION,
+                        max_block_size=AddressDeduperSpark.DEFAULT_MAX_BLOCK_SIZE, block_sizes=None):
+        '''
+        Attach the TF-IDF vectors to the hashed records (keyed by uid) and
+        score the pairs inside the blocks where both records are already
+        present, instead of joining the vectors onto the pairs afterward.
+        address_hashes is the (persisted) output of address_hashes, so the
+        near-dupe hashes aren't computed again.
+        '''
+        hashes = address_hashes.map(lambda h_uid_address: (h_uid_address[1][0], (h_uid_address[0], h_uid_address[1][1]))) \
+                               .leftOuterJoin(name_tfidfs) \
+                               .map(lambda uid_h_address_tfidfs: (uid_h_address_tfidfs[1][0][0], (uid_h_address_tfidfs[0], (uid_h_address_tfidfs[1][0][1], uid_h_address_tfidfs[1][1]))))
+
+        return AddressDeduperSpark.block_candidate_pairs(hashes, max_block_size=max_block_size, block_sizes=block_sizes) \
+                                  .flatMap(lambda pair: cls.block_pair_dupe_sim(pair, name_dupe_threshold=name_dupe_threshold,
+                                                                                name_review_threshold=name_review_threshold,
+                                                                                geo_model_proportion=geo_model_proportion)) \
+                                  .reduceByKey(lambda x, y: x)
+
+    @classmethod
+    def doc_frequency_model(cls, address_ids, geo_model=True, model=None, update=True, adaptive_geo_cells=False):
+        '''
+        Document frequencies of the names in address_ids, added to those of a
+        prior model if one is given. With update=False a prior model is reused
+        as is, which skips the word count shuffles entirely.
+
+        With adaptive_geo_cells, the geo model counts docs per density-adaptive
+        cell (see GeoCells) rather than per fixed geohash merged via geo_aliases.
+        A prior model's cells are kept so its counts stay comparable.
+
+        Cell and geohash counts can't be added together, so updating a prior
+        geo model built the other way (with cells when adaptive_geo_cells is
+        False, or without them when it's True) raises ValueError.
+        '''
+        if model is not None and not update:
+            return model
+
+        if geo_model and model is not None and model.total_docs_by_geo is not None and (model.geo_cells is not None) != adaptive_geo_cells:
+            raise ValueError('The prior geo model was built with {} but adaptive_geo_cells={}, its counts can\'t be updated'.format(
+                             'density-adaptive cells' if model.geo_cells is not None else 'fixed-precision geohashes', adaptive_geo_cells))
+
+        name_word_counts = TFIDFSpark.doc_word_counts(cls.names(address_ids), has_id=True)
+        doc_frequency = TFIDFSpark.doc_frequency(name_word_counts)
+        total_docs = cls.batch_doc_count(address_ids)
+
+        if model is not None:
+            if model.doc_frequency is not None:
+                doc_frequency = TFIDFSpark.update_doc_frequency(model.doc_frequency, doc_frequency)
+            total_docs += model.total_docs
+
+        geo_doc_frequency = None
+        total_docs_by_geo = None
+        geo_cells = None
 
         if geo_model:
             name_geo_ids = cls.names_geo(address_ids)
-            batch_docs_by_geo = GeoTFIDFSpark.total_docs_by_geo(name_geo_ids, has_id=True)
-            if total_docs_by_geo is None:
-                total_docs_by_geo = batch_docs_by_geo
+
+            if adaptive_geo_cells:
+                if model is not None and model.geo_cells is not None:
+                    geo_cells = model.geo_cells
+                    total_docs_by_geo = GeoTFIDFSpark.total_docs_by_geo(name_geo_ids, has_id=True, geo_cells=address_ids.context.broadcast(geo_cells))
+                else:
+                    geo_cells = GeoTFIDFSpark.geo_cells(name_geo_ids, has_id=True)
+                    total_docs_by_geo = address_ids.context.parallelize(list(geo_cells.items()))
             else:
-                total_docs_by_geo = GeoTFIDFSpark.update_total_docs_by_geo(total_docs_by_geo, batch_docs_by_geo)
+                total_docs_by_geo = GeoTFIDFSpark.total_docs_by_geo(name_geo_ids, has_id=True)
 
-            geo_aliases = GeoTFIDFSpark.geo_aliases(total_docs_by_geo)
-            updated_total_docs_geo_aliases = GeoTFIDFSpark.updated_total_docs_geo_aliases(total_docs_by_geo, geo_aliases)
+            if model is not None and model.total_docs_by_geo is not None:
+                total_docs_by_geo = GeoTFIDFSpark.update_total_docs_by_geo(model.total_docs_by_geo, total_docs_by_geo)
 
-            name_geo_word_counts = GeoTFIDFSpark.doc_word_counts(name_geo_ids, has_id=True, geo_aliases=geo_aliases)
+            if geo_cells is not None:
+                name_geo_word_counts = GeoTFIDFSpark.doc_word_counts(name_geo_ids, has_id=True, geo_cells=address_ids.context.broadcast(geo_cells))
+            else:
+                geo_aliases = GeoTFIDFSpark.geo_aliases(total_docs_by_geo)
+                name_geo_word_counts = GeoTFIDFSpark.doc_word_counts(name_geo_ids, has_id=True, geo_aliases=geo_aliases)
 
-            batch_geo_doc_frequency = GeoTFIDFSpark.doc_frequency(name_geo_word_counts)
+            geo_doc_frequency = GeoTFIDFSpark.doc_frequency(name_geo_word_counts)
+            if model is not None and model.geo_doc_frequency is not None:
+                geo_doc_frequency = GeoTFIDFSpark.update_doc_frequency(model.geo_doc_frequency, geo_doc_frequency)
 
-            if geo_doc_frequency is not None:
-                geo_doc_frequency = GeoTFIDFSpark.update_doc_frequency(geo_doc_frequency, batch_geo_doc_frequency)
-            else:
-                geo_doc_frequency = batch_geo_doc_frequency
+        return DocFrequencyModel(doc_frequency, total_docs, geo_doc_frequency, total_docs_by_geo, geo_cells)
 
-        batch_docs = cls.batch_doc_count(address_ids)
+    @classmethod
+    def name_tfidfs(cls, address_ids, model, geo_model=True):
+        '''
+        (uid, (tfidf, geo_tfidf)) for each name, geo_tfidf is None without
+        the geo model or coordinates
+        '''
+        name_word_counts = TFIDFSpark.doc_word_counts(cls.names(address_ids), has_id=True)
+        names_tfidf = TFIDFSpark.docs_tfidf(name_word_counts, model.doc_frequency, model.total_docs)
 
-        total_docs += batch_docs
-        names_tfidf = TFIDFSpark.docs_tfidf(name_word_counts, doc_frequency, total_docs)
-        names_geo_tfidf = None
+        if not geo_model:
+            return names_tfidf.mapValues(lambda tfidf: (tfidf, None))
 
-        if geo_model:
-            names_geo_tfidf = GeoTFIDFSpark.docs_tfidf(name_geo_word_counts, geo_doc_frequency, updated_total_docs_geo_aliases)
+        name_geo_ids = cls.names_geo(address_ids)
+        if model.geo_cells is not None:
+            # cells are already balanced, so their doc counts are a small table to look up map-side
+            name_geo_word_counts = GeoTFIDFSpark.doc_word_counts(name_geo_ids, has_id=True, geo_cells=address_ids.context.broadcast(model.geo_cells))
+            total_docs_by_geo = model.total_docs_by_geo.collectAsMap()
+        else:
+            geo_aliases = GeoTFIDFSpark.geo_aliases(model.total_docs_by_geo)
+            total_docs_by_geo = GeoTFIDFSpark.updated_total_docs_geo_aliases(model.total_docs_by_geo, geo_aliases)
+            name_geo_word_counts = GeoTFIDFSpark.doc_word_counts(name_geo_ids, has_id=True, geo_aliases=geo_aliases)
+        names_geo_tfidf = GeoTFIDFSpark.docs_tfidf(name_geo_word_counts, model.geo_doc_frequency, total_docs_by_geo)
+        return names_tfidf.leftOuterJoin(names_geo_tfidf)
+
+    @classmethod
+    def dupe_sims(cls, address_ids, geo_model=True, doc_frequency=None, geo_doc_frequency=None, total_docs=0, total_docs_by_geo=None,
+                  min_name_word_count=1, min_geo_name_word_count=1, name_dupe_threshold=DedupeResponse.default_name_dupe_threshold,
+                  name_review_threshold=DedupeResponse.default_name_review_threshold, geo_model_proportion=DEFAULT_GEO_MODEL_PROPORTION,
+                  use_latlon=True, use_city=False, use_postal_code=False, max_block_size=AddressDeduperSpark.DEFAULT_MAX_BLOCK_SIZE,
+                  join_strategy=None, model=None, update_doc_frequencies=True, adaptive_geo_cells=False, persistence=None):
+        '''
+        Returns ((uid1, uid2), (classification, similarity)) for each dupe pair.
+        RDDs consumed more than once are persisted through persistence (an
+        RDDPersistence, so the caller can log and release them).
+        '''
+        if persistence is None:
+            persistence = RDDPersistence()
+
+        if model is None and (doc_frequency is not None or geo_doc_frequency is not None or total_docs_by_geo is not None):
+            model = DocFrequencyModel(doc_frequency, total_docs, geo_doc_frequency, total_docs_by_geo)
+
+        model = cls.doc_frequency_model(address_ids, geo_model=geo_model, model=model, update=update_doc_frequencies,
+                                        adaptive_geo_cells=adaptive_geo_cells)
+
+        name_ids = cls.names(address_ids)
+        name_tfidfs = persistence.persist(cls.name_tfidfs(address_ids, model, geo_model=geo_model), 'name_tfidfs')
 
-        address_hashes = address_ids.flatMap(lambda address_uid3: [(h, (address_uid3[1], address_uid3[0])) for h in VenueDeduper.near_dupe_hashes(address_uid3[0], use_latlon=use_latlon, use_city=use_city, use_postal_code=use_postal_code)])
+        address_hashes = AddressDeduperSpark.address_hashes(address_ids, deduper=VenueDeduper, use_latlon=use_latlon, use_city=use_city, use_postal_code=use_postal_code)
+        address_hashes = persistence.persist(address_hashes, 'venue_address_hashes')
+        block_sizes = AddressDeduperSpark.block_size_estimates(address_hashes)
 
-        address_dupe_pairs = AddressDeduperSpark.address_dupe_pairs(address_hashes)
+        if join_strategy is None:
+            num_hash_entries, num_address_dupe_pairs = AddressDeduperSpark.dupe_pair_estimates(address_hashes, max_block_size=max_block_size)
+            join_strategy = cls.choose_join_strategy(IDPairRDD.estimate_bytes(name_tfidfs), num_hash_entries, num_address_dupe_pairs)
+
+        if join_strategy == IDPairRDD.BLOCK:
+            return cls.block_dupe_sims(address_hashes, name_tfidfs,
+                                       name_dupe_threshold=name_dupe_threshold, name_review_threshold=name_review_threshold,
+                                       geo_model_proportion=geo_model_proportion, max_block_size=max_block_size, block_sizes=block_sizes)
+
+        address_dupe_pairs = AddressDeduperSpark.address_dupe_pairs(address_hashes, max_block_size=max_block_size, block_sizes=block_sizes)
+        address_dupe_pairs = persistence.persist(address_dupe_pairs, 'address_dupe_pairs', checkpoint=True)
 
         id_names = name_ids.map(lambda name_uid: (name_uid[1], name_uid[0]))
 
-        exact_dupe_pairs = list(IDPairRDD.join_pairs(address_dupe_pairs, id_names) \
-                                    .filter(lambda uid1_uid2_name1_name2: VenueDeduper.is_exact_name_dupe(uid1_uid2_name1_name2[1][0], uid1_uid2_name1_name2[1][1])).keys())
+        exact_dupe_pairs = IDPairRDD.join_pairs(address_dupe_pairs, id_names, persistence=persistence, name='partitioned_id_names') \
+                                    .filter(lambda uid1_uid2_name1_name2: VenueDeduper.is_exact_name_dupe(uid1_uid2_name1_name2[1][0], uid1_uid2_name1_name2[1][1])) \
+                                    .keys()
 
-        if not geo_model:
-            dupe_pair_sims = IDPairRDD.join_pairs(address_dupe_pairs, names_tfidf) \
-                                      .mapValues(lambda tfidf1_tfidf2: cls.name_similarity(list(tfidf1_tfidf2[0].items()), list(tfidf1_tfidf2[1].items())))
-        else:
-            dupe_pair_sims = IDPairRDD.join_pairs(address_dupe_pairs, names_tfidf.join(names_geo_tfidf)) \
-                                      .mapValues(lambda tfidf1_geo_tfidf1_tfidf2_geo_tfidf2: cls.name_geo_similarity(list(tfidf1_geo_tfidf1_tfidf2_geo_tfidf2[0][0].items()), list(tfidf1_geo_tfidf1_tfidf2_geo_tfidf2[1][0].items()),
-                                                                                                                              list(tfidf1_geo_tfidf1_tfidf2_geo_tfidf2[0][1].items()), list(tfidf1_geo_tfidf1_tfidf2_geo_tfidf2[1][1].items()),
-                                                                                                                              geo_model_proportion=geo_model_proportion))
+        dupe_pair_sims = IDPairRDD.join_pairs(address_dupe_pairs, name_tfidfs, strategy=join_strategy, persistence=persistence,
+                                              name='partitioned_name_tfidfs') \
+                                  .mapValues(lambda tfidfs1_tfidfs2: cls.pair_similarity(tfidfs1_tfidfs2[0], tfidfs1_tfidfs2[1], geo_model_proportion=geo_model_proportion))
 
         exact_dupe_sims = exact_dupe_pairs.map(lambda uid1_uid24: ((uid1_uid24[0], uid1_uid24[1]), (DedupeResponse.classifications.EXACT_DUPE, 1.0)))
+        exact_dupe_sims = persistence.persist(exact_dupe_sims, 'exact_dupe_sims')
 
         possible_dupe_sims = dupe_pair_sims.filter(lambda uid1_uid2_sim: uid1_uid2_sim[1] >= name_review_threshold) \
-                                           .mapValues(lambda sim: (DedupeResponse.classifications.LIKELY_DUPE if sim >= name_dupe_threshold else DedupeResponse.classifications.NEEDS_REVIEW, sim)) \
+                                           .mapValues(lambda sim: cls.sim_dupe_class(sim, name_dupe_threshold=name_dupe_threshold)) \
                                            .subtractByKey(exact_dupe_sims)
 
         all_dupe_sims = possible_dupe_sims.union(exact_dupe_sims)
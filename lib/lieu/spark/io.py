@@ -0,0 +1,174 @@
+import six
+import ujson as json
+
+from lieu.address import Address
+from lieu.api import DedupeResponse
+from lieu.spark.tfidf import spark_session
+from lieu.spark.utils import UidRangePartitioning
+
+
+class GeoJSONLines(object):
+    '''Line-delimited GeoJSON text, one feature per line'''
+    name = 'geojson'
+
+    @classmethod
+    def read(cls, sc, input_path, persistence):
+        '''
+        Returns (address_ids, id_records) where the records are the original
+        features as JSON strings, only parsed again to build the output.
+        '''
+        line_ids = persistence.persist(sc.textFile(input_path).map(lambda line: line.rstrip()).zipWithIndex(), 'line_ids')
+        id_records = line_ids.map(lambda line_uid: (line_uid[1], line_uid[0]))
+
+        address_ids = line_ids.map(lambda line_uid: (Address.from_geojson(json.loads(line_uid[0])), line_uid[1]))
+        return address_ids, id_records
+
+    @classmethod
+    def write(cls, responses, output_path, persistence=None):
+        responses.map(lambda response: json.dumps(response)).saveAsTextFile(output_path)
+
+
+class GeoJSONParquet(object):
+    '''
+    GeoJSON features stored as Parquet with the same nesting as the JSON
+    (properties and geometry columns), e.g. as written by
+    spark.read.json(lines).write.parquet(path).
+
+    The dedupe stages only select the properties in Address.field_map and
+    the coordinates, so Parquet decodes just those columns. The full record
+    is read (as a JSON string) for the output only.
+
+    Unlike GeoJSONLines, the output records have no null fields. The
+    Parquet schema has every property of any feature, so most nulls are
+    properties a feature never had, and to_json leaves them out. The
+    catch is that a property that was null in the source is dropped too.
+    '''
+    name = 'parquet'
+
+    @classmethod
+    def address_properties(cls, schema):
+        from pyspark.sql.types import StructType
+
+        properties = schema['properties'].dataType
+        if not isinstance(properties, StructType):
+            # a map column can't be pruned by key, so decode it whole
+            return None
+        return [f.name for f in properties.fields if f.name in Address.field_map]
+
+    @classmethod
+    def row_address(cls, row, properties):
+        if properties is None:
+            values = {k: v for k, v in six.iteritems(row[0] or {}) if k in Address.field_map and v is not None}
+        else:
+            values = {k: v for k, v in six.moves.zip(properties, row) if v is not None}
+
+        coordinates = row[-1] or (None, None)
+        return Address.from_geojson({'properties': values, 'geometry': {'coordinates': coordinates}})
+
+    @classmethod
+    def read(cls, sc, input_path, persistence):
+        '''
+        Returns (address_ids, id_records). The address columns and the full
+        record (as a JSON string) come from one select, numbered once with
+        zipWithIndex and persisted, so both sides see the same uids even if
+        a rescan would return the rows in a different order.
+        '''
+        from pyspark.sql import functions as F
+
+        features = spark_session(sc).read.parquet(*input_path.split(','))
+
+        properties = cls.address_properties(features.schema)
+        if properties is None:
+            columns = [F.col('properties')]
+        else:
+            columns = [F.col('properties.`{}`'.format(name)) for name in properties]
+        columns.append(F.col('geometry.coordinates'))
+        # to_json drops null fields, i.e. properties missing from a given feature (see above)
+        columns.append(F.to_json(F.struct(*[features[name] for name in features.columns])))
+
+        row_ids = persistence.persist(features.select(*columns).rdd.zipWithIndex(), 'row_ids')
+        id_records = row_ids.map(lambda row_uid: (row_uid[1], row_uid[0][-1]))
+
+        address_ids = row_ids.map(lambda row_uid: (cls.row_address(row_uid[0][:-1], properties), row_uid[1]))
+        return address_ids, id_records
+
+    @classmethod
+    def write(cls, responses, output_path, persistence=None):
+        '''
+        spark.read.json scans its input once to infer the schema and again
+        to write it, so the responses are persisted in between rather than
+        built twice.
+        '''
+        spark = spark_session(responses.context)
+        lines = responses.map(lambda response: json.dumps(response))
+        if persistence is not None:
+            lines = persistence.persist(lines, 'response_lines')
+        spark.read.json(lines).write.parquet(output_path)
+
+
+class DedupeResponses(object):
+    @classmethod
+    def same_as_by_uid1(cls, uid2_vals):
+        '''
+        From (uid2, (pairs, records, dupes)) to (uid1, (record2, classification, is_canonical, sim))
+        for each pair, where uid2 is canonical unless it's a dupe itself
+        '''
+        uid2, (pairs, records, dupes) = uid2_vals
+        if not pairs or not records:
+            return []
+        is_canonical = not dupes
+        return [(uid1, (records[0], classification, is_canonical, sim)) for uid1, classification, sim in pairs]
+
+    @classmethod
+    def uid_response(cls, uid_vals, explain=None, dupes_only=False):
+        uid, (records, same_as) = uid_vals
+        if not records:
+            return []
+
+        value = json.loads(records[0])
+        if not same_as:
+            if dupes_only:
+                return []
+            return [(uid, DedupeResponse.base_response(value, is_dupe=False))]
+
+        is_dupe = any((classification in DedupeResponse.dupe_classifications for other, classification, is_canonical, sim in same_as))
+        same_as = [(json.loads(other), classification, is_canonical, sim) for other, classification, is_canonical, sim in same_as]
+        return [(uid, DedupeResponse.create(value, is_dupe=is_dupe, add_random_guid=True, same_as=same_as, explain=explain))]
+
+    @classmethod
+    def responses(cls, dupe_sims, id_records, explain=None, dupes_only=False, ordered=True, persistence=None):
+        '''
+        Build a response for each record from ((uid1, uid2), (classification, similarity))
+        pairs and (uid, JSON string) records.
+
+        The records are partitioned by uid range once, and both cogroups only
+        shuffle the pair side to them: the first attaches the other record
+        and its canonical flag to each pair, the second groups the pairs
+        with their record. Output partitions follow the uid ranges, so with
+        ordered=True sorting within each partition restores the input order
+        (there's no global sort).
+        '''
+        partitioning = UidRangePartitioning(id_records.count(), id_records.getNumPartitions())
+        id_records = partitioning.partition(id_records)
+        if persistence is not None:
+            id_records = persistence.persist(id_records, 'id_records')
+
+        dupe_classifications = DedupeResponse.dupe_classifications
+        dupes = dupe_sims.filter(lambda pair_class_sim: pair_class_sim[1][0] in dupe_classifications) \
+                         .map(lambda pair_class_sim: (pair_class_sim[0][0], True))
+
+        pairs_by_uid2 = dupe_sims.map(lambda pair_class_sim: (pair_class_sim[0][1], (pair_class_sim[0][0], pair_class_sim[1][0], pair_class_sim[1][1])))
+
+        same_as_by_uid1 = partitioning.cogroup(pairs_by_uid2, id_records, dupes) \
+                                      .flatMap(cls.same_as_by_uid1)
+
+        responses = partitioning.cogroup(id_records, same_as_by_uid1) \
+                                .flatMap(lambda uid_vals: cls.uid_response(uid_vals, explain=explain, dupes_only=dupes_only), preservesPartitioning=True)
+
+        if ordered:
+            responses = partitioning.sort_within_partitions(responses)
+
+        return responses.values()
+
+
+formats = {f.name: f for f in (GeoJSONLines, GeoJSONParquet)}
@@ -1,22 +1,37 @@
 import geohash
 import math
+import os
+import six
+import uuid
 
 from six import operator
 
-from collections import Counter
+from collections import Counter, namedtuple
 
 from lieu.tfidf import TFIDF
-from lieu.dedupe import NameDeduper
+from lieu.dedupe import Name
+from lieu.spark.utils import replace_path
+
+
+def spark_session(sc):
+    from pyspark.sql import SparkSession
+    return SparkSession.builder.config(conf=sc.getConf()).getOrCreate()
 
 
 class TFIDFSpark(object):
+    doc_frequency_columns = ('word', 'doc_count')
+    doc_frequency_schema = 'word string, doc_count long'
+
+    '''Doc frequency of words the model hasn't seen, as in TFIDF.doc_frequency'''
+    unseen_doc_frequency = 1.0
+
     @classmethod
     def doc_word_counts(cls, docs, has_id=False):
         if not has_id:
             docs = docs.zipWithUniqueId()
 
         doc_word_counts = docs.flatMap(lambda doc_doc_id: [(word, (doc_doc_id[1], count))
-                                                              for word, count in list(Counter(NameDeduper.content_tokens(doc_doc_id[0])).items())])
+                                                              for word, count in list(Counter(Name.content_tokens(doc_doc_id[0])).items())])
         return doc_word_counts
 
     @classmethod
@@ -33,65 +48,184 @@ class TFIDFSpark(object):
         updated = doc_frequency.union(batch_frequency).reduceByKey(lambda x, y: x + y)
         return updated
 
+    @classmethod
+    def save_doc_frequency(cls, doc_frequency, path):
+        '''Write (word, doc_count) as Parquet, sorted by word so it compresses well'''
+        spark_session(doc_frequency.context).createDataFrame(doc_frequency.map(lambda word_count: (word_count[0], word_count[1])), cls.doc_frequency_schema) \
+                                            .sortWithinPartitions(cls.doc_frequency_columns[0]) \
+                                            .write.mode('overwrite').parquet(path)
+
+    @classmethod
+    def load_doc_frequency(cls, sc, path):
+        return spark_session(sc).read.parquet(path).rdd.map(lambda row: (row[0], row[1]))
+
     @classmethod
     def docs_tfidf(cls, doc_word_counts, doc_frequency, total_docs, min_count=1):
+        '''
+        Words missing from doc_frequency (e.g. new words when a saved model
+        is reused as is) get unseen_doc_frequency rather than being dropped.
+        '''
         if min_count > 1:
             doc_frequency = cls.filter_min_doc_frequency(doc_frequency, min_count=min_count)
 
         num_partitions = doc_word_counts.getNumPartitions()
+        unseen_doc_frequency = cls.unseen_doc_frequency
 
-        doc_ids_word_stats = doc_word_counts.join(doc_frequency).map(lambda word_doc_id_term_frequency_doc_frequency: (word_doc_id_term_frequency_doc_frequency[0][0], (word_doc_id_term_frequency_doc_frequency[0], word_doc_id_term_frequency_doc_frequency[0][1], word_doc_id_term_frequency_doc_frequency[1][1])))
+        doc_ids_word_stats = doc_word_counts.leftOuterJoin(doc_frequency).map(lambda word_doc_id_term_frequency_doc_frequency: (word_doc_id_term_frequency_doc_frequency[1][0][0], (word_doc_id_term_frequency_doc_frequency[0], word_doc_id_term_frequency_doc_frequency[1][0][1], word_doc_id_term_frequency_doc_frequency[1][1] or unseen_doc_frequency)))
         docs_tfidf = doc_ids_word_stats.groupByKey() \
                                        .mapValues(lambda vals: {word: TFIDF.tfidf_score(term_frequency, doc_frequency, total_docs)
                                                                 for word, term_frequency, doc_frequency in vals})
         return docs_tfidf.coalesce(num_partitions)
 
 
+class GeoCells(object):
+    '''
+    Density-adaptive geohash cells, quadtree-style. Starting from cells at
+    min_precision, any cell with more than target_doc_count docs is split into
+    its child geohashes. Children with fewer than min_doc_count docs are merged
+    back upward, i.e. their docs stay with the parent cell. Top-level cells
+    with fewer than min_doc_count docs have no parent, so they're left out
+    and their docs fall back to the global model.
+
+    The result is a compact {cell geohash: doc count} lookup table, where a
+    doc belongs to the longest cell prefix of its geohash, if any. It's
+    computed once on the driver from doc counts and broadcast, so assigning
+    docs to cells needs no joins.
+    '''
+    DEFAULT_MIN_PRECISION = 3
+    DEFAULT_MAX_PRECISION = 6
+    DEFAULT_TARGET_DOC_COUNT = 10000
+    DEFAULT_MIN_DOC_COUNT = 1000
+
+    @classmethod
+    def build(cls, geohash_counts, min_precision=DEFAULT_MIN_PRECISION, max_precision=DEFAULT_MAX_PRECISION,
+              target_doc_count=DEFAULT_TARGET_DOC_COUNT, min_doc_count=DEFAULT_MIN_DOC_COUNT):
+        '''
+        geohash_counts is an RDD of (geohash at max_precision, doc count).
+        Each level only counts the children of the cells being split.
+        '''
+        sc = geohash_counts.context
+
+        cells = geohash_counts.map(lambda geo_count: (geo_count[0][:min_precision], geo_count[1])) \
+                              .reduceByKey(lambda x, y: x + y) \
+                              .collectAsMap()
+
+        cells = {geo: count for geo, count in six.iteritems(cells) if count >= min_doc_count}
+        split = set([geo for geo, count in six.iteritems(cells) if count > target_doc_count])
+
+        for precision in range(min_precision + 1, max_precision + 1):
+            if not split:
+                break
+
+            parents = sc.broadcast(split)
+            child_counts = geohash_counts.filter(lambda geo_count: geo_count[0][:precision - 1] in parents.value) \
+                                         .map(lambda geo_count: (geo_count[0][:precision], geo_count[1])) \
+                                         .reduceByKey(lambda x, y: x + y) \
+                                         .collectAsMap()
+            parents.unpersist()
+
+            split = set()
+            for child, count in six.iteritems(child_counts):
+                if count < min_doc_count:
+                    continue
+                cells[child] = count
+                cells[child[:-1]] -= count
+                if count > target_doc_count:
+                    split.add(child)
+
+        return cells
+
+    @classmethod
+    def cell(cls, geo, cells, min_precision=DEFAULT_MIN_PRECISION):
+        '''Longest prefix of geo in the cells table, None if there is none (a sparse or new area)'''
+        for precision in range(len(geo), min_precision - 1, -1):
+            if geo[:precision] in cells:
+                return geo[:precision]
+        return None
+
+
 class GeoTFIDFSpark(TFIDFSpark):
     DEFAULT_GEOHASH_PRECISION = 4
 
+    doc_frequency_columns = ('geo', 'word', 'doc_count')
+    doc_frequency_schema = 'geo string, word string, doc_count long'
+    total_docs_by_geo_columns = ('geo', 'num_docs')
+    total_docs_by_geo_schema = 'geo string, num_docs long'
+
+    '''
+    Doc count of geos the model hasn't seen. Their words all get the same
+    doc frequency, so they're weighted by term frequency alone.
+    '''
+    unseen_num_docs = 2.0
+
     @classmethod
     def doc_geohash(cls, lat, lon, geohash_precision=DEFAULT_GEOHASH_PRECISION):
         return geohash.encode(lat, lon)[:geohash_precision]
 
     @classmethod
-    def doc_word_counts(cls, docs, geo_aliases=None, has_id=False, geohash_precision=DEFAULT_GEOHASH_PRECISION):
+    def doc_cell(cls, lat, lon, geo_cells):
+        return GeoCells.cell(geohash.encode(lat, lon), geo_cells)
+
+    @classmethod
+    def doc_word_counts(cls, docs, geo_aliases=None, geo_cells=None, has_id=False, geohash_precision=DEFAULT_GEOHASH_PRECISION):
+        '''
+        geo_cells is an optional broadcast GeoCells table. If given, docs are
+        assigned to their adaptive cell directly instead of joining geo_aliases,
+        and docs outside every cell are left out.
+        '''
         if not has_id:
             docs = docs.zipWithUniqueId()
 
-        docs = docs.filter(lambda doc_lat_lon_doc_id2: doc_lat_lon_doc_id2[0][1] is not None and doc_lat_lon_doc_id2[0][2] is not None)
+        docs = docs.filter(lambda doc_lat_lon_doc_id: doc_lat_lon_doc_id[0][1] is not None and doc_lat_lon_doc_id[0][2] is not None)
 
-        if geo_aliases:
+        if geo_cells is not None:
+            doc_geohashes = docs.map(lambda doc_lat_lon_doc_id: (cls.doc_cell(doc_lat_lon_doc_id[0][1], doc_lat_lon_doc_id[0][2], geo_cells.value), doc_lat_lon_doc_id[0][0], doc_lat_lon_doc_id[1])) \
+                                .filter(lambda geo_doc_doc_id: geo_doc_doc_id[0] is not None)
+        elif geo_aliases:
             doc_geohashes = docs.map(lambda doc_lat_lon_doc_id: (cls.doc_geohash(doc_lat_lon_doc_id[0][1], doc_lat_lon_doc_id[0][2]), (doc_lat_lon_doc_id[0][0], doc_lat_lon_doc_id[1]))) \
                                 .leftOuterJoin(geo_aliases) \
-                                .map(lambda geo_doc_doc_id_geo_alias: (geo_doc_doc_id_geo_alias[1][1] or geo_doc_doc_id_geo_alias[0], geo_doc_doc_id_geo_alias[0][0], geo_doc_doc_id_geo_alias[0][1]))
+                                .map(lambda geo_doc_doc_id_geo_alias: (geo_doc_doc_id_geo_alias[1][1] or geo_doc_doc_id_geo_alias[0], geo_doc_doc_id_geo_alias[1][0][0], geo_doc_doc_id_geo_alias[1][0][1]))
         else:
-            doc_geohashes = docs.map(lambda doc_lat_lon_doc_id1: (cls.doc_geohash(doc_lat_lon_doc_id1[0][1], doc_lat_lon_doc_id1[0][2]), doc_lat_lon_doc_id1[0][0], doc_lat_lon_doc_id1[1]))
+            doc_geohashes = docs.map(lambda doc_lat_lon_doc_id: (cls.doc_geohash(doc_lat_lon_doc_id[0][1], doc_lat_lon_doc_id[0][2]), doc_lat_lon_doc_id[0][0], doc_lat_lon_doc_id[1]))
 
         doc_word_counts = doc_geohashes.flatMap(lambda geo_doc_doc_id: [((geo_doc_doc_id[0], word), (geo_doc_doc_id[2], count))
-                                                                            for word, count in list(Counter(NameDeduper.content_tokens(geo_doc_doc_id[1])).items())])
+                                                                            for word, count in list(Counter(Name.content_tokens(geo_doc_doc_id[1])).items())])
         return doc_word_counts
 
     @classmethod
     def geo_aliases(cls, total_docs_by_geo, min_doc_count=1000):
         keep_geos = total_docs_by_geo.filter(lambda geo_count: geo_count[1] >= min_doc_count)
         alias_geos = total_docs_by_geo.subtract(keep_geos)
-        return list(alias_geos.keys()) \
+        return alias_geos.keys() \
                          .flatMap(lambda key: [(neighbor, key) for neighbor in geohash.neighbors(key)]) \
                          .join(keep_geos) \
                          .map(lambda neighbor_key_count: (neighbor_key_count[1][0], (neighbor_key_count[0], neighbor_key_count[1][1]))) \
                          .groupByKey() \
-                         .map(lambda key_values: (key_values[0], sorted(key_values[1], key_values[0]=operator.itemgetter(1), reverse=True)[0][0]))
+                         .map(lambda key_values: (key_values[0], sorted(key_values[1], key=operator.itemgetter(1), reverse=True)[0][0]))
 
     @classmethod
-    def total_docs_by_geo(cls, docs, has_id=False, geohash_precision=DEFAULT_GEOHASH_PRECISION):
+    def geo_cells(cls, docs, has_id=False, min_precision=GeoCells.DEFAULT_MIN_PRECISION, max_precision=GeoCells.DEFAULT_MAX_PRECISION,
+                  target_doc_count=GeoCells.DEFAULT_TARGET_DOC_COUNT, min_doc_count=GeoCells.DEFAULT_MIN_DOC_COUNT):
+        geohash_counts = cls.total_docs_by_geo(docs, has_id=has_id, geohash_precision=max_precision).cache()
+        geo_cells = GeoCells.build(geohash_counts, min_precision=min_precision, max_precision=max_precision,
+                                   target_doc_count=target_doc_count, min_doc_count=min_doc_count)
+        geohash_counts.unpersist()
+        return geo_cells
+
+    @classmethod
+    def total_docs_by_geo(cls, docs, has_id=False, geo_cells=None, geohash_precision=DEFAULT_GEOHASH_PRECISION):
         if not has_id:
             docs = docs.zipWithUniqueId()
 
-        docs = docs.filter(lambda doc_lat_lon_doc_id3: doc_lat_lon_doc_id3[0][1] is not None and doc_lat_lon_doc_id3[0][2] is not None)
+        docs = docs.filter(lambda doc_lat_lon_doc_id: doc_lat_lon_doc_id[0][1] is not None and doc_lat_lon_doc_id[0][2] is not None)
 
-        total_docs_by_geo = docs.map(lambda doc_lat_lon_doc_id4: (cls.doc_geohash(doc_lat_lon_doc_id4[0][1], doc_lat_lon_doc_id4[0][2]), 1)) \
-                                .reduceByKey(lambda x, y: x + y)
+        if geo_cells is not None:
+            doc_geos = docs.map(lambda doc_lat_lon_doc_id: (cls.doc_cell(doc_lat_lon_doc_id[0][1], doc_lat_lon_doc_id[0][2], geo_cells.value), 1)) \
+                           .filter(lambda geo_count: geo_count[0] is not None)
+        else:
+            doc_geos = docs.map(lambda doc_lat_lon_doc_id: (cls.doc_geohash(doc_lat_lon_doc_id[0][1], doc_lat_lon_doc_id[0][2], geohash_precision=geohash_precision), 1))
+
+        total_docs_by_geo = doc_geos.reduceByKey(lambda x, y: x + y)
         return total_docs_by_geo
 
     @classmethod
@@ -99,6 +233,27 @@ class GeoTFIDFSpark(TFIDFSpark):
         updated = total_docs_by_geo.union(batch_docs_by_geo).reduceByKey(lambda x, y: x + y)
         return updated
 
+    @classmethod
+    def save_doc_frequency(cls, geo_doc_frequency, path):
+        spark_session(geo_doc_frequency.context).createDataFrame(geo_doc_frequency.map(lambda geo_word_count: (geo_word_count[0][0], geo_word_count[0][1], geo_word_count[1])),
+                                                                 cls.doc_frequency_schema) \
+                                                .sortWithinPartitions(*cls.doc_frequency_columns[:2]) \
+                                                .write.mode('overwrite').parquet(path)
+
+    @classmethod
+    def load_doc_frequency(cls, sc, path):
+        return spark_session(sc).read.parquet(path).rdd.map(lambda row: ((row[0], row[1]), row[2]))
+
+    @classmethod
+    def save_total_docs_by_geo(cls, total_docs_by_geo, path):
+        spark_session(total_docs_by_geo.context).createDataFrame(total_docs_by_geo, cls.total_docs_by_geo_schema) \
+                                                .sortWithinPartitions(cls.total_docs_by_geo_columns[0]) \
+                                                .write.mode('overwrite').parquet(path)
+
+    @classmethod
+    def load_total_docs_by_geo(cls, sc, path):
+        return spark_session(sc).read.parquet(path).rdd.map(lambda row: (row[0], row[1]))
+
     @classmethod
     def updated_total_docs_geo_aliases(cls, total_docs_by_geo, geo_aliases):
         batch_docs_by_geo = total_docs_by_geo.join(geo_aliases) \
@@ -110,18 +265,99 @@ class GeoTFIDFSpark(TFIDFSpark):
 
     @classmethod
     def docs_tfidf(cls, doc_word_counts, geo_doc_frequency, total_docs_by_geo, min_count=1):
+        '''
+        total_docs_by_geo may be an RDD or, e.g. for adaptive cells, a dict
+        small enough to look up map-side instead of joining.
+
+        As in TFIDFSpark.docs_tfidf, words missing from geo_doc_frequency get
+        unseen_doc_frequency, and geos missing from total_docs_by_geo (e.g. a
+        new area when a saved model is reused as is) get unseen_num_docs, so
+        no doc loses its geo vector.
+        '''
         if min_count > 1:
             geo_doc_frequency = cls.filter_min_doc_frequency(geo_doc_frequency, min_count=min_count)
 
         num_partitions = doc_word_counts.getNumPartitions()
+        unseen_doc_frequency = cls.unseen_doc_frequency
+        unseen_num_docs = cls.unseen_num_docs
 
-        geo_doc_frequency_totals = geo_doc_frequency.map(lambda geo_word_count: (geo_word_count[0][0], (geo_word_count[0][1], geo_word_count[1]))) \
-                                                    .join(total_docs_by_geo) \
-                                                    .map(lambda geo_word_count_num_docs: ((geo_word_count_num_docs[0], geo_word_count_num_docs[0][0]), (geo_word_count_num_docs[0][1], geo_word_count_num_docs[1][1])))
-        doc_ids_word_stats = doc_word_counts.join(geo_doc_frequency_totals) \
-                                            .map(lambda geo_word_doc_id_term_frequency_doc_frequency_num_docs: (geo_word_doc_id_term_frequency_doc_frequency_num_docs[0][0], (geo_word_doc_id_term_frequency_doc_frequency_num_docs[0][0], geo_word_doc_id_term_frequency_doc_frequency_num_docs[0][1], geo_word_doc_id_term_frequency_doc_frequency_num_docs[0][1], geo_word_doc_id_term_frequency_doc_frequency_num_docs[1][0], geo_word_doc_id_term_frequency_doc_frequency_num_docs[1][1])))
+        geo_word_stats = doc_word_counts.leftOuterJoin(geo_doc_frequency) \
+                                        .map(lambda geo_word_doc_id_term_frequency_doc_frequency: (geo_word_doc_id_term_frequency_doc_frequency[0][0], (geo_word_doc_id_term_frequency_doc_frequency[1][0][0], geo_word_doc_id_term_frequency_doc_frequency[0][1], geo_word_doc_id_term_frequency_doc_frequency[1][0][1], geo_word_doc_id_term_frequency_doc_frequency[1][1] or unseen_doc_frequency)))
+
+        if isinstance(total_docs_by_geo, dict):
+            num_docs_by_geo = doc_word_counts.context.broadcast(total_docs_by_geo)
+            doc_ids_word_stats = geo_word_stats.map(lambda geo_doc_id_word_term_frequency_doc_frequency: (geo_doc_id_word_term_frequency_doc_frequency[1][0], (geo_doc_id_word_term_frequency_doc_frequency[0], geo_doc_id_word_term_frequency_doc_frequency[1][1], geo_doc_id_word_term_frequency_doc_frequency[1][2], geo_doc_id_word_term_frequency_doc_frequency[1][3], num_docs_by_geo.value.get(geo_doc_id_word_term_frequency_doc_frequency[0], unseen_num_docs))))
+        else:
+            doc_ids_word_stats = geo_word_stats.leftOuterJoin(total_docs_by_geo) \
+                                               .map(lambda geo_doc_id_word_term_frequency_doc_frequency_num_docs: (geo_doc_id_word_term_frequency_doc_frequency_num_docs[1][0][0], (geo_doc_id_word_term_frequency_doc_frequency_num_docs[0], geo_doc_id_word_term_frequency_doc_frequency_num_docs[1][0][1], geo_doc_id_word_term_frequency_doc_frequency_num_docs[1][0][2], geo_doc_id_word_term_frequency_doc_frequency_num_docs[1][0][3], geo_doc_id_word_term_frequency_doc_frequency_num_docs[1][1] or unseen_num_docs)))
 
         docs_tfidf = doc_ids_word_stats.groupByKey() \
                                        .mapValues(lambda vals: {word: TFIDF.tfidf_score(term_frequency, doc_frequency, num_docs)
                                                                 for geo, word, term_frequency, doc_frequency, num_docs in vals})
         return docs_tfidf.coalesce(num_partitions)
+
+
+DocFrequencyModel = namedtuple('DocFrequencyModel', 'doc_frequency, total_docs, geo_doc_frequency, total_docs_by_geo, geo_cells')
+DocFrequencyModel.__new__.__defaults__ = (None,)
+
+
+class TFIDFModelSpark(object):
+    '''
+    On-disk document frequency models so recurring jobs can reuse the counts
+    from prior runs instead of recomputing them. A model is a directory of
+    Parquet tables, the geo tables being present only if a geo model was built.
+
+    A model can be saved to the directory it was loaded from: the tables are
+    written to a temporary sibling directory, which only replaces the old
+    one once it's complete. Everything that still reads from the old model
+    has to have run by then (the job saves the model last).
+    '''
+    doc_frequency_dir = 'doc_frequency'
+    total_docs_dir = 'total_docs'
+    geo_doc_frequency_dir = 'geo_doc_frequency'
+    total_docs_by_geo_dir = 'total_docs_by_geo'
+    geo_cells_dir = 'geo_cells'
+
+    @classmethod
+    def save(cls, model, path):
+        sc = model.doc_frequency.context
+        path = path.rstrip('/')
+        temp_path = '{}.tmp-{}'.format(path, uuid.uuid4().hex)
+        cls.write(model, temp_path)
+        replace_path(sc, temp_path, path)
+
+    @classmethod
+    def write(cls, model, path):
+        sc = model.doc_frequency.context
+        TFIDFSpark.save_doc_frequency(model.doc_frequency, os.path.join(path, cls.doc_frequency_dir))
+        spark_session(sc).createDataFrame([(model.total_docs,)], ['total_docs']) \
+                         .write.mode('overwrite').parquet(os.path.join(path, cls.total_docs_dir))
+
+        if model.geo_doc_frequency is not None:
+            GeoTFIDFSpark.save_doc_frequency(model.geo_doc_frequency, os.path.join(path, cls.geo_doc_frequency_dir))
+        if model.total_docs_by_geo is not None:
+            GeoTFIDFSpark.save_total_docs_by_geo(model.total_docs_by_geo, os.path.join(path, cls.total_docs_by_geo_dir))
+        if model.geo_cells is not None:
+            GeoTFIDFSpark.save_total_docs_by_geo(sc.parallelize(list(model.geo_cells.items())), os.path.join(path, cls.geo_cells_dir))
+
+    @classmethod
+    def load(cls, sc, path, geo_model=True):
+        from pyspark.sql.utils import AnalysisException
+
+        doc_frequency = TFIDFSpark.load_doc_frequency(sc, os.path.join(path, cls.doc_frequency_dir))
+        total_docs = spark_session(sc).read.parquet(os.path.join(path, cls.total_docs_dir)).first()[0]
+
+        geo_doc_frequency = None
+        total_docs_by_geo = None
+        geo_cells = None
+        if geo_model:
+            geo_doc_frequency = GeoTFIDFSpark.load_doc_frequency(sc, os.path.join(path, cls.geo_doc_frequency_dir))
+            total_docs_by_geo = GeoTFIDFSpark.load_total_docs_by_geo(sc, os.path.join(path, cls.total_docs_by_geo_dir))
+            geo_cells_path = os.path.join(path, cls.geo_cells_dir)
+            try:
+                geo_cells = GeoTFIDFSpark.load_total_docs_by_geo(sc, geo_cells_path).collectAsMap()
+            except AnalysisException:
+                # models saved with fixed geohashes have no cells table
+                geo_cells = None
+
+        return DocFrequencyModel(doc_frequency, total_docs, geo_doc_frequency, total_docs_by_geo, geo_cells)
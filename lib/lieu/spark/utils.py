@@ -1,13 +1,220 @@
+import logging
+import six
+import uuid
+
+from collections import OrderedDict
+from six.moves import cPickle as pickle
+
+logger = logging.getLogger(__name__)
+
+
+def replace_path(sc, src, dst):
+    '''
+    Move the directory src to dst through the Hadoop FileSystem API, so it
+    works on HDFS and S3 as well as locally. An existing dst is first moved
+    aside and only deleted once src has taken its place, so if the move
+    fails, dst is put back and there is always a complete copy on disk.
+    '''
+    Path = sc._jvm.org.apache.hadoop.fs.Path
+    src_path = Path(src)
+    dst_path = Path(dst)
+    fs = dst_path.getFileSystem(sc._jsc.hadoopConfiguration())
+
+    backup_path = None
+    if fs.exists(dst_path):
+        backup_path = Path('{}.old-{}'.format(dst.rstrip('/'), uuid.uuid4().hex))
+        if not fs.rename(dst_path, backup_path):
+            raise IOError('Could not move {} aside'.format(dst))
+
+    if not fs.rename(src_path, dst_path):
+        if backup_path is not None:
+            fs.rename(backup_path, dst_path)
+        raise IOError('Could not move {} to {}'.format(src, dst))
+
+    if backup_path is not None:
+        fs.delete(backup_path, True)
 
 
 class IDPairRDD(object):
+    BROADCAST = 'broadcast'
+    COPARTITION = 'copartition'
+    BLOCK = 'block'
+
+    strategies = (BROADCAST, COPARTITION, BLOCK)
+
+    '''Value sides estimated to be smaller than this are broadcast to every executor'''
+    DEFAULT_BROADCAST_MAX_BYTES = 10 * 1024 * 1024
+
+    DEFAULT_SIZE_SAMPLE = 1000
+
     @classmethod
-    def join_pairs(cls, pairs, kvs):
-        result = pairs.join(kvs) \
-                      .map(lambda k1_k2_v1: (k1_k2_v1[1][0], (k1_k2_v1[0], k1_k2_v1[1][1])))
+    def estimate_bytes(cls, kvs, sample_size=DEFAULT_SIZE_SAMPLE):
+        '''
+        Estimated pickled size of an RDD from its count and the average size
+        of a sample. Both are actions, so kvs should be persisted if it's
+        used again, otherwise its whole lineage is computed twice more.
+        '''
+        num_records = kvs.count()
+        if not num_records:
+            return 0
+
+        sample = kvs.take(sample_size)
+        avg_record_bytes = float(sum((len(pickle.dumps(r, pickle.HIGHEST_PROTOCOL)) for r in sample))) / len(sample)
+        return int(num_records * avg_record_bytes)
+
+    @classmethod
+    def choose_strategy(cls, kvs, broadcast_max_bytes=DEFAULT_BROADCAST_MAX_BYTES):
+        if cls.estimate_bytes(kvs) <= broadcast_max_bytes:
+            return cls.BROADCAST
+        return cls.COPARTITION
+
+    @classmethod
+    def broadcast_join_pairs(cls, pairs, kvs):
+        '''Map-side hash join against a broadcast dict of the (small) value side, no shuffle at all'''
+        values = pairs.context.broadcast(kvs.collectAsMap())
+
+        return pairs.filter(lambda k1_k2: k1_k2[0] in values.value and k1_k2[1] in values.value) \
+                    .map(lambda k1_k2: ((k1_k2[0], k1_k2[1]), (values.value[k1_k2[0]], values.value[k1_k2[1]])))
+
+    @classmethod
+    def copartitioned_join_pairs(cls, pairs, kvs, num_partitions=None, persistence=None, name='partitioned_values'):
+        '''
+        Partition the value side by id once and keep it around, so both joins
+        only need to shuffle the (much smaller) pair side to it. The partitioned
+        copy is persisted as name through persistence (an RDDPersistence), so
+        the caller can release it once the joined pairs have been computed.
+        '''
+        if num_partitions is None:
+            num_partitions = kvs.getNumPartitions()
+
+        if kvs.partitioner is None or kvs.getNumPartitions() != num_partitions:
+            kvs = (persistence or RDDPersistence()).persist(kvs.partitionBy(num_partitions), name)
+
+        return pairs.partitionBy(num_partitions) \
+                    .join(kvs) \
+                    .map(lambda k1_k2_v1: (k1_k2_v1[1][0], (k1_k2_v1[0], k1_k2_v1[1][1]))) \
+                    .partitionBy(num_partitions) \
+                    .join(kvs) \
+                    .map(lambda k2_k1_v1_v2: ((k2_k1_v1_v2[1][0][0], k2_k1_v1_v2[0]), (k2_k1_v1_v2[1][0][1], k2_k1_v1_v2[1][1])))
+
+    @classmethod
+    def join_pairs(cls, pairs, kvs, strategy=None, broadcast_max_bytes=DEFAULT_BROADCAST_MAX_BYTES, persistence=None,
+                   name='partitioned_values'):
+        '''
+        Attach values to (uid1, uid2) pairs, returning ((uid1, uid2), (value1, value2)).
+        If no strategy is given, broadcast when the value side is estimated to be
+        small enough and co-partition otherwise (see copartitioned_join_pairs
+        for persistence and name).
+        '''
+        if strategy is None:
+            strategy = cls.choose_strategy(kvs, broadcast_max_bytes=broadcast_max_bytes)
+
+        if strategy == cls.BROADCAST:
+            return cls.broadcast_join_pairs(pairs, kvs)
+        elif strategy == cls.COPARTITION:
+            return cls.copartitioned_join_pairs(pairs, kvs, persistence=persistence, name=name)
+        else:
+            raise ValueError('Unsupported join strategy for pairs: {}'.format(strategy))
+
+
+class RDDPersistence(object):
+    '''
+    Deliberate persistence for RDDs that are consumed more than once, so each
+    reuse doesn't recompute the whole lineage. Long lineages can optionally be
+    checkpointed (requires checkpoint_dir). Everything persisted through here
+    is logged and can be released together once the job is done with it.
+    '''
+    DEFAULT_STORAGE_LEVEL = 'MEMORY_AND_DISK'
+
+    storage_levels = ('MEMORY_ONLY', 'MEMORY_ONLY_2', 'MEMORY_AND_DISK', 'MEMORY_AND_DISK_2', 'DISK_ONLY', 'DISK_ONLY_2', 'OFF_HEAP')
+
+    def __init__(self, storage_level=DEFAULT_STORAGE_LEVEL, checkpoint_dir=None):
+        self.storage_level = storage_level
+        self.checkpoint_dir = checkpoint_dir
+        self.rdds = OrderedDict()
+        self.checkpoint_dir_set = False
+
+    def persist(self, rdd, name, checkpoint=False, storage_level=None):
+        '''
+        An RDD that's already persisted (e.g. by another step) is returned
+        as is, since Spark can't change its storage level. It's left to
+        whatever persisted it to release it.
+        '''
+        from pyspark import StorageLevel
+
+        current_level = rdd.getStorageLevel()
+        if current_level.useMemory or current_level.useDisk or current_level.useOffHeap:
+            logger.info('RDD {} is already persisted with storage level {}'.format(name, current_level))
+            return rdd
+
+        storage_level = storage_level or self.storage_level
+        rdd.setName(name)
+        rdd.persist(getattr(StorageLevel, storage_level))
+
+        if checkpoint and self.checkpoint_dir:
+            if not self.checkpoint_dir_set:
+                rdd.context.setCheckpointDir(self.checkpoint_dir)
+                self.checkpoint_dir_set = True
+            rdd.checkpoint()
+
+        self.rdds[name] = rdd
+        logger.info('Persisting RDD {} with storage level {}{}'.format(name, storage_level, ', checkpointed' if checkpoint and self.checkpoint_dir else ''))
+        return rdd
+
+    def unpersist(self, name):
+        rdd = self.rdds.pop(name, None)
+        if rdd is not None:
+            rdd.unpersist()
+            logger.info('Unpersisted RDD {}'.format(name))
+
+    def unpersist_all(self):
+        for name in list(self.rdds):
+            self.unpersist(name)
+
+    def log_materialized(self):
+        for name, rdd in six.iteritems(self.rdds):
+            logger.info('RDD {}: storage level {}, checkpointed: {}'.format(name, rdd.getStorageLevel(), rdd.isCheckpointed()))
+
+
+class UidRangePartitioning(object):
+    '''
+    Partitions RDDs keyed by the sequential uids from zipWithIndex into
+    contiguous uid ranges, so the partitions are in input order and sorting
+    within each partition orders the whole output without a global sort.
+
+    RDDs partitioned through the same instance share a partitioner, so
+    cogroup only shuffles the sides that aren't already partitioned
+    (PySpark's own join/cogroup always hash partition both sides).
+    '''
+    def __init__(self, num_records, num_partitions):
+        self.num_partitions = num_partitions
+        num_records = max(num_records, 1)
+
+        # one function object for the lifetime of the partitioning, PySpark compares partitioners by it
+        self.partition_func = lambda uid: min(uid * num_partitions // num_records, num_partitions - 1)
+
+    def partition(self, rdd):
+        return rdd.partitionBy(self.num_partitions, self.partition_func)
+
+    def cogroup(self, *rdds):
+        '''
+        (uid, (values1, values2, ...)) with a list of values from each RDD,
+        for every uid in any of them
+        '''
+        num_rdds = len(rdds)
+        tagged = None
+        for i, rdd in enumerate(rdds):
+            rdd = self.partition(rdd).mapValues(lambda v, i=i: (i, v))
+            tagged = rdd if tagged is None else tagged.union(rdd)
+
+        def split(tagged_values):
+            values = tuple(([] for i in range(num_rdds)))
+            for i, v in tagged_values:
+                values[i].append(v)
+            return values
 
-        num_partitions = result.getNumPartitions()
+        return tagged.groupByKey(self.num_partitions, self.partition_func) \
+                     .mapValues(split)
 
-        return result.join(kvs) \
-                     .map(lambda k2_k1_v1_v2: ((k2_k1_v1_v2[0][0], k2_k1_v1_v2[0]), (k2_k1_v1_v2[0][1], k2_k1_v1_v2[1][1]))) \
-                     .coalesce(num_partitions)
+    def sort_within_partitions(self, rdd):
+        return rdd.repartitionAndSortWithinPartitions(self.num_partitions, self.partition_func)
@@ -0,0 +1,150 @@
+import geohash
+
+from collections import defaultdict, deque
+
+from lieu.address import Address, Coordinates
+from lieu.api import DedupeResponse
+from lieu.pipeline import DedupePipeline
+from lieu.tfidf import CountMinTFIDF
+
+
+class StreamingDeduper(object):
+    '''
+    Single-pass dedupe for input that's already ordered spatially (by
+    geohash or tile). Only a bounded window of recent records is indexed by
+    their near-dupe hashes, and each new record is compared to the window
+    candidates it shares a hash with.
+
+    Since the earlier record in a pair is always the canonical (as in the
+    command-line script), a record's response is complete as soon as it has
+    been compared, so responses are yielded immediately, in input order.
+
+    Records leave the window when it's over window_size, or when the input
+    moves on to a geohash cell (at window_precision) that isn't theirs or
+    one of its neighbors. The TF-IDF index is built from the records seen
+    so far (optionally on top of a saved index), so name similarities can
+    differ slightly from a batch run over the full data set.
+
+    The window bounds the records kept, but the TF-IDF index grows with
+    every distinct name token in the stream, so unless the pipeline sets
+    idf_memory_limit (or an index is passed in), document frequencies are
+    counted in a CountMinTFIDF of DEFAULT_IDF_MEMORY_LIMIT bytes.
+    Top-k candidates and exact signatures need the whole data set up
+    front and aren't used here.
+    '''
+    DEFAULT_WINDOW_SIZE = 10000
+    DEFAULT_WINDOW_PRECISION = 4
+    DEFAULT_IDF_MEMORY_LIMIT = 64 * 1024 * 1024
+
+    def __init__(self, pipeline=None, window_size=DEFAULT_WINDOW_SIZE, window_precision=DEFAULT_WINDOW_PRECISION, tfidf_index=None):
+        self.pipeline = pipeline or DedupePipeline()
+        self.window_size = window_size
+        self.window_precision = window_precision
+
+        if tfidf_index is None:
+            if self.pipeline.idf_memory_limit is None and not self.pipeline.address_only:
+                tfidf_index = CountMinTFIDF.from_memory(self.DEFAULT_IDF_MEMORY_LIMIT, min_count=self.pipeline.idf_min_count)
+            else:
+                tfidf_index = self.pipeline.new_tfidf_index()
+        self.tfidf_index = tfidf_index
+
+        self.explain = self.pipeline.explain()
+
+        self.window = deque()
+        self.cells = {}
+        self.addresses = {}
+        self.values = {}
+        self.hashes = {}
+        self.hash_index = defaultdict(list)
+        self.dupes = set()
+        self.current_cell = None
+
+    def cell(self, address):
+        lat = address.get(Coordinates.LATITUDE)
+        lon = address.get(Coordinates.LONGITUDE)
+        if lat is None or lon is None:
+            return None
+        return geohash.encode(lat, lon, precision=self.window_precision)
+
+    def evict(self, guid):
+        for h in self.hashes.pop(guid, ()):
+            guids = self.hash_index[h]
+            guids.remove(guid)
+            if not guids:
+                del self.hash_index[h]
+
+        self.cells.pop(guid, None)
+        self.addresses.pop(guid, None)
+        self.values.pop(guid, None)
+        self.dupes.discard(guid)
+
+    def evict_outside(self, cell):
+        if cell is None or cell == self.current_cell:
+            return
+
+        self.current_cell = cell
+        nearby = set(geohash.neighbors(cell))
+        nearby.add(cell)
+
+        window = deque()
+        for guid in self.window:
+            guid_cell = self.cells.get(guid)
+            if guid_cell is not None and guid_cell not in nearby:
+                self.evict(guid)
+            else:
+                window.append(guid)
+        self.window = window
+
+    def add(self, feature):
+        '''Compare a feature to the window, returning its response'''
+        DedupeResponse.add_random_guid(feature)
+        guid = feature['properties'][DedupeResponse.guid_key]
+
+        address = Address.from_geojson(feature)
+        hashes = self.pipeline.index_address(address, self.tfidf_index)
+        if hashes is None:
+            if self.pipeline.dupes_only:
+                return None
+            return self.pipeline.response(guid, feature, {}, self.dupes, self.values.get, explain=self.explain)
+
+        hashes = set(hashes)
+        cell = self.cell(address)
+        self.evict_outside(cell)
+        while self.window and len(self.window) >= self.window_size:
+            self.evict(self.window.popleft())
+
+        candidates = []
+        seen = set()
+        for h in hashes:
+            for candidate_guid in self.hash_index.get(h, ()):
+                if candidate_guid not in seen:
+                    seen.add(candidate_guid)
+                    candidates.append(candidate_guid)
+
+        self.addresses[guid] = address
+
+        dupe_pairs = defaultdict(set)
+        for canonical_guid in candidates:
+            for other_guid, canonical_guid, dupe_class, sim in self.pipeline.compare_block([canonical_guid, guid], self.addresses, self.tfidf_index):
+                dupe_pairs[guid].add((canonical_guid, dupe_class, sim))
+                if dupe_class in DedupeResponse.dupe_classifications:
+                    self.dupes.add(guid)
+
+        response = self.pipeline.response(guid, feature, dupe_pairs, self.dupes, self.values.get, explain=self.explain)
+
+        self.window.append(guid)
+        self.cells[guid] = cell
+        self.values[guid] = feature
+        self.hashes[guid] = hashes
+        for h in hashes:
+            self.hash_index[h].append(guid)
+
+        if self.pipeline.dupes_only and not dupe_pairs:
+            return None
+        return response
+
+    def dedupe(self, features):
+        for feature in features:
+            response = self.add(feature)
+            if response is not None:
+                yield response
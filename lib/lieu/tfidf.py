@@ -7,6 +7,7 @@ from collections import defaultdict
 
 from lieu.encoding import safe_encode, safe_decode
 from lieu.floats import isclose
+from lieu.sketch import CountMinSketch
 
 
 class TFIDF(object):
@@ -71,12 +72,15 @@ class TFIDF(object):
     def corpus_frequency(self, key):
         return self.idf_counts.get(key, 0)
 
+    def doc_frequency(self, key):
+        return self.idf_counts.get(key, 1.0)
+
     @classmethod
     def tfidf_score(cls, term_frequency, doc_frequency, total_docs):
         return math.log(term_frequency + 1.0) * (math.log(float(total_docs) / doc_frequency))
 
     def tfidf_vector(self, token_counts):
-        return [(w, self.tfidf_score(term_frequency=c, doc_frequency=self.idf_counts.get(w, 1.0), total_docs=self.N)) for w, c in token_counts.items()]
+        return [(w, self.tfidf_score(term_frequency=c, doc_frequency=self.doc_frequency(w), total_docs=self.N)) for w, c in token_counts.items()]
 
     @classmethod
     def normalized_tfidf_vector(cls, tfidf_vector):
@@ -85,3 +89,61 @@ class TFIDF(object):
         if isclose(norm, 0.0):
             return tfidf_vector
         return [(w, s / norm) for w, s in tfidf_vector]
+
+
+class CountMinTFIDF(TFIDF):
+    '''
+    TFIDF whose document frequencies are counted in a fixed-size
+    CountMinSketch rather than a dict of every token ever seen. Only the
+    terms whose estimated document frequency reaches min_count are kept
+    exactly (as the sketch's estimate) in idf_counts. There can be at most
+    (total doc/term pairs) / min_count of them, so the long tail of one-off
+    tokens never takes up memory.
+
+    Estimates only overcount, by at most sketch.error_bound() with
+    probability 1 - sketch.delta, so a rare term can occasionally be
+    promoted. The terms that aren't promoted all get rare_doc_frequency,
+    i.e. the highest idf, the same as unseen terms. Saved indexes contain
+    only the promoted terms, and load as a plain TFIDF.
+    '''
+    DEFAULT_MIN_COUNT = 5
+
+    def __init__(self, sketch, min_count=DEFAULT_MIN_COUNT, rare_doc_frequency=1.0):
+        super(CountMinTFIDF, self).__init__()
+        self.sketch = sketch
+        self.min_count = min_count
+        self.rare_doc_frequency = rare_doc_frequency
+        self.idf_counts = {}
+
+    @classmethod
+    def from_memory(cls, memory_limit, min_count=DEFAULT_MIN_COUNT, depth=CountMinSketch.DEFAULT_DEPTH):
+        return cls(CountMinSketch.from_memory(memory_limit, depth=depth), min_count=min_count)
+
+    def update(self, doc):
+        if self.finalized or not doc:
+            return
+
+        for feature in doc:
+            count = self.sketch.add(feature)
+            if count >= self.min_count:
+                self.idf_counts[feature] = count
+
+        self.N += 1
+
+    def read(self, f):
+        # saved counts go through the sketch too, so they add up with later updates
+        reader = csv.reader(f, delimiter='\t')
+        term_prefix_len = len(self.term_key_prefix)
+        for key, val in reader:
+            val = int(val)
+            key = safe_decode(key)
+            if key.startswith(self.term_key_prefix):
+                key = key[term_prefix_len:]
+                count = self.sketch.add(key, val)
+                if count >= self.min_count:
+                    self.idf_counts[key] = count
+            elif key == self.doc_count_key:
+                self.N += val
+
+    def doc_frequency(self, key):
+        return self.idf_counts.get(key, self.rare_doc_frequency)
@@ -0,0 +1,115 @@
+import multiprocessing
+import os
+import time
+
+from lieu import libpostal
+
+
+def fork_context():
+    '''Multiprocessing context that forks where forking is available'''
+    get_context = getattr(multiprocessing, 'get_context', None)
+    if get_context is None:
+        # Python 2 only forks on POSIX
+        return multiprocessing
+    try:
+        return get_context('fork')
+    except ValueError:
+        return get_context()
+
+
+def memory_usage():
+    '''
+    (rss, pss) of the current process in bytes, from /proc. PSS splits each
+    shared page between the processes sharing it, so across forked workers
+    it shows what copy-on-write actually saves, where RSS counts shared
+    pages in full for every worker. Either is None where it can't be read.
+    '''
+    rss = pss = None
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    pss = int(line.split()[1]) * 1024
+                    break
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+
+    return rss, pss
+
+
+def init_worker(stats_queue, fork_time, initializer, initargs):
+    start = time.time()
+    if initializer is not None:
+        initializer(*initargs)
+    rss, pss = memory_usage()
+    stats_queue.put({
+        'pid': os.getpid(),
+        'startup_seconds': time.time() - fork_time,
+        'init_seconds': time.time() - start,
+        'libpostal_loaded': libpostal.is_loaded(),
+        'rss': rss,
+        'pss': pss,
+    })
+
+
+class ForkWorkerPool(object):
+    '''
+    Process pool for workers that need libpostal and large shared state
+    (addresses, a TF-IDF index). libpostal is loaded once in the parent and
+    the workers are forked from it, so they share its models and whatever
+    was passed in initargs copy-on-write instead of each importing
+    libpostal and unpickling the state on startup.
+
+    After the workers have started, worker_stats() returns a dict per
+    worker of its pid, startup time (since the pool was created), time
+    spent in initializer, and RSS/PSS in bytes.
+    '''
+
+    def __init__(self, num_workers, initializer=None, initargs=(), preload_libpostal=True):
+        self.num_workers = num_workers
+
+        self.libpostal_seconds = None
+        if preload_libpostal:
+            self.libpostal_seconds = libpostal.load()
+
+        context = fork_context()
+        self.stats_queue = context.Queue()
+        self.stats = []
+
+        self.pool = context.Pool(num_workers, initializer=init_worker,
+                                 initargs=(self.stats_queue, time.time(), initializer, initargs))
+
+    def imap_unordered(self, func, iterable, chunksize=1):
+        return self.pool.imap_unordered(func, iterable, chunksize=chunksize)
+
+    def worker_stats(self, timeout=None):
+        '''Stats for each worker, waits (up to timeout seconds each) for workers that haven't reported'''
+        while len(self.stats) < self.num_workers:
+            try:
+                self.stats.append(self.stats_queue.get(timeout=timeout))
+            except Exception:
+                break
+        return self.stats
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
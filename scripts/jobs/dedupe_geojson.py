@@ -1,19 +1,46 @@
 import ujson as json
 from collections import Counter, defaultdict
 
+from six import itertools
+
+from lieu.address import Address, AddressComponents
 from lieu.api import DedupeResponse
-from lieu.address import Address
-from lieu.dedupe import NameDeduper
+from lieu.dedupe import AddressDeduper, VenueDeduper, Name
+from lieu.tfidf import TFIDF
 
 from lieu.spark.dedupe import AddressDeduperSpark, VenueDeduperSpark
-from lieu.spark.utils import IDPairRDD
+from lieu.spark.tfidf import TFIDFModelSpark
+from lieu.spark.utils import IDPairRDD, RDDPersistence
+from lieu.spark import io as spark_io
 
+from mrjob.compat import jobconf_from_env
 from mrjob.job import MRJob
+from mrjob.protocol import RawValueProtocol
+from mrjob.step import MRStep
 
 
 class DedupeVenuesJob(MRJob):
+    OUTPUT_PROTOCOL = RawValueProtocol
+
+    # the MapReduce steps rely on tagged values arriving in sorted order, see steps()
+    SORT_VALUES = True
+
+    DEFAULT_NUM_BUCKETS = 100
+
     def configure_options(self):
         super(DedupeVenuesJob, self).configure_options()
+        self.add_passthrough_option(
+            '--input-format',
+            choices=sorted(spark_io.formats),
+            default=spark_io.GeoJSONLines.name,
+            help='Input format: line-delimited GeoJSON or Parquet (only the address properties and coordinates are decoded for deduping)')
+
+        self.add_passthrough_option(
+            '--output-format',
+            choices=sorted(spark_io.formats),
+            default=spark_io.GeoJSONLines.name,
+            help='Output format for the responses')
+
         self.add_passthrough_option(
             '--address-only',
             default=False,
@@ -68,18 +95,322 @@ class DedupeVenuesJob(MRJob):
             action="store_true",
             help="Whether to include units in deduplication")
 
+        self.add_passthrough_option(
+            '--max-block-size',
+            type='int',
+            default=AddressDeduperSpark.DEFAULT_MAX_BLOCK_SIZE,
+            help='Blocks estimated to be larger than this are split into sub-blocks spread over many tasks')
+
+        self.add_passthrough_option(
+            '--join-strategy',
+            choices=IDPairRDD.strategies,
+            default=None,
+            help='How to attach name vectors to candidate venue pairs (chosen from size estimates by default)')
+
+        self.add_passthrough_option(
+            '--adaptive-geohash-cells',
+            default=False,
+            action="store_true",
+            help="Use density-adaptive cells for the geo model instead of fixed-precision geohashes. With --update-tfidf-model, this must match how the loaded model was built (the job fails otherwise)")
+
+        self.add_passthrough_option(
+            '--tfidf-model-dir',
+            default=None,
+            help='Directory of a document frequency model saved by a prior run, reused instead of counting from scratch')
+
+        self.add_passthrough_option(
+            '--update-tfidf-model',
+            default=False,
+            action="store_true",
+            help="Add this batch's counts to the model from --tfidf-model-dir (by default it's reused as is). Fails if the model's geo counts were built with the other kind of cells, see --adaptive-geohash-cells")
+
+        self.add_passthrough_option(
+            '--save-tfidf-model-dir',
+            default=None,
+            help='Directory to save the document frequency model used in this run (may be the same as --tfidf-model-dir)')
+
+        self.add_passthrough_option(
+            '--dataframe',
+            default=False,
+            action="store_true",
+            help="Score venue pairs with vectorized pandas UDFs over DataFrames (requires pyarrow and pandas on the executors)")
+
+        self.add_passthrough_option(
+            '--unordered-output',
+            default=False,
+            action="store_true",
+            help="Don't sort the responses within each output partition (partitions are still written in uid ranges)")
+
+        self.add_passthrough_option(
+            '--no-spark',
+            default=False,
+            action="store_true",
+            help="Run as plain MapReduce steps (Hadoop streaming or mrjob's local/inline runners) instead of Spark")
+
+        self.add_passthrough_option(
+            '--num-buckets',
+            type='int',
+            default=self.DEFAULT_NUM_BUCKETS,
+            help='Number of reducer buckets the doc count is broadcast to in the MapReduce steps')
+
+        self.add_passthrough_option(
+            '--storage-level',
+            choices=RDDPersistence.storage_levels,
+            default=RDDPersistence.DEFAULT_STORAGE_LEVEL,
+            help='Storage level for RDDs that are reused within the job (MEMORY_AND_DISK spills rather than recomputes)')
+
+        self.add_passthrough_option(
+            '--checkpoint-dir',
+            default=None,
+            help='Reliable storage (e.g. HDFS/S3) for checkpointing the scored pairs, truncating their lineage')
+
+    def steps(self):
+        '''
+        Without Spark, the job runs as five MapReduce steps:
+
+        1. parse each feature, assign a guid and note its input position, count name word doc frequencies (with combiners)
+        2. attach the doc frequencies and total doc count to each record and send it to its hash blocks
+        3. score the candidate pairs in each block
+        4. aggregate the pairs per guid and reply with each canonical record
+        5. join everything into one response per guid
+
+        Values are tagged so SORT_VALUES delivers counts before the records that need them.
+        '''
+        if not self.options.no_spark:
+            return super(DedupeVenuesJob, self).steps()
+
+        return [
+            MRStep(mapper_init=self.parse_mapper_init,
+                   mapper=self.parse_mapper,
+                   mapper_final=self.parse_mapper_final,
+                   combiner=self.count_combiner,
+                   reducer=self.doc_frequency_reducer),
+            MRStep(mapper=self.bucket_mapper,
+                   reducer=self.bucket_reducer),
+            MRStep(reducer=self.block_reducer),
+            MRStep(reducer=self.pair_reducer),
+            MRStep(reducer=self.response_reducer),
+        ]
+
+    def parse_mapper_init(self):
+        self.num_docs = 0
+        # (input file, split offset, line in split) sorts in input order, unlike the random guids
+        self.input_file = jobconf_from_env('mapreduce.map.input.file', '')
+        self.input_start = int(jobconf_from_env('mapreduce.map.input.start', 0))
+        self.line_index = 0
+
+    def parse_mapper(self, _, line):
+        feature = json.loads(line)
+        guid = DedupeResponse.random_guid()
+        DedupeResponse.add_guid(feature, guid)
+
+        position = [self.input_file, self.input_start, self.line_index]
+        self.line_index += 1
+
+        address = Address.from_geojson(feature)
+        hashes = []
+        tokens = []
+
+        if not self.options.address_only:
+            name = address.get(AddressComponents.NAME)
+            if name:
+                tokens = Name.content_tokens(name)
+                hashes = VenueDeduper.near_dupe_hashes(address, with_latlon=not self.options.no_latlon, with_city_or_equivalent=self.options.use_city,
+                                                       with_postal_code=self.options.use_postal_code)
+        else:
+            hashes = AddressDeduper.near_dupe_hashes(address, with_latlon=not self.options.no_latlon, with_city_or_equivalent=self.options.use_city,
+                                                     with_postal_code=self.options.use_postal_code)
+
+        yield ['guid', guid], ['record', json.dumps(feature), position, Address.to_tuple(address), list(hashes)]
+
+        if tokens:
+            self.num_docs += 1
+            for word in set(tokens):
+                yield ['word', word], ['count', 1]
+                yield ['word', word], ['doc', guid]
+
+    def parse_mapper_final(self):
+        if self.num_docs:
+            yield ['docs', None], ['count', self.num_docs]
+
+    def count_combiner(self, key, values):
+        count = 0
+        for value in values:
+            if value[0] == 'count':
+                count += value[1]
+            else:
+                yield key, value
+        if count:
+            yield key, ['count', count]
+
+    def doc_frequency_reducer(self, key, values):
+        key_type, k = key
+        if key_type == 'guid':
+            for value in values:
+                yield key, value
+            return
+
+        # 'count' sorts before 'doc'
+        count = 0
+        for value in values:
+            if value[0] == 'count':
+                count += value[1]
+            elif key_type == 'word':
+                yield ['guid', value[1]], ['df', k, count]
+
+        if key_type == 'docs':
+            yield key, count
+
+    def bucket(self, guid):
+        return int(guid, 16) % self.options.num_buckets
+
+    def bucket_mapper(self, key, value):
+        key_type, k = key
+        if key_type == 'docs':
+            # an empty tag sorts before the guids, so each bucket sees the count first
+            for bucket in range(self.options.num_buckets):
+                yield bucket, ['', value]
+        else:
+            yield self.bucket(k), [k, value]
+
+    def bucket_blocks(self, guid, record, doc_frequencies, total_docs):
+        if record is None:
+            return
+        line, position, address, hashes = record
+        yield ['guid', guid], ['record', line]
+        for h in hashes:
+            yield ['block', h], [guid, position, address, doc_frequencies, total_docs]
+
+    def bucket_reducer(self, bucket, values):
+        '''
+        Each bucket gets the total doc count first, then every value for its
+        guids grouped by guid, so records are assembled one at a time
+        '''
+        total_docs = 0
+        guid = None
+        record = None
+        doc_frequencies = {}
+
+        for value_guid, value in values:
+            if value_guid == '':
+                total_docs += value
+                continue
+
+            if value_guid != guid:
+                for kv in self.bucket_blocks(guid, record, doc_frequencies, total_docs):
+                    yield kv
+                guid = value_guid
+                record = None
+                doc_frequencies = {}
+
+            if value[0] == 'record':
+                record = value[1:]
+            elif value[0] == 'df':
+                doc_frequencies[value[1]] = value[2]
+
+        for kv in self.bucket_blocks(guid, record, doc_frequencies, total_docs):
+            yield kv
+
+    def pair_dupe_class_and_sim(self, canonical, other):
+        _, _, canonical_address, canonical_doc_frequencies, total_docs = canonical
+        _, _, other_address, other_doc_frequencies, _ = other
+
+        canonical_address = Address.from_tuple(canonical_address)
+        other_address = Address.from_tuple(other_address)
+
+        if self.options.address_only:
+            if AddressDeduper.is_dupe(canonical_address, other_address, with_unit=self.options.with_unit):
+                return DedupeResponse.classifications.EXACT_DUPE, 1.0
+            return None, 0.0
+
+        # the same index the command-line script would build, restricted to the pair's words
+        tfidf = TFIDF()
+        tfidf.idf_counts.update(canonical_doc_frequencies)
+        tfidf.idf_counts.update(other_doc_frequencies)
+        tfidf.N = total_docs
+
+        return VenueDeduper.dupe_class_and_sim(canonical_address, other_address, tfidf=tfidf,
+                                               likely_dupe_threshold=self.options.name_dupe_threshold,
+                                               needs_review_threshold=self.options.name_review_threshold,
+                                               with_unit=self.options.with_unit)
+
+    def block_reducer(self, key, values):
+        key_type, k = key
+        if key_type == 'guid':
+            for value in values:
+                yield key, value
+            return
+
+        # the record that comes first in the input is the canonical one, as in the command-line script
+        candidates = sorted(values, key=lambda value: (value[1], value[0]))
+        for canonical, other in itertools.combinations(candidates, 2):
+            dupe_class, sim = self.pair_dupe_class_and_sim(canonical, other)
+            if dupe_class is None:
+                continue
+            yield ['guid', other[0]], ['pair', canonical[0], dupe_class, sim]
+            yield ['guid', canonical[0]], ['same_as', other[0], dupe_class, sim]
+
+    def pair_reducer(self, key, values):
+        '''
+        Dedupes the pairs found in multiple blocks, decides whether the guid
+        is a dupe itself and replies to the guids that pointed at it
+        '''
+        record = None
+        pairs = set()
+        same_as = set()
+
+        for value in values:
+            if value[0] == 'record':
+                record = value[1]
+            elif value[0] == 'pair':
+                pairs.add(tuple(value[1:]))
+            elif value[0] == 'same_as':
+                same_as.add(tuple(value[1:]))
+
+        if record is None:
+            return
+
+        is_dupe = any((dupe_class in DedupeResponse.dupe_classifications for other_guid, dupe_class, sim in pairs))
+        yield key, ['record', record, is_dupe, len(pairs)]
+
+        for other_guid, dupe_class, sim in same_as:
+            yield ['guid', other_guid], ['other', record, dupe_class, not is_dupe, sim]
+
+    def response_reducer(self, key, values):
+        record = None
+        others = []
+        for value in values:
+            if value[0] == 'record':
+                record, is_dupe, num_pairs = value[1:]
+            elif value[0] == 'other':
+                others.append(value[1:])
+
+        if record is None or (self.options.dupes_only and not num_pairs):
+            return
+
+        if not self.options.address_only:
+            explain = DedupeResponse.explain_venue_dupe(name_likely_dupe_threshold=self.options.name_dupe_threshold,
+                                                        name_needs_review_threshold=self.options.name_review_threshold,
+                                                        with_unit=self.options.with_unit)
+        else:
+            explain = DedupeResponse.explain_address_dupe(with_unit=self.options.with_unit)
+
+        response = DedupeResponse.create(json.loads(record), is_dupe=is_dupe, explain=explain,
+                                         same_as=[(json.loads(other), dupe_class, is_canonical, sim) for other, dupe_class, is_canonical, sim in others])
+
+        yield None, json.dumps(response)
+
     def spark(self, input_path, output_path):
         from pyspark import SparkContext
 
         sc = SparkContext(appName='dedupe venues MRJob')
 
-        lines = sc.textFile(input_path)
-
-        geojson_lines = lines.map(lambda line: json.loads(line.rstrip()))
-        geojson_ids = geojson_lines.cache().zipWithIndex()
-        id_geojson = geojson_ids.map(lambda geojson_uid: (geojson_uid[1], geojson_uid[0]))
+        persistence = RDDPersistence(storage_level=self.options.storage_level,
+                                     checkpoint_dir=self.options.checkpoint_dir)
 
-        address_ids = geojson_ids.map(lambda geojson_uid1: (Address.from_geojson(geojson_uid1[0]), geojson_uid1[1]))
+        # the original GeoJSON is carried as a JSON string and only parsed again to build the output
+        address_ids, id_geojson = spark_io.formats[self.options.input_format].read(sc, input_path, persistence)
+        address_ids = persistence.persist(address_ids, 'address_ids')
 
         geo_model = not self.options.no_geo_model
 
@@ -87,55 +418,59 @@ class DedupeVenuesJob(MRJob):
         use_latlon = not self.options.no_latlon
         use_city = self.options.use_city
         use_postal_code = self.options.use_postal_code
+        max_block_size = self.options.max_block_size
 
+        model = None
         if not self.options.address_only:
-            dupes_with_classes_and_sims = VenueDeduperSpark.dupe_sims(address_ids, geo_model=geo_model, use_latlon=use_latlon, use_city=use_city, use_postal_code=use_postal_code)
+            if self.options.tfidf_model_dir:
+                model = TFIDFModelSpark.load(sc, self.options.tfidf_model_dir, geo_model=geo_model)
+
+            model = VenueDeduperSpark.doc_frequency_model(address_ids, geo_model=geo_model, model=model,
+                                                          update=model is None or self.options.update_tfidf_model,
+                                                          adaptive_geo_cells=self.options.adaptive_geohash_cells)
+
+            # the frequency tables are read by the name vectors, possibly the join size estimate and the save
+            model = model._replace(doc_frequency=persistence.persist(model.doc_frequency, 'doc_frequency'))
+            if geo_model:
+                model = model._replace(geo_doc_frequency=persistence.persist(model.geo_doc_frequency, 'geo_doc_frequency'),
+                                       total_docs_by_geo=persistence.persist(model.total_docs_by_geo, 'total_docs_by_geo'))
+
+            if self.options.dataframe:
+                from lieu.spark.dataframe import VenueDeduperSparkDF
+                venue_deduper = VenueDeduperSparkDF
+            else:
+                venue_deduper = VenueDeduperSpark
+
+            dupes_with_classes_and_sims = venue_deduper.dupe_sims(address_ids, geo_model=geo_model, use_latlon=use_latlon, use_city=use_city, use_postal_code=use_postal_code,
+                                                                  max_block_size=max_block_size, join_strategy=self.options.join_strategy,
+                                                                  model=model, update_doc_frequencies=False,
+                                                                  adaptive_geo_cells=self.options.adaptive_geohash_cells,
+                                                                  persistence=persistence)
         else:
-            dupes_with_classes_and_sims = AddressDeduperSpark.dupe_sims(address_ids, geo_model=geo_model, use_latlon=use_latlon, use_city=use_city, use_postal_code=use_postal_code)
-
-        dupes = dupes_with_classes_and_sims.filter(lambda uid1_uid2_classification_sim: uid1_uid2_classification_sim[1][0] in (DedupeResponse.classifications.EXACT_DUPE, DedupeResponse.classifications.LIKELY_DUPE)) \
-                                           .map(lambda uid1_uid2_classification_sim2: (uid1_uid2_classification_sim2[0][0], True)) \
-                                           .distinct()
-
-        possible_dupe_pairs = dupes_with_classes_and_sims.map(lambda uid1_uid2_classification_sim3: (uid1_uid2_classification_sim3[0][0], True)) \
-                                                         .distinct()
+            dupes_with_classes_and_sims = AddressDeduperSpark.dupe_sims(address_ids, use_latlon=use_latlon, use_city=use_city, use_postal_code=use_postal_code,
+                                                                        max_block_size=max_block_size, persistence=persistence)
 
-        canonicals = dupes_with_classes_and_sims.map(lambda uid1_uid2_classification_sim4: (uid1_uid2_classification_sim4[0][1], (uid1_uid2_classification_sim4[0][0], uid1_uid2_classification_sim4[1][0], uid1_uid2_classification_sim4[1][1]))) \
-                                                .subtractByKey(dupes) \
-                                                .map(lambda uid2_uid1_classification_sim: (uid2_uid1_classification_sim[0], True)) \
-                                                .distinct()
-
-        dupes_with_canonical = dupes_with_classes_and_sims.map(lambda uid1_uid2_classification_sim5: (uid1_uid2_classification_sim5[0][1], (uid1_uid2_classification_sim5[0][0], uid1_uid2_classification_sim5[1][0], uid1_uid2_classification_sim5[1][1]))) \
-                                                          .leftOuterJoin(canonicals) \
-                                                          .map(lambda uid2_uid1_classification_sim_is_canonical: ((uid2_uid1_classification_sim_is_canonical[0][0], uid2_uid1_classification_sim_is_canonical[0]), (uid2_uid1_classification_sim_is_canonical[0][1], uid2_uid1_classification_sim_is_canonical[1][1] or False, uid2_uid1_classification_sim_is_canonical[0][2])))
+        # scored pairs feed both output cogroups, checkpoint so neither of them replays the blocking
+        dupes_with_classes_and_sims = persistence.persist(dupes_with_classes_and_sims, 'dupes_with_classes_and_sims', checkpoint=True)
 
         if not self.options.address_only:
-            explain = DedupeResponse.explain_venue_dupe(name_dupe_threshold=self.options.name_dupe_threshold,
-                                                        name_review_threshold=self.options.name_review_threshold,
+            explain = DedupeResponse.explain_venue_dupe(name_likely_dupe_threshold=self.options.name_dupe_threshold,
+                                                        name_needs_review_threshold=self.options.name_review_threshold,
                                                         with_unit=self.options.with_unit)
         else:
             explain = DedupeResponse.explain_address_dupe(with_unit=self.options.with_unit)
 
-        dupe_responses = dupes_with_canonical.map(lambda uid1_uid2_classification_is_canonical_sim: ((uid1_uid2_classification_is_canonical_sim[0][1], (uid1_uid2_classification_is_canonical_sim[0][0], uid1_uid2_classification_is_canonical_sim[1][0], uid1_uid2_classification_is_canonical_sim[1][1], uid1_uid2_classification_is_canonical_sim[1][2])))) \
-                                             .join(id_geojson) \
-                                             .map(lambda uid2_uid1_classification_is_canonical_sim_val2: (uid2_uid1_classification_is_canonical_sim_val2[0][0], (uid2_uid1_classification_is_canonical_sim_val2[1][1], uid2_uid1_classification_is_canonical_sim_val2[0][1], uid2_uid1_classification_is_canonical_sim_val2[0][2], uid2_uid1_classification_is_canonical_sim_val2[0][3]))) \
-                                             .groupByKey() \
-                                             .leftOuterJoin(dupes) \
-                                             .join(id_geojson) \
-                                             .map(lambda uid1_same_as_is_dupe_value: (uid1_same_as_is_dupe_value[0], DedupeResponse.create(uid1_same_as_is_dupe_value[1][1], uid1_same_as_is_dupe_value[0][1]=uid1_same_as_is_dupe_value[0][1] or False, add_random_guid=True, uid1_same_as_is_dupe_value[0][0]=uid1_same_as_is_dupe_value[0][0], explain=explain)))
-
-        if dupes_only:
-            all_responses = list(dupe_responses.values()) \
-                                          .map(lambda response: json.dumps(response))
-        else:
-            non_dupe_responses = id_geojson.subtractByKey(possible_dupe_pairs) \
-                                           .map(lambda uid_value: (uid_value[0], DedupeResponse.base_response(uid_value[1], is_dupe=False)))
+        all_responses = spark_io.DedupeResponses.responses(dupes_with_classes_and_sims, id_geojson, explain=explain, dupes_only=dupes_only,
+                                                           ordered=not self.options.unordered_output, persistence=persistence)
+
+        spark_io.formats[self.options.output_format].write(all_responses, output_path, persistence=persistence)
 
-            all_responses = list(non_dupe_responses.union(dupe_responses) \
-                                              .sortByKey().values()) \
-                                              .map(lambda response: json.dumps(response))
+        # saved last, since it may replace the model directory everything above was read from
+        if model is not None and self.options.save_tfidf_model_dir:
+            TFIDFModelSpark.save(model, self.options.save_tfidf_model_dir)
 
-        all_responses.saveAsTextFile(output_path)
+        persistence.log_materialized()
+        persistence.unpersist_all()
 
         sc.stop()
 
@@ -14,7 +14,7 @@ def main():
         ],
         package_dir={'': 'lib'},
         packages=find_packages('lib'),
-        scripts=['scripts/dedupe_geojson'],
+        scripts=['scripts/dedupe_geojson', 'scripts/evaluate_dedupe'],
         zip_safe=False,
         url='https://github.com/openvenues/lieu',
         description='Dedupe addresses and venues around the world with libpostal',
@@ -0,0 +1,77 @@
+import unittest
+
+try:
+    import postal.dedupe
+    import fuzzy
+    have_postal = True
+except ImportError:
+    have_postal = False
+
+import ujson as json
+
+from lieu.api import DedupeResponse
+from lieu.encoding import safe_encode
+
+
+EXACT_DUPE = DedupeResponse.classifications.EXACT_DUPE
+LIKELY_DUPE = DedupeResponse.classifications.LIKELY_DUPE
+NEEDS_REVIEW = DedupeResponse.classifications.NEEDS_REVIEW
+
+
+def feature(guid, name, lat, lon):
+    return {
+        'type': 'Feature',
+        'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+        'properties': {'name': name, 'addr:housenumber': u'7', 'addr:street': u'Carmine St', DedupeResponse.guid_key: guid},
+    }
+
+
+FEATURES = {
+    'a': feature('a', u"Joe's Pizza", 40.73056, -74.00214),
+    'b': feature('b', u'Joes Pizza', 40.73057, -74.00215),
+    'c': feature('c', u"Joe's Pizza Restaurant", 40.73056, -74.00214),
+    'd': feature('d', u'Joë\'s Pizzeria', 40.73055, -74.00213),
+    'e': feature('e', u"Joe's", 40.73056, -74.00214),
+}
+
+DUPE_PAIRS = {
+    'b': [('a', LIKELY_DUPE, 0.95), ('c', NEEDS_REVIEW, 0.72), ('d', NEEDS_REVIEW, 0.81), ('e', NEEDS_REVIEW, 0.72)],
+    'c': [('a', EXACT_DUPE, None)],
+    'd': [('c', LIKELY_DUPE, 1.0000000000000002)],
+}
+
+DUPES = set(['b', 'c', 'd'])
+
+
+@unittest.skipUnless(have_postal, 'requires the libpostal Python bindings')
+class TestRawResponse(unittest.TestCase):
+    '''Responses spliced from stored JSON are byte for byte the serialized parsed response'''
+
+    def setUp(self):
+        from lieu.pipeline import DedupePipeline
+        self.pipeline = DedupePipeline()
+        self.raw_features = {guid: json.dumps(value) for guid, value in FEATURES.items()}
+
+    def assert_same_response(self, guid, explain=None):
+        raw_explain = safe_encode(json.dumps(explain)) if explain else None
+        raw = self.pipeline.raw_response(guid, self.raw_features[guid], DUPE_PAIRS, DUPES, self.raw_features.get, raw_explain=raw_explain)
+
+        values = {other_guid: json.loads(value) for other_guid, value in self.raw_features.items()}
+        response = self.pipeline.response(guid, values[guid], DUPE_PAIRS, DUPES, values.get, explain=explain)
+
+        self.assertEqual(raw, safe_encode(json.dumps(response)))
+
+    def test_unpaired(self):
+        self.assert_same_response('a')
+
+    def test_dupes_and_possible_dupes(self):
+        for guid in DUPE_PAIRS:
+            self.assert_same_response(guid)
+
+    def test_explain(self):
+        for guid in DUPE_PAIRS:
+            self.assert_same_response(guid, explain=self.pipeline.explain())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+try:
+    import leveldb
+    import geohash
+    import postal.dedupe
+    have_cli_deps = True
+except ImportError:
+    have_cli_deps = False
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(REPO_DIR, 'scripts', 'dedupe_geojson')
+
+
+def feature(name, house_number, street, lat, lon):
+    return {
+        'type': 'Feature',
+        'properties': {
+            'name': name,
+            'addr:housenumber': house_number,
+            'addr:street': street,
+        },
+        'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+    }
+
+
+FEATURES = [
+    feature(u"Joe's Pizza", u'7', u'Carmine St', 40.73056, -74.00214),
+    feature(u'Murrays Bagels', u'500', u'6th Ave', 40.73528, -73.99780),
+    feature(u"Joe's Pizza", u'7', u'Carmine Street', 40.73057, -74.00215),
+    feature(u"Joe's Pizza Restaurant", u'7', u'Carmine St', 40.73056, -74.00214),
+    feature(u'Joes Pizza', u'7', u'Carmine St', 40.73055, -74.00213),
+    feature(u'Murrays Bagels', u'500', u'Sixth Avenue', 40.73529, -73.99781),
+    feature(u'Starbucks', u'500', u'6th Ave', 40.73528, -73.99780),
+]
+
+
+def comparable(response):
+    '''Response without the random guids, with same_as in a fixed order (possibly_same_as is already sorted)'''
+    from lieu.api import DedupeResponse
+
+    response['object']['properties'].pop(DedupeResponse.guid_key, None)
+    for key in ('same_as', 'possibly_same_as'):
+        for dupe in response.get(key, []):
+            dupe['object']['properties'].pop(DedupeResponse.guid_key, None)
+    if 'same_as' in response:
+        response['same_as'].sort(key=lambda dupe: json.dumps(dupe, sort_keys=True))
+    return response
+
+
+@unittest.skipUnless(have_cli_deps, 'requires leveldb, the geohash module and the libpostal Python bindings')
+class TestCommandLine(unittest.TestCase):
+    '''The command-line script and DedupePipeline give the same responses for the same file'''
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.input_path = os.path.join(self.temp_dir, 'venues.geojson')
+        with open(self.input_path, 'w') as f:
+            for feat in FEATURES:
+                f.write(json.dumps(feat) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def run_script(self, *args):
+        output_dir = os.path.join(self.temp_dir, 'deduped')
+        os.mkdir(output_dir)
+
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([os.path.join(REPO_DIR, 'lib')] + [p for p in [env.get('PYTHONPATH')] if p])
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call([sys.executable, SCRIPT, self.input_path, '-o', output_dir] + list(args), env=env, stdout=devnull)
+
+        with open(os.path.join(output_dir, 'deduped.geojson')) as f:
+            return [comparable(json.loads(line)) for line in f]
+
+    def pipeline_responses(self, **kw):
+        from lieu.pipeline import DedupePipeline
+
+        return [comparable(r) for r in DedupePipeline(**kw).dedupe(json.loads(json.dumps(f)) for f in FEATURES)]
+
+    def test_same_output(self):
+        responses = self.run_script()
+        self.assertEqual(len(responses), len(FEATURES))
+        self.assertEqual(responses, self.pipeline_responses())
+        self.assertTrue(any(('same_as' in r for r in responses)))
+
+    def test_same_output_review_threshold(self):
+        # a low review threshold so possibly_same_as has more than one entry to order
+        responses = self.run_script('--name-review-threshold', '0.1')
+        self.assertEqual(responses, self.pipeline_responses(name_review_threshold=0.1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+import unittest
+
+try:
+    import postal.dedupe
+    have_postal = True
+except ImportError:
+    have_postal = False
+
+from lieu.address import AddressComponents, Coordinates, VenueDetails
+from lieu.api import DedupeResponse
+from lieu.contact import Contact
+
+
+def venue(phone=None, website=None, lat=51.5194, lon=-0.1270):
+    address = {Coordinates.LATITUDE: lat, Coordinates.LONGITUDE: lon}
+    if phone is not None:
+        address[VenueDetails.PHONE] = phone
+    if website is not None:
+        address[VenueDetails.WEBSITE] = website
+    return address
+
+
+class TestPhoneNumbers(unittest.TestCase):
+    def test_normalization(self):
+        self.assertEqual(Contact.phone_number(u'+1 (212) 555-0100'), u'12125550100')
+        self.assertEqual(Contact.phone_number(u'212.555.0100'), u'2125550100')
+        self.assertEqual(Contact.phone_number(u'212/555-0100'), u'2125550100')
+        self.assertEqual(Contact.phone_number(u'020 7946 0000'), u'2079460000')
+        self.assertEqual(Contact.phone_number(u'0044 20 7946 0000'), u'442079460000')
+        self.assertIsNone(Contact.phone_number(u'555-01'))
+        self.assertIsNone(Contact.phone_number(u'000 0001'))
+
+    def test_split(self):
+        self.assertEqual(Contact.phone_numbers(venue(phone=u'+1 212 555 0100; +1 212 555 0101')),
+                         frozenset([u'12125550100', u'12125550101']))
+        self.assertEqual(Contact.phone_numbers(venue(phone=u'212-555-0100 ext 12')), frozenset([u'2125550100']))
+        self.assertEqual(Contact.phone_numbers(venue(phone=[u'212 555 0100', 2125550101])), frozenset([u'2125550100', u'2125550101']))
+        self.assertEqual(Contact.phone_numbers(venue()), frozenset())
+
+    def test_suffix_match(self):
+        self.assertTrue(Contact.phone_numbers_match(u'2079460000', u'442079460000'))
+        self.assertTrue(Contact.phone_numbers_match(u'12125550100', u'2125550100'))
+        self.assertTrue(Contact.phone_numbers_match(u'5550100', u'2125550100'))
+        self.assertFalse(Contact.phone_numbers_match(u'2125550100', u'2125550101'))
+        self.assertFalse(Contact.phone_numbers_match(u'2125550100', u'3125550100'))
+
+    def test_phone_match(self):
+        # country code and trunk prefix
+        self.assertTrue(Contact.phone_match(venue(phone=u'+44 20 7946 0000'), venue(phone=u'020 7946 0000')))
+        # any shared number
+        self.assertTrue(Contact.phone_match(venue(phone=u'212 555 0100; 212 555 0199'), venue(phone=u'(212) 555-0199')))
+        # same length, different numbers
+        self.assertIs(Contact.phone_match(venue(phone=u'212 555 0100'), venue(phone=u'212 555 0101')), False)
+        # different lengths that don't match aren't a conflict
+        self.assertIsNone(Contact.phone_match(venue(phone=u'+1 212 555 0100'), venue(phone=u'555 0101')))
+        self.assertIsNone(Contact.phone_match(venue(phone=u'212 555 0100'), venue()))
+
+
+class TestWebsites(unittest.TestCase):
+    def test_registrable_domain(self):
+        self.assertEqual(Contact.website_domain(u'https://www.JoesPizza.com/menu?x=1'), u'joespizza.com')
+        self.assertEqual(Contact.website_domain(u'order.joespizza.com'), u'joespizza.com')
+        self.assertEqual(Contact.website_domain(u'http://joespizza.com:8080'), u'joespizza.com')
+        self.assertEqual(Contact.website_domain(u'www.joespizza.co.uk/contact'), u'joespizza.co.uk')
+        self.assertEqual(Contact.website_domain(u'shop.joespizza.com.au'), u'joespizza.com.au')
+        self.assertEqual(Contact.website_domain(u'joespizza.de'), u'joespizza.de')
+        self.assertIsNone(Contact.website_domain(u'localhost'))
+        self.assertIsNone(Contact.website_domain(u'http://192.168.0.1/'))
+
+    def test_shared_domains(self):
+        self.assertIsNone(Contact.website_domain(u'https://m.facebook.com/joespizza'))
+        self.assertIsNone(Contact.website_domain(u'joespizza.blogspot.com'))
+        self.assertIsNone(Contact.website_domain(u'sites.google.com/view/joespizza'))
+
+    def test_website_match(self):
+        self.assertTrue(Contact.website_match(venue(website=u'http://www.joespizza.com'), venue(website=u'order.joespizza.com/online')))
+        self.assertIs(Contact.website_match(venue(website=u'joespizza.com'), venue(website=u'katzsdeli.com')), False)
+        self.assertIsNone(Contact.website_match(venue(website=u'facebook.com/joespizza'), venue(website=u'joespizza.com')))
+
+
+class TestHashes(unittest.TestCase):
+    def test_matching_numbers_share_a_key(self):
+        hashes1 = set(Contact.hashes(venue(phone=u'+44 20 7946 0000')))
+        hashes2 = set(Contact.hashes(venue(phone=u'020 7946 0000')))
+        self.assertTrue(hashes1 & hashes2)
+
+    def test_own_cell_only(self):
+        hashes = Contact.hashes(venue(phone=u'212 555 0100', website=u'joespizza.com'))
+        self.assertEqual(len(hashes), 2)
+        self.assertEqual(len(set((h.split(u'|')[1] for h in hashes))), 1)
+
+    def test_no_coordinates(self):
+        self.assertEqual(Contact.hashes({VenueDetails.PHONE: u'212 555 0100'}), [])
+
+
+def named_venue(name, phone=None, website=None):
+    address = venue(phone=phone, website=website)
+    address.update({
+        AddressComponents.NAME: name,
+        AddressComponents.HOUSE_NUMBER: u'7',
+        AddressComponents.STREET: u'Carmine St',
+    })
+    return address
+
+
+@unittest.skipUnless(have_postal, 'requires the libpostal Python bindings')
+class TestContactSignals(unittest.TestCase):
+    '''Phone numbers promote similar names and websites only lower a pair to needs review'''
+
+    def classification(self, a1, a2, contact_signals=True):
+        from lieu.dedupe import VenueDeduper
+        dupe_class, sim = VenueDeduper.dupe_class_and_sim(a1, a2, contact_signals=contact_signals)
+        return dupe_class
+
+    def test_phone_match_similar_names(self):
+        a1 = named_venue(u"Joe's Pizza", phone=u'212 555 0100')
+        a2 = named_venue(u"Joe's Pizza Restaurant", phone=u'(212) 555-0100')
+        self.assertIn(self.classification(a1, a2, contact_signals=False),
+                      (DedupeResponse.classifications.LIKELY_DUPE, DedupeResponse.classifications.NEEDS_REVIEW))
+        self.assertEqual(self.classification(a1, a2), DedupeResponse.classifications.LIKELY_DUPE)
+
+    def test_phone_match_dissimilar_names(self):
+        a1 = named_venue(u"Joe's Pizza", phone=u'212 555 0100')
+        a2 = named_venue(u'Chase Bank', phone=u'212 555 0100')
+        self.assertIsNone(self.classification(a1, a2))
+
+    def test_phone_conflict(self):
+        a1 = named_venue(u"Joe's Pizza", phone=u'212 555 0100')
+        a2 = named_venue(u"Joe's Pizza Restaurant", phone=u'212 555 0101')
+        self.assertIsNone(self.classification(a1, a2))
+
+    def test_website_conflict(self):
+        a1 = named_venue(u"Saint Mark's Bookshop", website=u'stmarksbookshop.com')
+        a2 = named_venue(u"St Mark's Bookshop", website=u'saintmarks.example.com')
+        self.assertIn(self.classification(a1, a2, contact_signals=False),
+                      (DedupeResponse.classifications.EXACT_DUPE, DedupeResponse.classifications.LIKELY_DUPE))
+        self.assertEqual(self.classification(a1, a2), DedupeResponse.classifications.NEEDS_REVIEW)
+
+        a3 = named_venue(u'Chase Bank', website=u'chase.com')
+        self.assertIsNone(self.classification(a1, a3))
+
+    def test_identical_names(self):
+        a1 = named_venue(u"Joe's Pizza", phone=u'212 555 0100', website=u'joespizza.com')
+        a2 = named_venue(u"Joe's Pizza", website=u'joespizzanyc.com')
+        self.assertEqual(self.classification(a1, a2), DedupeResponse.classifications.EXACT_DUPE)
+
+
+if __name__ == '__main__':
+    unittest.main()
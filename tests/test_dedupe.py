@@ -0,0 +1,125 @@
+import unittest
+
+try:
+    from postal.dedupe import duplicate_status, is_name_duplicate, is_street_duplicate, is_house_number_duplicate, place_languages
+    have_postal = True
+except ImportError:
+    have_postal = False
+
+from lieu.address import AddressComponents
+
+
+LANGUAGES = ['en']
+
+NAMES = [
+    u"Joe's Pizza",
+    u'Starbucks Coffee',
+    u'Katz Delicatessen',
+    u'St. Mark\'s Church',
+]
+
+# (house number 1, house number 2, trivially different)
+HOUSE_NUMBERS = [
+    (u'123', u'124', True),
+    (u'10', u'100', True),
+    (u'7', u'0007', False),
+    (u'2', u'20', True),
+    (u'12A', u'12', False),
+    (u'123', u'123', False),
+]
+
+# (street 1, street 2, trivially same, trivially different)
+STREETS = [
+    (u'W 34th St', u'West 34th Street', False, False),
+    (u'W 34th St', u'W 35th St', False, True),
+    (u'5th Ave', u'Fifth Avenue', False, False),
+    (u'5th Ave', u'6th Ave', False, True),
+    (u'Route 9', u'NY-9', False, False),
+    (u'Route 9', u'Route 1', False, True),
+    (u'Broadway', u'Broadway', True, False),
+    (u'Main St', u'Main Street', False, False),
+    (u'I-95', u'Interstate 95', False, False),
+    (u'W 34th St', u'W 34th St', True, False),
+]
+
+
+@unittest.skipUnless(have_postal, 'requires the libpostal Python bindings')
+class TestCheapChecks(unittest.TestCase):
+    '''The checks that skip libpostal fire on the expected pairs and agree with the libpostal predicates they stand in for'''
+
+    def setUp(self):
+        from lieu.dedupe import AddressDeduper, libpostal_cache
+        self.address_deduper = AddressDeduper
+        libpostal_cache.clear()
+
+    def test_trivially_same_names(self):
+        for name in NAMES:
+            self.assertTrue(self.address_deduper.is_trivially_same(name, name))
+            self.assertEqual(is_name_duplicate(name, name, languages=LANGUAGES), duplicate_status.EXACT_DUPLICATE)
+        self.assertFalse(self.address_deduper.is_trivially_same(NAMES[0], NAMES[1]))
+        self.assertFalse(self.address_deduper.is_trivially_same(u'-', u'-'))
+
+    def test_trivially_same_streets(self):
+        for street1, street2, trivially_same, trivially_different in STREETS:
+            self.assertEqual(self.address_deduper.is_trivially_same(street1, street2), trivially_same, (street1, street2))
+            if trivially_same:
+                self.assertEqual(is_street_duplicate(street1, street2, languages=LANGUAGES), duplicate_status.EXACT_DUPLICATE)
+
+    def test_trivially_different_house_numbers(self):
+        for house_number1, house_number2, trivially_different in HOUSE_NUMBERS:
+            self.assertEqual(self.address_deduper.is_trivially_different_house_number(house_number1, house_number2), trivially_different,
+                             (house_number1, house_number2))
+            if trivially_different:
+                self.assertNotEqual(is_house_number_duplicate(house_number1, house_number2, languages=LANGUAGES),
+                                    duplicate_status.EXACT_DUPLICATE)
+
+    def test_trivially_different_streets(self):
+        for street1, street2, trivially_same, trivially_different in STREETS:
+            self.assertEqual(self.address_deduper.is_trivially_different_street(street1, street2), trivially_different, (street1, street2))
+            if trivially_different:
+                self.assertNotIn(is_street_duplicate(street1, street2, languages=LANGUAGES),
+                                 (duplicate_status.EXACT_DUPLICATE, duplicate_status.LIKELY_DUPLICATE))
+
+    def test_is_address_dupe_matches_libpostal(self):
+        '''The cascade gives the same answer as calling libpostal on both components'''
+        for street1, street2, trivially_same, trivially_different in STREETS:
+            for house_number1, house_number2, house_number_different in HOUSE_NUMBERS:
+                a1 = {AddressComponents.STREET: street1, AddressComponents.HOUSE_NUMBER: house_number1}
+                a2 = {AddressComponents.STREET: street2, AddressComponents.HOUSE_NUMBER: house_number2}
+
+                same_street = is_street_duplicate(street1, street2, languages=LANGUAGES) in (duplicate_status.EXACT_DUPLICATE,
+                                                                                               duplicate_status.LIKELY_DUPLICATE)
+                same_house_number = is_house_number_duplicate(house_number1, house_number2, languages=LANGUAGES) == duplicate_status.EXACT_DUPLICATE
+
+                self.assertEqual(bool(self.address_deduper.is_address_dupe(a1, a2, languages=LANGUAGES)), same_street and same_house_number,
+                                 (a1, a2))
+
+
+# names in a different language from the street, and the same streets with other names
+PLACE_LANGUAGE_ADDRESSES = [
+    {AddressComponents.NAME: u'Boulangerie du Coin', AddressComponents.HOUSE_NUMBER: u'12', AddressComponents.STREET: u'Main Street'},
+    {AddressComponents.NAME: u"Joe's Diner", AddressComponents.HOUSE_NUMBER: u'12', AddressComponents.STREET: u'Main Street'},
+    {AddressComponents.NAME: u'Bäckerei Schmidt', AddressComponents.HOUSE_NUMBER: u'3', AddressComponents.STREET: u'Rue de Rivoli'},
+    {AddressComponents.NAME: u'Café de Flore', AddressComponents.HOUSE_NUMBER: u'3', AddressComponents.STREET: u'Rue de Rivoli'},
+    {AddressComponents.NAME: u'Panadería La Espiga', AddressComponents.HOUSE_NUMBER: u'3', AddressComponents.STREET: u'Hauptstraße'},
+    {AddressComponents.HOUSE_NUMBER: u'3', AddressComponents.STREET: u'Hauptstraße'},
+]
+
+
+@unittest.skipUnless(have_postal, 'requires the libpostal Python bindings')
+class TestLibpostalCache(unittest.TestCase):
+    def test_place_languages_same_as_uncached(self):
+        from lieu.dedupe import AddressDeduper, LibpostalCache
+        cache = LibpostalCache()
+
+        # twice, so the second pass is answered from the cache
+        for i in range(2):
+            for address in PLACE_LANGUAGE_ADDRESSES:
+                labels, values = AddressDeduper.address_labels_and_values(address)
+                self.assertEqual(cache.place_languages(labels, values), place_languages(labels, values), address)
+
+        self.assertGreater(cache.info()['place_languages']['hits'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+
+from collections import Counter
+
+try:
+    import geohash
+    import postal.dedupe
+    have_postal = True
+except ImportError:
+    have_postal = False
+
+from lieu.tfidf import TFIDF
+
+
+LAT, LON = 40.73056, -74.00214
+
+# all within a few meters, so in the same geohash cell
+NAMES = [
+    u"Joe's Pizza",
+    u'Pizza Hut',
+    u"Ray's Pizza",
+    u'Starbucks Coffee',
+    u'Blue Bottle Coffee',
+    u'Murray Bagels',
+    u"Katz's Delicatessen",
+    u'Chase Bank',
+    u'Duane Reade',
+    u'Duane Reade Pharmacy',
+    u'Grand Central Terminal',
+    u'Metropolitan Museum of Art',
+]
+
+
+@unittest.skipUnless(have_postal, 'requires the geohash module and the libpostal Python bindings')
+class TestNameIndex(unittest.TestCase):
+    '''Top-k in a single cell returns the near-duplicate names and not the dissimilar ones'''
+
+    def setUp(self):
+        from lieu.dedupe import Name
+        from lieu.index import NameIndex
+
+        self.tfidf = TFIDF()
+        for name in NAMES:
+            self.tfidf.update(Counter(Name.content_tokens(name)))
+
+        self.index = NameIndex(self.tfidf)
+        for i, name in enumerate(NAMES):
+            self.assertTrue(self.index.add(i, name, LAT + i * 1e-5, LON))
+
+        cells = set(self.index.cell(lat, lon) for name, num_ngrams, lat, lon in self.index.records.values())
+        self.assertEqual(len(cells), 1)
+
+    def test_top_k(self):
+        results = self.index.top_k(u'Starbucks Cofee', LAT, LON, k=2)
+        self.assertEqual(len(results), 2)
+
+        record_ids = [record_id for record_id, sim in results]
+        self.assertEqual(record_ids[0], NAMES.index(u'Starbucks Coffee'))
+        self.assertNotIn(NAMES.index(u'Chase Bank'), record_ids)
+        self.assertNotIn(NAMES.index(u"Joe's Pizza"), record_ids)
+
+        sims = [sim for record_id, sim in results]
+        self.assertEqual(sims, sorted(sims, reverse=True))
+
+    def test_top_k_record(self):
+        record_id = NAMES.index(u'Duane Reade')
+        results = self.index.top_k_record(record_id, k=2)
+
+        record_ids = [other_id for other_id, sim in results]
+        self.assertNotIn(record_id, record_ids)
+        self.assertEqual(record_ids[0], NAMES.index(u'Duane Reade Pharmacy'))
+        self.assertNotIn(NAMES.index(u'Murray Bagels'), record_ids)
+
+    def test_min_similarity(self):
+        results = self.index.top_k(u'Starbucks Coffee', LAT, LON, k=len(NAMES), min_similarity=0.99)
+        self.assertEqual([record_id for record_id, sim in results], [NAMES.index(u'Starbucks Coffee')])
+
+    def test_other_cell(self):
+        self.assertEqual(self.index.top_k(u'Starbucks Coffee', -LAT, -LON), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+    import mrjob
+    import geohash
+    import postal.dedupe
+    have_mrjob = True
+except ImportError:
+    have_mrjob = False
+
+from lieu.address import AddressComponents
+
+JOBS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts', 'jobs')
+
+
+def feature(name, house_number, street, lat, lon):
+    return {
+        'type': 'Feature',
+        'properties': {
+            'name': name,
+            'addr:housenumber': house_number,
+            'addr:street': street,
+        },
+        'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+    }
+
+
+FEATURES = [
+    feature(u"Joe's Pizza", u'7', u'Carmine St', 40.73056, -74.00214),
+    feature(u'Murrays Bagels', u'500', u'6th Ave', 40.73528, -73.99780),
+    feature(u"Joe's Pizza", u'7', u'Carmine Street', 40.73057, -74.00215),
+    feature(u"Joe's Pizza Restaurant", u'7', u'Carmine St', 40.73056, -74.00214),
+    feature(u'Murrays Bagels', u'500', u'Sixth Avenue', 40.73529, -73.99781),
+    feature(u'Starbucks', u'500', u'6th Ave', 40.73528, -73.99780),
+]
+
+
+def comparable(response):
+    '''Response without the random guids, with dupes in a fixed order'''
+    from lieu.api import DedupeResponse
+
+    response['object']['properties'].pop(DedupeResponse.guid_key, None)
+    for key in ('same_as', 'possibly_same_as'):
+        for dupe in response.get(key, []):
+            dupe['object']['properties'].pop(DedupeResponse.guid_key, None)
+        if key in response:
+            response[key].sort(key=lambda dupe: (-dupe.get('similarity', 0.0), json.dumps(dupe, sort_keys=True)))
+    return response
+
+
+@unittest.skipUnless(have_mrjob, 'requires mrjob, the geohash module and the libpostal Python bindings')
+class TestDedupeVenuesJob(unittest.TestCase):
+    '''The MapReduce steps, run inline, give the same responses as DedupePipeline, with the first record in the input as canonical'''
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.input_path = os.path.join(self.temp_dir, 'venues.geojson')
+        with open(self.input_path, 'w') as f:
+            for feat in FEATURES:
+                f.write(json.dumps(feat) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def run_job(self):
+        sys.path.insert(0, JOBS_DIR)
+        try:
+            from dedupe_geojson import DedupeVenuesJob
+        finally:
+            sys.path.remove(JOBS_DIR)
+
+        job = DedupeVenuesJob(['-r', 'inline', '--no-spark', '--num-buckets', '2', self.input_path])
+        with job.make_runner() as runner:
+            runner.run()
+            responses = [json.loads(job.parse_output_line(line)[1]) for line in runner.stream_output()]
+
+        return sorted(responses, key=lambda response: FEATURES.index(comparable(response)['object']))
+
+    def test_same_as_pipeline(self):
+        from lieu.pipeline import DedupePipeline
+
+        responses = self.run_job()
+        expected = [comparable(r) for r in DedupePipeline().dedupe(json.loads(json.dumps(f)) for f in FEATURES)]
+        self.assertEqual(responses, expected)
+
+    def test_first_record_is_canonical(self):
+        responses = self.run_job()
+
+        self.assertFalse(responses[0]['is_dupe'])
+        self.assertNotIn('same_as', responses[0])
+
+        same_as = responses[2]['same_as']
+        self.assertTrue(responses[2]['is_dupe'])
+        self.assertEqual(len(same_as), 1)
+        self.assertEqual(same_as[0]['object'], FEATURES[0])
+        self.assertTrue(same_as[0]['is_canonical'])
+
+        for response in responses:
+            for dupe in response.get('possibly_same_as', []):
+                self.assertLess(FEATURES.index(dupe['object']), FEATURES.index(response['object']))
+                self.assertEqual(dupe['classification'], 'needs_review')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+
+try:
+    import geohash
+    import postal.dedupe
+    have_postal = True
+except ImportError:
+    have_postal = False
+
+from lieu.address import AddressComponents, Coordinates
+
+
+def venue(name, lat=40.73056, lon=-74.00214):
+    return {
+        AddressComponents.NAME: name,
+        Coordinates.LATITUDE: lat,
+        Coordinates.LONGITUDE: lon,
+    }
+
+
+# one-letter typos, so most of the character trigrams are shared
+NEAR_DUPES = [
+    (u"Katz's Delicatessen", u"Katz's Delicatesen"),
+    (u'Starbucks Coffee', u'Starbucks Cofee'),
+    (u'Grand Central Terminal', u'Grand Central Terminall'),
+]
+
+# no character trigrams in common
+UNRELATED = [
+    (u"Joe's Pizza", u'Starbucks'),
+    (u'Murray Bagels', u'Katz Deli'),
+]
+
+
+@unittest.skipUnless(have_postal, 'requires the geohash module and the libpostal Python bindings')
+class TestMinHashLSH(unittest.TestCase):
+    '''Near-duplicate names nearby share a band key, unrelated names and far away names don't'''
+
+    def setUp(self):
+        from lieu.lsh import MinHashLSH
+        self.lsh = MinHashLSH()
+
+    def shared_keys(self, a1, a2, lsh=None):
+        lsh = lsh or self.lsh
+        return set(lsh.hashes(a1)) & set(lsh.hashes(a2))
+
+    def test_same_name(self):
+        a = venue(u"Joe's Pizza")
+        self.assertEqual(len(self.lsh.hashes(a)), self.lsh.num_bands)
+        self.assertEqual(self.lsh.hashes(a), self.lsh.hashes(venue(u"Joe's Pizza")))
+
+    def test_near_dupes(self):
+        for name1, name2 in NEAR_DUPES:
+            self.assertTrue(self.shared_keys(venue(name1), venue(name2)), (name1, name2))
+
+    def test_unrelated(self):
+        for name1, name2 in UNRELATED:
+            self.assertFalse(set(self.lsh.ngrams(name1)) & set(self.lsh.ngrams(name2)), (name1, name2))
+            self.assertFalse(self.shared_keys(venue(name1), venue(name2)), (name1, name2))
+
+    def test_other_cell(self):
+        from lieu.lsh import MinHashLSH
+
+        gh = geohash.encode(40.73056, -74.00214, precision=MinHashLSH.DEFAULT_GEOHASH_PRECISION)
+        lat, lon = geohash.decode(geohash.neighbors(gh)[0])[:2]
+        a1 = venue(u"Joe's Pizza")
+        a2 = venue(u"Joe's Pizza", lat=lat, lon=lon)
+
+        self.assertFalse(self.shared_keys(a1, a2))
+        self.assertTrue(self.shared_keys(a1, a2, lsh=MinHashLSH(with_neighbors=True)))
+
+    def test_no_keys(self):
+        self.assertEqual(self.lsh.hashes({AddressComponents.NAME: u"Joe's Pizza"}), [])
+        self.assertEqual(self.lsh.hashes(venue(u'')), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import io
+import random
+import unittest
+
+from lieu.api import DedupeResponse
+from lieu.pairs import IdSet, PairStore, ScoredPairs
+
+
+EXACT_DUPE = DedupeResponse.classifications.EXACT_DUPE
+LIKELY_DUPE = DedupeResponse.classifications.LIKELY_DUPE
+NEEDS_REVIEW = DedupeResponse.classifications.NEEDS_REVIEW
+
+
+class TestIdSet(unittest.TestCase):
+    def test_add_and_contains(self):
+        ids = IdSet()
+        random.seed(0)
+        expected = set(random.randrange(100000) for i in range(1000))
+        for record_id in expected:
+            ids.add(record_id)
+            ids.add(record_id)
+
+        self.assertEqual(len(ids), len(expected))
+        for record_id in range(100001):
+            self.assertEqual(record_id in ids, record_id in expected)
+        self.assertNotIn(10 ** 9, ids)
+
+
+class TestPairStore(unittest.TestCase):
+    def random_pairs(self, num_pairs, num_records=500):
+        random.seed(0)
+        classifications = [EXACT_DUPE, LIKELY_DUPE, NEEDS_REVIEW]
+        pairs = []
+        for i in range(num_pairs):
+            record_id = random.randrange(1, num_records)
+            canonical_id = random.randrange(record_id)
+            classification = random.choice(classifications)
+            sim = random.random() if classification != EXACT_DUPE else None
+            pairs.append((record_id, canonical_id, classification, sim))
+        return pairs
+
+    def expected_groups(self, pairs):
+        '''The first pair added for each (record, canonical), which is the one an in-memory store keeps'''
+        groups = {}
+        for record_id, canonical_id, classification, sim in pairs:
+            groups.setdefault(record_id, {}).setdefault(canonical_id, (canonical_id, classification, sim))
+        return [(record_id, sorted(groups[record_id].values(), key=lambda pair: pair[0])) for record_id in sorted(groups)]
+
+    def store(self, pairs, memory_limit=None):
+        store = PairStore(memory_limit=memory_limit)
+        for pair in pairs:
+            store.add(*pair)
+        return store
+
+    def test_groups_in_memory(self):
+        pairs = self.random_pairs(2000)
+        store = self.store(pairs)
+        self.assertEqual(store.runs, [])
+        self.assertEqual(list(store.groups()), self.expected_groups(pairs))
+        store.close()
+
+    def test_groups_merges_spilled_runs(self):
+        pairs = self.random_pairs(2000)
+        store = self.store(pairs, memory_limit=PairStore.record.size * 100)
+        self.assertGreater(len(store.runs), 1)
+        self.assertEqual(len(store), len(pairs))
+
+        groups = list(store.groups())
+        self.assertEqual([record_id for record_id, group in groups], sorted(set(pair[0] for pair in pairs)))
+        for record_id, group in groups:
+            canonical_ids = [canonical_id for canonical_id, classification, sim in group]
+            self.assertEqual(canonical_ids, sorted(set(canonical_ids)))
+
+        in_memory = self.store(pairs)
+        self.assertEqual([(record_id, [canonical_id for canonical_id, classification, sim in group]) for record_id, group in groups],
+                         [(record_id, [canonical_id for canonical_id, classification, sim in group]) for record_id, group in in_memory.groups()])
+        store.close()
+        in_memory.close()
+
+    def test_sorted_buffer_chunks(self):
+        '''Merging sorted chunks gives the same order as sorting the whole buffer, first added pair first'''
+        pairs = self.random_pairs(2000, num_records=50)
+        store = self.store(pairs)
+        chunked = self.store(pairs)
+        chunked.SORT_CHUNK_SIZE = 7
+
+        expected_order = sorted(range(len(pairs)), key=lambda i: (pairs[i][0], pairs[i][1]))
+        self.assertEqual(list(store.sorted_order()), expected_order)
+        self.assertEqual(list(chunked.sorted_order()), expected_order)
+        self.assertEqual(list(chunked.groups()), self.expected_groups(pairs))
+        store.close()
+        chunked.close()
+
+    def test_repeated_pairs_dropped(self):
+        '''A pair found in several blocks is only output once, whichever run it was spilled to'''
+        store = PairStore(memory_limit=PairStore.record.size * 2)
+        for i in range(5):
+            store.add(3, 1, LIKELY_DUPE, 0.9)
+        store.add(3, 2, NEEDS_REVIEW, 0.6)
+        store.add(3, 1, LIKELY_DUPE, 0.9)
+
+        self.assertGreater(len(store.runs), 1)
+        self.assertEqual(list(store.groups()), [(3, [(1, LIKELY_DUPE, 0.9), (2, NEEDS_REVIEW, 0.6)])])
+        store.close()
+
+    def test_dupes(self):
+        store = self.store([(1, 0, LIKELY_DUPE, 0.9), (2, 0, NEEDS_REVIEW, 0.6), (3, 2, EXACT_DUPE, None)])
+        self.assertEqual([record_id for record_id in range(4) if record_id in store.dupes], [1, 3])
+        store.close()
+
+    def test_join(self):
+        store = self.store([(4, 1, LIKELY_DUPE, 0.9), (2, 0, EXACT_DUPE, None)], memory_limit=PairStore.record.size)
+        records = [(i, 'record {}'.format(i)) for i in range(6)]
+        self.assertEqual(list(store.join(records)), [
+            (0, 'record 0', []),
+            (1, 'record 1', []),
+            (2, 'record 2', [(0, EXACT_DUPE, None)]),
+            (3, 'record 3', []),
+            (4, 'record 4', [(1, LIKELY_DUPE, 0.9)]),
+            (5, 'record 5', []),
+        ])
+        store.close()
+
+
+class TestScoredPairs(unittest.TestCase):
+    def test_round_trip(self):
+        pairs = [(1, 0, 2, 1, 0.75), (5, 3, 3, -1, None), (2 ** 40, 7, 0, 0, 0.0)]
+
+        f = io.BytesIO()
+        scored_pairs = ScoredPairs(f)
+        for pair in pairs:
+            scored_pairs.write(*pair)
+        self.assertEqual(scored_pairs.num_pairs, len(pairs))
+
+        f.seek(0)
+        self.assertEqual(list(ScoredPairs.read(f)), pairs)
+
+
+if __name__ == '__main__':
+    unittest.main()
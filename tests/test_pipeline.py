@@ -0,0 +1,125 @@
+import copy
+import json
+import unittest
+
+try:
+    import geohash
+    import postal.dedupe
+    have_postal = True
+except ImportError:
+    have_postal = False
+
+
+def feature(name, house_number, street, lat, lon):
+    return {
+        'type': 'Feature',
+        'properties': {
+            'name': name,
+            'addr:housenumber': house_number,
+            'addr:street': street,
+        },
+        'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+    }
+
+
+# two exact copies each of two venues (e.g. the same source imported twice), among unrelated venues
+FEATURES = [
+    feature(u"Joe's Pizza", u'7', u'Carmine St', 40.73056, -74.00214),
+    feature(u'Murrays Bagels', u'500', u'6th Ave', 40.73528, -73.99780),
+    feature(u"Joe's Pizza", u'7', u'Carmine St', 40.73056, -74.00214),
+    feature(u'Starbucks', u'500', u'6th Ave', 40.73528, -73.99780),
+    feature(u'Murrays Bagels', u'500', u'6th Ave', 40.73528, -73.99780),
+    feature(u'Duane Reade', u'7', u'Carmine St', 40.73056, -74.00214),
+]
+
+EXACT_DUPES = {2: 0, 4: 1}
+
+# near dupes of the venues above, so blocks have pairs of every kind
+NEAR_DUPES = [
+    feature(u"Joe's Pizza", u'7', u'Carmine Street', 40.73057, -74.00215),
+    feature(u"Joe's Pizza Restaurant", u'7', u'Carmine St', 40.73056, -74.00214),
+    feature(u'Murrays Bagels', u'500', u'Sixth Avenue', 40.73529, -73.99781),
+    feature(u'Duane Reade Pharmacy', u'7', u'Carmine St', 40.73056, -74.00214),
+]
+
+
+def comparable(response):
+    '''Response without the random guids, with dupes in a fixed order'''
+    from lieu.api import DedupeResponse
+
+    response['object']['properties'].pop(DedupeResponse.guid_key, None)
+    for key in ('same_as', 'possibly_same_as'):
+        for dupe in response.get(key, []):
+            dupe['object']['properties'].pop(DedupeResponse.guid_key, None)
+        if key in response:
+            response[key].sort(key=lambda dupe: (-dupe.get('similarity', 0.0), json.dumps(dupe, sort_keys=True)))
+    return response
+
+
+@unittest.skipUnless(have_postal, 'requires the geohash module and the libpostal Python bindings')
+class TestExactSignatures(unittest.TestCase):
+    '''The exact-signature pre-pass finds exact copies without comparing them, with the same responses as the pairwise path'''
+
+    def dedupe(self, **kw):
+        from lieu.pipeline import DedupePipeline
+
+        pipeline = DedupePipeline(**kw)
+        responses = [comparable(response) for response in pipeline.dedupe(copy.deepcopy(FEATURES))]
+        return pipeline, responses
+
+    def test_exact_dupes(self):
+        from lieu.api import DedupeResponse
+
+        pipeline, responses = self.dedupe(exact_signatures=True)
+        self.assertEqual(pipeline.num_exact_dupes, len(EXACT_DUPES))
+
+        for i, response in enumerate(responses):
+            self.assertEqual(response['is_dupe'], i in EXACT_DUPES)
+            if i in EXACT_DUPES:
+                self.assertEqual([(dupe['object'], dupe['classification'], dupe['is_canonical'], dupe['similarity']) for dupe in response['same_as']],
+                                 [(FEATURES[EXACT_DUPES[i]], DedupeResponse.classifications.EXACT_DUPE, True, 1.0)])
+
+    def test_same_as_pairwise(self):
+        signature_pipeline, signature_responses = self.dedupe(exact_signatures=True)
+        pairwise_pipeline, pairwise_responses = self.dedupe(exact_signatures=False)
+
+        self.assertEqual(pairwise_pipeline.num_exact_dupes, 0)
+        self.assertEqual(signature_responses, pairwise_responses)
+        self.assertLess(signature_pipeline.num_comparisons, pairwise_pipeline.num_comparisons)
+
+    def test_address_only(self):
+        signature_pipeline, signature_responses = self.dedupe(exact_signatures=True, address_only=True)
+        pairwise_pipeline, pairwise_responses = self.dedupe(address_only=True)
+
+        self.assertGreater(signature_pipeline.num_exact_dupes, 0)
+        self.assertEqual([response['is_dupe'] for response in signature_responses],
+                         [response['is_dupe'] for response in pairwise_responses])
+
+
+@unittest.skipUnless(have_postal, 'requires the geohash module and the libpostal Python bindings')
+class TestWorkers(unittest.TestCase):
+    '''Comparing blocks in a ForkWorkerPool gives the same responses as comparing them in process'''
+
+    def dedupe(self, **kw):
+        from lieu.pipeline import DedupePipeline
+
+        pipeline = DedupePipeline(**kw)
+        responses = [comparable(response) for response in pipeline.dedupe(copy.deepcopy(FEATURES + NEAR_DUPES))]
+        return pipeline, responses
+
+    def test_same_as_one_worker(self):
+        pipeline, responses = self.dedupe(num_workers=2)
+        expected_pipeline, expected = self.dedupe(num_workers=1)
+
+        self.assertEqual(responses, expected)
+        self.assertTrue(any(response['is_dupe'] for response in responses))
+        self.assertEqual(pipeline.num_comparisons, expected_pipeline.num_comparisons)
+        self.assertEqual(pipeline.num_dupes, expected_pipeline.num_dupes)
+
+        self.assertEqual(expected_pipeline.worker_stats, [])
+        self.assertEqual(len(pipeline.worker_stats), 2)
+        self.assertEqual(len(set(stats['pid'] for stats in pipeline.worker_stats)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
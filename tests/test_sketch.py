@@ -0,0 +1,111 @@
+import io
+import random
+import unittest
+
+from collections import Counter
+
+from lieu.sketch import CountMinSketch
+from lieu.tfidf import TFIDF, CountMinTFIDF
+
+
+def zipf_keys(num_keys, num_updates, seed=0):
+    '''Skewed key stream, like name tokens: a few very common keys and a long tail'''
+    rand = random.Random(seed)
+    return [u'key{}'.format(int(num_keys ** rand.random()) - 1) for i in range(num_updates)]
+
+
+class TestCountMinSketch(unittest.TestCase):
+    def test_never_undercounts(self):
+        # far more keys than counters, so most of them collide
+        sketch = CountMinSketch(64, depth=3)
+        keys = zipf_keys(2000, 20000)
+        counts = Counter()
+        for key in keys:
+            counts[key] += 1
+            self.assertGreaterEqual(sketch.add(key), counts[key])
+
+        for key, count in counts.items():
+            self.assertGreaterEqual(sketch.estimate(key), count)
+        self.assertEqual(sketch.total, len(keys))
+
+    def test_never_undercounts_weighted(self):
+        sketch = CountMinSketch(32, depth=2)
+        rand = random.Random(1)
+        counts = Counter()
+        for i in range(5000):
+            key = u'key{}'.format(rand.randrange(500))
+            count = rand.randrange(1, 10)
+            counts[key] += count
+            sketch.add(key, count)
+
+        for key, count in counts.items():
+            self.assertGreaterEqual(sketch.estimate(key), count)
+
+    def test_error_bound(self):
+        sketch = CountMinSketch.from_error(0.01, 0.01)
+        keys = zipf_keys(5000, 50000)
+        counts = Counter(keys)
+        for key in keys:
+            sketch.add(key)
+
+        bound = sketch.error_bound()
+        over = sum((1 for key, count in counts.items() if sketch.estimate(key) - count > bound))
+        self.assertLessEqual(over, sketch.delta * len(counts))
+
+    def test_unseen_keys(self):
+        sketch = CountMinSketch(1024)
+        for key in zipf_keys(100, 1000):
+            sketch.add(key)
+        self.assertGreaterEqual(sketch.estimate(u'not a key'), 0)
+        self.assertEqual(CountMinSketch(1024).estimate(u'not a key'), 0)
+
+    def test_from_memory(self):
+        sketch = CountMinSketch.from_memory(1024 * 1024, depth=4)
+        self.assertLessEqual(sketch.width * sketch.depth * sketch.counts.itemsize, 1024 * 1024)
+        self.assertEqual(len(sketch.counts), sketch.width * sketch.depth)
+
+    def test_stable_across_instances(self):
+        '''Same seed, same counters, so sketches built in different processes agree'''
+        sketch1 = CountMinSketch(128, seed=7)
+        sketch2 = CountMinSketch(128, seed=7)
+        self.assertEqual(sketch1.indices(u'pizza'), sketch2.indices(u'pizza'))
+
+
+class TestCountMinTFIDF(unittest.TestCase):
+    def docs(self):
+        rand = random.Random(0)
+        common = [u'pizza', u'cafe', u'bar', u'restaurant']
+        return [Counter([rand.choice(common), u'rare{}'.format(i), u'rarer{}'.format(rand.randrange(10 ** 6))]) for i in range(5000)]
+
+    def test_doc_frequencies(self):
+        tfidf = TFIDF()
+        sketch_tfidf = CountMinTFIDF.from_memory(64 * 1024, min_count=5)
+        for doc in self.docs():
+            tfidf.update(doc)
+            sketch_tfidf.update(doc)
+
+        self.assertEqual(sketch_tfidf.N, tfidf.N)
+
+        for term, count in tfidf.idf_counts.items():
+            if count >= sketch_tfidf.min_count:
+                # promoted terms never count fewer docs than the exact index
+                self.assertIn(term, sketch_tfidf.idf_counts)
+                self.assertGreaterEqual(sketch_tfidf.doc_frequency(term), count)
+            elif term not in sketch_tfidf.idf_counts:
+                self.assertEqual(sketch_tfidf.doc_frequency(term), sketch_tfidf.rare_doc_frequency)
+
+        # the one-off tail isn't kept
+        self.assertLess(len(sketch_tfidf.idf_counts), len(tfidf.idf_counts) // 10)
+
+    def test_read_adds_to_sketch(self):
+        sketch_tfidf = CountMinTFIDF.from_memory(64 * 1024, min_count=5)
+        sketch_tfidf.update(Counter([u'pizza']))
+        sketch_tfidf.read(io.StringIO(u't:pizza\t4\nt:cafe\t2\nN\t10\n'))
+
+        self.assertEqual(sketch_tfidf.N, 11)
+        self.assertEqual(sketch_tfidf.doc_frequency(u'pizza'), 5)
+        self.assertEqual(sketch_tfidf.doc_frequency(u'cafe'), sketch_tfidf.rare_doc_frequency)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+
+try:
+    import pyspark
+    import pandas
+    import pyarrow
+    import postal.dedupe
+    have_spark = True
+except ImportError:
+    have_spark = False
+
+from lieu.address import AddressComponents, Coordinates
+
+
+def venue(name, house_number, street, lat, lon):
+    return {
+        AddressComponents.NAME: name,
+        AddressComponents.HOUSE_NUMBER: house_number,
+        AddressComponents.STREET: street,
+        Coordinates.LATITUDE: lat,
+        Coordinates.LONGITUDE: lon,
+    }
+
+
+VENUES = [
+    venue(u"Joe's Pizza", u'7', u'Carmine St', 40.73056, -74.00214),
+    venue(u"Joe's Pizza", u'7', u'Carmine Street', 40.73057, -74.00215),
+    venue(u'Joes Pizza', u'7', u'Carmine St', 40.73055, -74.00213),
+    venue(u"Joe's Pizza Restaurant", u'7', u'Carmine St', 40.73056, -74.00214),
+    venue(u'Murray\'s Bagels', u'500', u'6th Ave', 40.73528, -73.99780),
+    venue(u'Murrays Bagels', u'500', u'Sixth Avenue', 40.73529, -73.99781),
+    venue(u'Starbucks', u'500', u'6th Ave', 40.73528, -73.99780),
+    venue(u'Katz\'s Delicatessen', u'205', u'E Houston St', 40.72227, -73.98741),
+]
+
+
+@unittest.skipUnless(have_spark, 'requires pyspark, pandas, pyarrow and the libpostal Python bindings')
+class TestVenueDeduperSparkDF(unittest.TestCase):
+    '''The DataFrame scoring path gives the same pairs, classes and similarities as the RDD one, in local mode'''
+
+    @classmethod
+    def setUpClass(cls):
+        from pyspark import SparkContext
+        cls.sc = SparkContext('local[2]', 'lieu dataframe test')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sc.stop()
+
+    def dupe_sims(self, deduper, geo_model):
+        from lieu.spark.utils import IDPairRDD
+
+        address_ids = self.sc.parallelize([(address, uid) for uid, address in enumerate(VENUES)], 2)
+        return sorted(deduper.dupe_sims(address_ids, geo_model=geo_model, join_strategy=IDPairRDD.COPARTITION).collect())
+
+    def assert_same_dupe_sims(self, geo_model):
+        from lieu.spark.dedupe import VenueDeduperSpark
+        from lieu.spark.dataframe import VenueDeduperSparkDF
+
+        expected = self.dupe_sims(VenueDeduperSpark, geo_model)
+        result = self.dupe_sims(VenueDeduperSparkDF, geo_model)
+
+        self.assertTrue(expected)
+        self.assertEqual([pair for pair, (classification, sim) in result], [pair for pair, (classification, sim) in expected])
+        for (pair, (classification, sim)), (expected_pair, (expected_classification, expected_sim)) in zip(result, expected):
+            self.assertEqual(classification, expected_classification, pair)
+            self.assertAlmostEqual(sim, expected_sim, places=6, msg=pair)
+
+    def test_same_output(self):
+        self.assert_same_dupe_sims(geo_model=False)
+
+    def test_same_output_geo_model(self):
+        self.assert_same_dupe_sims(geo_model=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
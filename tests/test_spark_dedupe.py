@@ -0,0 +1,100 @@
+import unittest
+
+try:
+    import geohash
+    import postal.dedupe
+    have_postal = True
+except ImportError:
+    have_postal = False
+
+try:
+    import pyspark
+    have_spark = have_postal
+except ImportError:
+    have_spark = False
+
+from lieu.address import AddressComponents, Coordinates
+
+
+def venue(name, house_number, street, lat, lon):
+    return {
+        AddressComponents.NAME: name,
+        AddressComponents.HOUSE_NUMBER: house_number,
+        AddressComponents.STREET: street,
+        Coordinates.LATITUDE: lat,
+        Coordinates.LONGITUDE: lon,
+    }
+
+
+VENUES = [
+    venue(u"Joe's Pizza", u'7', u'Carmine St', 40.73056, -74.00214),
+    venue(u"Joe's Pizza", u'7', u'Carmine Street', 40.73057, -74.00215),
+    venue(u'Joes Pizza', u'7', u'Carmine St', 40.73055, -74.00213),
+    venue(u'Murray\'s Bagels', u'500', u'6th Ave', 40.73528, -73.99780),
+    venue(u'Murrays Bagels', u'500', u'Sixth Avenue', 40.73529, -73.99781),
+    venue(u'Starbucks', u'501', u'6th Ave', 40.73528, -73.99780),
+    venue(u'Katz\'s Delicatessen', u'205', u'E Houston St', 40.72227, -73.98741),
+]
+
+
+@unittest.skipUnless(have_postal, 'requires the geohash module and the libpostal Python bindings')
+class TestChooseJoinStrategy(unittest.TestCase):
+    '''Each join strategy is chosen for some sizes'''
+
+    def choose(self, vector_bytes, num_hash_entries, num_address_dupe_pairs):
+        from lieu.spark.dedupe import VenueDeduperSpark
+        return VenueDeduperSpark.choose_join_strategy(vector_bytes, num_hash_entries, num_address_dupe_pairs, broadcast_max_bytes=1000)
+
+    def test_broadcast(self):
+        from lieu.spark.utils import IDPairRDD
+        self.assertEqual(self.choose(1000, 10 ** 6, 0), IDPairRDD.BROADCAST)
+
+    def test_block(self):
+        from lieu.spark.utils import IDPairRDD
+        # dense blocks where most candidates survive the address checks
+        self.assertEqual(self.choose(10 ** 6, 10 ** 5, 10 ** 6), IDPairRDD.BLOCK)
+
+    def test_copartition(self):
+        from lieu.spark.utils import IDPairRDD
+        # many hash entries per record and few pairs left after the address checks
+        self.assertEqual(self.choose(10 ** 6, 10 ** 6, 10 ** 4), IDPairRDD.COPARTITION)
+
+
+@unittest.skipUnless(have_spark, 'requires pyspark, the geohash module and the libpostal Python bindings')
+class TestDupePairEstimates(unittest.TestCase):
+    '''Sampling every hash key gives the exact counts'''
+
+    @classmethod
+    def setUpClass(cls):
+        from pyspark import SparkContext
+        cls.sc = SparkContext('local[2]', 'lieu dedupe test')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sc.stop()
+
+    def test_full_sample(self):
+        from six import itertools
+        from lieu.address import Address
+        from lieu.dedupe import VenueDeduper
+        from lieu.spark.dedupe import AddressDeduperSpark
+
+        address_ids = self.sc.parallelize([(address, uid) for uid, address in enumerate(VENUES)], 2)
+        address_hashes = AddressDeduperSpark.address_hashes(address_ids, deduper=VenueDeduper).collect()
+
+        blocks = {}
+        for key, (uid, address) in address_hashes:
+            blocks.setdefault(key, []).append((uid, address))
+
+        expected_dupe_pairs = sum((1 for block in blocks.values() for pair in itertools.combinations(block, 2)
+                                   if AddressDeduperSpark.is_address_dupe_pair(pair)))
+
+        num_hash_entries, num_address_dupe_pairs = AddressDeduperSpark.dupe_pair_estimates(self.sc.parallelize(address_hashes, 2),
+                                                                                             sample_fraction=1.0)
+        self.assertEqual(num_hash_entries, len(address_hashes))
+        self.assertEqual(num_address_dupe_pairs, expected_dupe_pairs)
+        self.assertTrue(expected_dupe_pairs)
+
+
+if __name__ == '__main__':
+    unittest.main()
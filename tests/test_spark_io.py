@@ -0,0 +1,168 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import pyspark
+    have_spark = True
+except ImportError:
+    have_spark = False
+
+from lieu.address import Address
+
+
+def feature(feature_id, name, house_number, street, lat, lon, **properties):
+    properties.update({
+        'id': feature_id,
+        'name': name,
+        'addr:housenumber': house_number,
+        'addr:street': street,
+    })
+    return {
+        'type': 'Feature',
+        'properties': properties,
+        'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+    }
+
+
+FEATURES = [
+    feature(1, u"Joe's Pizza", u'7', u'Carmine St', 40.73056, -74.00214, amenity=u'restaurant'),
+    feature(2, u"Joe's Pizza", u'7', u'Carmine Street', 40.73057, -74.00215, phone=u'+1 212 366 1182'),
+    feature(3, u'Murrays Bagels', u'500', u'6th Ave', 40.73528, -73.99780, website=None),
+]
+
+
+def without_nulls(value):
+    if isinstance(value, dict):
+        return {k: without_nulls(v) for k, v in value.items() if v is not None}
+    elif isinstance(value, list):
+        return [without_nulls(v) for v in value]
+    return value
+
+
+@unittest.skipUnless(have_spark, 'requires pyspark')
+class TestGeoJSONParquet(unittest.TestCase):
+    '''Features written to Parquet read back as the same addresses and records, less their null fields'''
+
+    @classmethod
+    def setUpClass(cls):
+        from pyspark import SparkContext
+        from lieu.spark.tfidf import spark_session
+
+        cls.sc = SparkContext('local[2]', 'lieu io test')
+        cls.spark = spark_session(cls.sc)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sc.stop()
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_read(self):
+        from lieu.spark.io import GeoJSONParquet
+        from lieu.spark.utils import RDDPersistence
+
+        input_path = os.path.join(self.temp_dir, 'features')
+        self.spark.read.json(self.sc.parallelize([json.dumps(f) for f in FEATURES], 1)).write.parquet(input_path)
+
+        persistence = RDDPersistence()
+        address_ids, id_records = GeoJSONParquet.read(self.sc, input_path, persistence)
+        addresses = dict(((uid, address) for address, uid in address_ids.collect()))
+        records = {uid: json.loads(record) for uid, record in id_records.collect()}
+        persistence.unpersist_all()
+
+        self.assertEqual(sorted(addresses), sorted(records))
+        expected = {f['properties']['id']: f for f in FEATURES}
+        self.assertEqual(len(records), len(expected))
+
+        for uid, record in records.items():
+            original = expected[record['properties']['id']]
+            self.assertEqual(record, without_nulls(original))
+            self.assertEqual(addresses[uid], Address.from_geojson(without_nulls(original)))
+
+    def test_write(self):
+        from lieu.spark.io import GeoJSONParquet
+
+        output_path = os.path.join(self.temp_dir, 'responses')
+        GeoJSONParquet.write(self.sc.parallelize(FEATURES, 2), output_path)
+
+        written = [json.loads(line) for line in self.spark.read.parquet(output_path).toJSON().collect()]
+        self.assertEqual(sorted(written, key=lambda f: f['properties']['id']), [without_nulls(f) for f in FEATURES])
+
+
+# ((uid1, uid2), (classification, similarity)), uid1 is the dupe and uid2 the canonical
+DUPE_SIMS = [
+    ((1, 0), ('exact_dupe', 1.0)),
+    ((2, 0), ('likely_dupe', 0.93)),
+    ((3, 2), ('needs_review', 0.75)),
+    ((3, 0), ('needs_review', 0.8)),
+]
+
+RESPONSE_FEATURES = FEATURES + [
+    feature(4, u'Joes Pizza', u'7', u'Carmine St', 40.73055, -74.00213),
+    feature(5, u'Katz\'s Delicatessen', u'205', u'E Houston St', 40.72227, -73.98741),
+]
+
+
+def without_guids(response):
+    from lieu.api import DedupeResponse
+
+    response['object']['properties'].pop(DedupeResponse.guid_key, None)
+    for key in ('same_as', 'possibly_same_as'):
+        for dupe in response.get(key, []):
+            dupe['object']['properties'].pop(DedupeResponse.guid_key, None)
+    return response
+
+
+@unittest.skipUnless(have_spark, 'requires pyspark')
+class TestDedupeResponses(unittest.TestCase):
+    '''The distributed responses are the ones DedupeResponse.create gives for the same pairs, in input order'''
+
+    @classmethod
+    def setUpClass(cls):
+        from pyspark import SparkContext
+        cls.sc = SparkContext('local[2]', 'lieu responses test')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sc.stop()
+
+    def expected_responses(self):
+        from lieu.api import DedupeResponse
+
+        dupe_uids = set([uid1 for (uid1, uid2), (classification, sim) in DUPE_SIMS if classification in DedupeResponse.dupe_classifications])
+        responses = []
+        for uid, value in enumerate(RESPONSE_FEATURES):
+            same_as = [(json.loads(json.dumps(RESPONSE_FEATURES[uid2])), classification, uid2 not in dupe_uids, sim)
+                       for (uid1, uid2), (classification, sim) in DUPE_SIMS if uid1 == uid]
+            responses.append(DedupeResponse.create(json.loads(json.dumps(value)), is_dupe=uid in dupe_uids, same_as=same_as))
+        return responses
+
+    def test_responses(self):
+        from lieu.spark.io import DedupeResponses
+
+        id_records = self.sc.parallelize([(uid, json.dumps(f)) for uid, f in enumerate(RESPONSE_FEATURES)], 2)
+        dupe_sims = self.sc.parallelize(DUPE_SIMS, 2)
+
+        responses = [without_guids(r) for r in DedupeResponses.responses(dupe_sims, id_records).collect()]
+        self.assertEqual(responses, self.expected_responses())
+        self.assertEqual([r['possibly_same_as'][0]['similarity'] for r in responses if 'possibly_same_as' in r], [0.8])
+
+    def test_dupes_only(self):
+        from lieu.spark.io import DedupeResponses
+
+        id_records = self.sc.parallelize([(uid, json.dumps(f)) for uid, f in enumerate(RESPONSE_FEATURES)], 2)
+        dupe_sims = self.sc.parallelize(DUPE_SIMS, 2)
+
+        responses = [without_guids(r) for r in DedupeResponses.responses(dupe_sims, id_records, dupes_only=True).collect()]
+        self.assertEqual(responses, [r for r in self.expected_responses() if 'same_as' in r or 'possibly_same_as' in r])
+
+
+if __name__ == '__main__':
+    unittest.main()
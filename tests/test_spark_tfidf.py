@@ -0,0 +1,143 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import pyspark
+    import geohash
+    import postal.dedupe
+    have_spark = True
+except ImportError:
+    have_spark = False
+
+from lieu.address import AddressComponents, Coordinates
+
+
+def venue(name, lat, lon):
+    return {
+        AddressComponents.NAME: name,
+        Coordinates.LATITUDE: lat,
+        Coordinates.LONGITUDE: lon,
+    }
+
+
+MODEL_VENUES = [
+    venue(u"Joe's Pizza", 40.73056, -74.00214),
+    venue(u'Murrays Bagels', 40.73528, -73.99780),
+    venue(u'Starbucks', 40.73528, -73.99780),
+    venue(u'Pizza Hut', 40.72227, -73.98741),
+]
+
+# a word and an area (San Francisco) the model hasn't seen
+NEW_VENUES = [
+    venue(u"Joe's Pizza", 40.73057, -74.00215),
+    venue(u'Tartine Bakery', 37.76143, -122.42410),
+    venue(u'Starbucks', 37.76140, -122.42400),
+]
+
+
+# (geohash at precision 5, doc count), dense around dr5 with a sparse top-level cell at 9q8
+SKEWED_GEOHASH_COUNTS = [
+    ('dr5ru', 150),
+    ('dr5rv', 20),
+    ('dr5q1', 5),
+    ('dr5x0', 30),
+    ('dr7ab', 50),
+    ('9q8yy', 3),
+]
+
+
+@unittest.skipUnless(have_spark, 'requires pyspark, the geohash module and the libpostal Python bindings')
+class TestGeoCells(unittest.TestCase):
+    '''Dense cells are split, sparse children stay with their parent and sparse top-level cells are left out'''
+
+    @classmethod
+    def setUpClass(cls):
+        from pyspark import SparkContext
+        cls.sc = SparkContext('local[2]', 'lieu geo cells test')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sc.stop()
+
+    def test_build(self):
+        from lieu.spark.tfidf import GeoCells
+
+        cells = GeoCells.build(self.sc.parallelize(SKEWED_GEOHASH_COUNTS, 2), min_precision=3, max_precision=5,
+                               target_doc_count=100, min_doc_count=10)
+
+        self.assertEqual(cells, {'dr5': 5, 'dr5r': 0, 'dr5ru': 150, 'dr5rv': 20, 'dr5x': 30, 'dr7': 50})
+        self.assertEqual(sum(cells.values()), sum((count for geo, count in SKEWED_GEOHASH_COUNTS)) - 3)
+
+        self.assertEqual(GeoCells.cell('dr5ru9', cells), 'dr5ru')
+        self.assertEqual(GeoCells.cell('dr5q1b', cells), 'dr5')
+        self.assertEqual(GeoCells.cell('dr7ab2', cells), 'dr7')
+        self.assertIsNone(GeoCells.cell('9q8yyk', cells))
+
+
+@unittest.skipUnless(have_spark, 'requires pyspark, the geohash module and the libpostal Python bindings')
+class TestTFIDFModelSpark(unittest.TestCase):
+    '''A saved model can be loaded and reused as is on new docs'''
+
+    @classmethod
+    def setUpClass(cls):
+        from pyspark import SparkContext
+        cls.sc = SparkContext('local[2]', 'lieu tfidf test')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sc.stop()
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def address_ids(self, venues):
+        return self.sc.parallelize([(address, uid) for uid, address in enumerate(venues)], 2)
+
+    def assert_reused(self, adaptive_geo_cells):
+        from lieu.spark.dedupe import VenueDeduperSpark
+        from lieu.spark.tfidf import DocFrequencyModel, GeoTFIDFSpark, TFIDFModelSpark
+
+        path = os.path.join(self.temp_dir, 'model')
+        prior = None
+        if adaptive_geo_cells:
+            # cells small enough for a handful of docs, the defaults would leave every doc to the global model
+            geo_cells = GeoTFIDFSpark.geo_cells(VenueDeduperSpark.names_geo(self.address_ids(MODEL_VENUES)), has_id=True,
+                                                target_doc_count=2, min_doc_count=1)
+            prior = DocFrequencyModel(None, 0, None, None, geo_cells)
+        model = VenueDeduperSpark.doc_frequency_model(self.address_ids(MODEL_VENUES), model=prior, adaptive_geo_cells=adaptive_geo_cells)
+        TFIDFModelSpark.save(model, path)
+        # saving over an existing model replaces it
+        TFIDFModelSpark.save(model, path)
+        self.assertEqual(sorted(os.listdir(self.temp_dir)), ['model'])
+
+        loaded = TFIDFModelSpark.load(self.sc, path)
+        self.assertEqual(loaded.total_docs, len(MODEL_VENUES))
+        self.assertEqual(sorted(loaded.doc_frequency.collect()), sorted(model.doc_frequency.collect()))
+
+        self.assertEqual(loaded.geo_cells, model.geo_cells)
+
+        name_tfidfs = VenueDeduperSpark.name_tfidfs(self.address_ids(NEW_VENUES), loaded).collectAsMap()
+        self.assertEqual(sorted(name_tfidfs), list(range(len(NEW_VENUES))))
+        for uid, (tfidf, geo_tfidf) in name_tfidfs.items():
+            self.assertTrue(tfidf, uid)
+            if adaptive_geo_cells and NEW_VENUES[uid][Coordinates.LONGITUDE] < -100:
+                # no cell covers the new area, so it only has the global vector
+                self.assertIsNone(geo_tfidf, uid)
+            else:
+                self.assertTrue(geo_tfidf, uid)
+                self.assertEqual(set(tfidf), set(geo_tfidf))
+
+    def test_reuse_fixed_geohashes(self):
+        self.assert_reused(adaptive_geo_cells=False)
+
+    def test_reuse_adaptive_cells(self):
+        self.assert_reused(adaptive_geo_cells=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
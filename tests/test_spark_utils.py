@@ -0,0 +1,51 @@
+import unittest
+
+try:
+    import pyspark
+    have_spark = True
+except ImportError:
+    have_spark = False
+
+
+@unittest.skipUnless(have_spark, 'requires pyspark')
+class TestRDDPersistence(unittest.TestCase):
+    '''Persisting an RDD that's already persisted leaves it alone'''
+
+    @classmethod
+    def setUpClass(cls):
+        from pyspark import SparkContext
+        cls.sc = SparkContext('local[2]', 'lieu utils test')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sc.stop()
+
+    def test_persist(self):
+        from pyspark import StorageLevel
+        from lieu.spark.utils import RDDPersistence
+
+        persistence = RDDPersistence(storage_level='MEMORY_AND_DISK')
+        rdd = persistence.persist(self.sc.parallelize(range(10), 2), 'numbers')
+        self.assertEqual(rdd.getStorageLevel(), StorageLevel.MEMORY_AND_DISK)
+        self.assertEqual(list(persistence.rdds), ['numbers'])
+
+        persistence.unpersist_all()
+        self.assertFalse(rdd.is_cached)
+
+    def test_already_persisted(self):
+        from pyspark import StorageLevel
+        from lieu.spark.utils import RDDPersistence
+
+        rdd = self.sc.parallelize(range(10), 2).persist(StorageLevel.MEMORY_ONLY)
+
+        persistence = RDDPersistence(storage_level='MEMORY_AND_DISK')
+        self.assertIs(persistence.persist(rdd, 'numbers'), rdd)
+        self.assertEqual(rdd.getStorageLevel(), StorageLevel.MEMORY_ONLY)
+
+        persistence.unpersist_all()
+        self.assertTrue(rdd.is_cached)
+        rdd.unpersist()
+
+
+if __name__ == '__main__':
+    unittest.main()